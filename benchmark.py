@@ -0,0 +1,262 @@
+'''
+	POKEY2MIDI benchmark
+	
+	Description:
+		Times POKEY2MIDI conversions of POKEY dumps, to keep an eye on performance
+		By default, every sample dump is converted with a few option profiles
+		
+		Conversions are timed stage by stage. Unlike in POKEY2MIDI, where each frame goes through
+		all stages before the next one is read, stages run one after the other here, each keeping
+		all of its results for the next. For each stage, the wall time, the frames per second and
+		the peak memory (from a separate run, with tracemalloc) are recorded.
+		
+		So that results don't depend on the order dumps and profiles are run in, each conversion
+		is run once untimed first, to pay one-time costs (such as imports and first calls), and
+		every run starts with an empty note lookup cache (see pokey2midi.lookupNote).
+		
+		Stages are:
+			decompress		reading (and decompressing) the dump
+			parse			parsing dump lines into POKEY frames
+			compile			compiling POKEY frames into notes (Song.compileFrames), and recording
+							them for tempo detection, with --findbpm (Song.recordFrames)
+			assemble		assembling MIDI events, including marking short notes, which is done
+							as notes end (Converter.assemble)
+			save			saving the MIDI file (MIDI.save)
+			detectTempo		guessing the tempo, with --findbpm (Converter.detectTempo)
+		
+		Results can be saved as JSON, and compared to the results of a previous run. Any stage of
+		any profile that takes too much longer than before, or needs too much more memory, counts
+		as a regression, and the benchmark fails.
+	
+	For usage, run: python benchmark.py -h
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+import pokey2midi
+
+# Settings
+SAMPLES_DIR			= os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "dump")
+DEFAULT_REPEAT		= 1
+DEFAULT_THRESHOLD	= 25 # percent
+MIN_TIME			= 0.05 # stages faster than this (in seconds, for all dumps) are too noisy to compare
+MIN_MEMORY			= 1 << 20 # same, for memory (in bytes)
+STAGES				= ["decompress", "parse", "compile", "assemble", "save", "detectTempo"]
+# Options to convert each dump with
+# --all retriggers notes on every change, which is as dense as conversions get
+PROFILES			= {
+	'default':		[],
+	'all':			["--all"],
+	'usevol':		["--usevol", "--useinst"],
+	'shortnotes':	["--shortnotes", "16"],
+	'findbpm':		["--findbpm"],
+	'dense':		["--all", "--shortnotes", "16"]
+}
+
+# Times the stages of conversions, and measures their memory use, if enabled
+class StageTimer(object):
+	def __init__(self, memory=False):
+		self.memory = memory
+		self.times = dict() # time of each stage, in seconds
+		self.peaks = dict() # peak memory of each stage, in bytes
+	
+	@contextlib.contextmanager
+	def stage(self, name):
+		if self.memory:
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+		start = time.perf_counter()
+		yield
+		self.times[name] = time.perf_counter() - start
+		if self.memory:
+			self.peaks[name] = tracemalloc.get_traced_memory()[1] - before
+
+# Convert a dump stage by stage (see above)
+# Returns the number of frames converted
+def runStages(converter, dump, output, timer):
+	pokey2midi.lookupNote.cache_clear() # every run starts from scratch
+	song = pokey2midi.Song(converter)
+	midi = pokey2midi.MIDI()
+	format = converter.sniffFormat(dump)
+	
+	with timer.stage("decompress"):
+		if format == "pkd": # Packed dumps are only mapped, and read when parsing
+			mode, frames = converter.openPKD(dump)
+		else:
+			with converter.openDump(dump, format) as fin:
+				mode, lines = converter.detectMode(fin)
+				lines = list(lines)
+	
+	with timer.stage("parse"):
+		if format != "pkd":
+			frames = converter.readDump(lines, mode)
+		frames = list(frames)
+	
+	with timer.stage("compile"):
+		music = song.compileFrames(frames, mode)
+		if converter.DetectTempo:
+			music = song.recordFrames(music, mode)
+		music = list(music)
+	
+	with timer.stage("assemble"):
+		converter.assemble(song, music, midi)
+	
+	with timer.stage("save"):
+		midi.save(output)
+	
+	if converter.DetectTempo:
+		with timer.stage("detectTempo"):
+			converter.detectTempo(song)
+	
+	return len(frames)
+
+# Benchmark a dump with a set of options
+# Returns the results of each stage that ran: best time, frames per second and peak memory
+def benchmark(parser, dump, options, repeat):
+	converter = pokey2midi.makeConverter(parser.parse_args(options + [dump]))
+	with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+		output = os.path.join(tmp, "benchmark.mid")
+		runStages(converter, dump, output, StageTimer()) # untimed warm-up, for one-time costs
+		times = dict()
+		for n in range(repeat):
+			timer = StageTimer()
+			numFrames = runStages(converter, dump, output, timer)
+			for stage, t in timer.times.items():
+				times[stage] = min(t, times.get(stage, t))
+		
+		# Memory is measured separately, since tracemalloc slows everything down
+		timer = StageTimer(memory=True)
+		tracemalloc.start()
+		try:
+			runStages(converter, dump, output, timer)
+		finally:
+			tracemalloc.stop()
+	
+	return {
+		stage: {
+			'time': times[stage],
+			'frames': numFrames,
+			'fps': numFrames / times[stage] if times[stage] > 0 else 0.0,
+			'memory': timer.peaks[stage]
+		} for stage in STAGES if stage in times
+	}
+
+# Add up the results of all dumps, for each profile and stage
+def totals(results):
+	total = dict()
+	for dump in results.values():
+		for profile, stages in dump.items():
+			for stage, r in stages.items():
+				t = total.setdefault(profile, dict()).setdefault(
+					stage, {'time': 0.0, 'frames': 0, 'fps': 0.0, 'memory': 0}
+				)
+				t['time'] += r['time']
+				t['frames'] += r['frames']
+				t['memory'] = max(t['memory'], r['memory'])
+	for stages in total.values():
+		for t in stages.values():
+			t['fps'] = t['frames'] / t['time'] if t['time'] > 0 else 0.0
+	return total
+
+# Compare totals with those of a baseline
+# Returns a list of regressions: (profile, stage, what, baseline value, new value)
+def compare(total, baseline, threshold):
+	regressions = []
+	for profile, stages in total.items():
+		for stage, t in stages.items():
+			base = baseline.get(profile, dict()).get(stage)
+			if base is None: # Nothing to compare to
+				continue
+			for what, minimum in [('time', MIN_TIME), ('memory', MIN_MEMORY)]:
+				if max(base[what], t[what]) < minimum:
+					continue
+				if t[what] > base[what] * (1 + threshold / 100):
+					regressions.append( (profile, stage, what, base[what], t[what]) )
+	return regressions
+
+# If running by itself, handle command line options
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Times POKEY2MIDI conversions of POKEY dumps, stage by stage.")
+	parser.add_argument('--profiles', metavar='name,name,...', nargs=1, type=str, help="Option profiles to convert with, out of: %s. Default is all of them." % ", ".join(PROFILES))
+	parser.add_argument('--repeat', metavar='N', nargs=1, type=int, help="Number of times to run each conversion. The best time of each stage is kept. Default is %d." % DEFAULT_REPEAT)
+	parser.add_argument('--maxtime', metavar='time', nargs=1, type=float, help="Only convert this many seconds of each dump, for a quicker benchmark.")
+	parser.add_argument('--output', metavar='file', nargs=1, type=str, help="Save results as a JSON file.")
+	parser.add_argument('--baseline', metavar='file', nargs=1, type=str, help="Compare results with those saved with --output before. Fails if any stage regressed.")
+	parser.add_argument('--threshold', metavar='percent', nargs=1, type=float, help="How much slower (or more memory hungry) a stage can get before it's a regression. Default is %d%%%%." % DEFAULT_THRESHOLD) # escaped twice, as argparse formats help too
+	parser.add_argument('dumps', metavar='dump', type=str, nargs="*", help="POKEY dumps (or directories of dumps) to convert. Default is all samples.")
+	args = parser.parse_args()
+	
+	repeat = args.repeat[0] if args.repeat is not None else DEFAULT_REPEAT
+	threshold = args.threshold[0] if args.threshold is not None else DEFAULT_THRESHOLD
+	dumps = pokey2midi.findDumps(args.dumps or [SAMPLES_DIR])
+	profiles = list(PROFILES)
+	if args.profiles is not None:
+		profiles = args.profiles[0].split(",")
+		for profile in profiles:
+			if profile not in PROFILES:
+				parser.error("unknown profile: %s" % profile)
+	extra = ["--maxtime", str(args.maxtime[0])] if args.maxtime is not None else []
+	
+	baseline = None
+	if args.baseline is not None:
+		with open(args.baseline[0], "rt") as fb:
+			baseline = json.load(fb)
+	
+	converterParser = pokey2midi.makeArgumentParser()
+	results = dict()
+	for dump in dumps:
+		print(os.path.basename(dump))
+		results[dump] = dict()
+		for profile in profiles:
+			stages = benchmark(converterParser, dump, PROFILES[profile] + extra, repeat)
+			results[dump][profile] = stages
+			print("    %-12s %s" % (profile, "  ".join(
+				"%s %.3fs" % (stage, stages[stage]['time']) for stage in STAGES if stage in stages
+			)))
+			sys.stdout.flush()
+	total = totals(results)
+	
+	print("Totals:")
+	print("    %-12s %-12s %10s %12s %12s" % ("Profile", "Stage", "Time (s)", "Frames/s", "Memory (KB)"))
+	for profile in profiles:
+		for stage in STAGES:
+			if stage not in total[profile]: # didn't run with this profile
+				continue
+			t = total[profile][stage]
+			print("    %-12s %-12s %10.3f %12.0f %12d" % (profile, stage, t['time'], t['fps'], t['memory'] // 1024))
+	
+	if args.output is not None:
+		with open(args.output[0], "wt") as fo:
+			json.dump({
+				'version': pokey2midi.VERSION,
+				'python': sys.version.split(" ")[0],
+				'repeat': repeat,
+				'maxtime': args.maxtime[0] if args.maxtime is not None else None,
+				'totals': total,
+				'dumps': {os.path.basename(dump): r for dump, r in results.items()}
+			}, fo, indent=4)
+	
+	if baseline is not None:
+		if sorted(baseline['dumps']) != sorted(os.path.basename(dump) for dump in dumps) or baseline['maxtime'] != (args.maxtime[0] if args.maxtime is not None else None):
+			print("WARNING: the baseline was made with other dumps or --maxtime, results may not compare")
+		regressions = compare(total, baseline['totals'], threshold)
+		if regressions:
+			print("%d regression%s (more than %g%% worse than the baseline):" % (
+				len(regressions), "s" if len(regressions) != 1 else "", threshold
+			))
+			for profile, stage, what, before, after in regressions:
+				print("    %-12s %-12s %-8s %12.3f -> %12.3f (%+.0f%%)" % (
+					profile, stage, what, before, after, (after / before - 1) * 100 if before else 100
+				))
+			sys.exit(1)
+		print("No regressions (within %g%% of the baseline)" % threshold)
+
+# EOF
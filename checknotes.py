@@ -0,0 +1,157 @@
+'''
+	POKEY2MIDI note lookup check
+
+	Description:
+		Checks that notes looked up from the note cache (POKEY.lookupNote) are the same as the
+		ones POKEY.getNote computes from the full POKEY state, for every combination of the
+		registers a note can depend on. Also checks that AUDCTL_TABLE decodes every AUDCTL value
+		as its bits say (see AUDCTL_BITS).
+		
+		Cases checked are:
+			8-bit		both modes, all 256 AUDCTL values, all four channels, every poly with
+						volume-only mode off and on, volumes 0, 1 and 15, and all 256 AUDF
+						values (25.2M cases)
+			16-bit		both modes, every AUDCTL value that joins channels 2 and 1 (or 4 and 3),
+						the joined channel with the tonal polys 5 and 6 and volumes 0 and 15,
+						and every 16-bit AUDF (134.2M cases)
+		
+		The registers of the other channels are set to unrelated values, since a note must not
+		depend on them. Mismatches are listed, and the check fails.
+		
+		A full check takes a long while. Use --mode, --audctl or --no16bit to check a part of it.
+	
+	For usage, run: python checknotes.py -h
+'''
+
+import sys
+import time
+import argparse
+
+import pokey2midi
+
+# Settings
+MODES				= {'ntsc': pokey2midi.NTSC, 'pal': pokey2midi.PAL}
+POLYS				= range(8)
+VOLCTRLS			= [0, 1]
+VOLUMES				= [0, 1, 15] # silent, and two audible volumes
+POLYS_16BIT			= [5, 6] # tonal polys, the only ones whose note depends on AUDF (7 is the same as 5)
+VOLUMES_16BIT		= [0, 15]
+OTHER_AUDF			= 0x5A # registers of the channels a note doesn't depend on
+OTHER_AUDC			= 0xA7
+MAX_MISMATCHES		= 20 # mismatches listed, the rest are only counted
+
+# Check that AUDCTL_TABLE has the flags and features of each AUDCTL value
+# Returns the number of mismatches
+def checkAUDCTL():
+	mismatches = 0
+	for audctl in range(256):
+		flags, features = pokey2midi.AUDCTL_TABLE[audctl]
+		expected = tuple(audctl >> bit & 1 for bit in range(8))
+		expectedFeatures = set(
+			feature for bit, (_, feature) in enumerate(pokey2midi.AUDCTL_BITS) if audctl >> bit & 1
+		)
+		pokey = pokey2midi.POKEY(0, pokey2midi.NTSC)
+		pokey.writeAUDCTL(audctl)
+		written = tuple(int(getattr(pokey, flag)) for flag, _ in pokey2midi.AUDCTL_BITS)
+		if flags != expected or written != expected or features != expectedFeatures:
+			print("AUDCTL $%02X: flags %s, written %s, features %s, expected %s and %s" % (
+				audctl, flags, written, sorted(features), expected, sorted(expectedFeatures)
+			))
+			mismatches += 1
+	return mismatches
+
+# Compares the looked up note of a channel with the computed one
+class NoteChecker(object):
+	def __init__(self, debugPolys):
+		self.debugPolys = debugPolys
+		self.cases = 0
+		self.mismatches = 0
+	
+	def check(self, pokey, ch):
+		self.cases += 1
+		note = pokey.getNote(ch)
+		expected = (note[0], note[2])
+		found = pokey.lookupNote(ch)
+		if found != expected:
+			self.mismatches += 1
+			if self.mismatches <= MAX_MISMATCHES:
+				print("%s, AUDCTL $%02X, channel %d, AUDC $%02X, AUDF %s: looked up %s, computed %s" % (
+					"NTSC" if pokey.mode == pokey2midi.NTSC else "PAL", pokey.audctl, ch,
+					pokey.poly[ch-1] << 5 | pokey.volctrl[ch-1] << 4 | pokey.vol[ch-1],
+					["$%02X" % audf for audf in pokey.audf], found, expected
+				))
+	
+	# A POKEY with the given AUDCTL, and the registers of all channels set to unrelated values
+	def makePOKEY(self, mode, audctl):
+		pokey = pokey2midi.POKEY(0, mode, self.debugPolys)
+		pokey.writeAUDCTL(audctl)
+		for ch in range(1, 5):
+			pokey.writeAUDF(ch, OTHER_AUDF)
+			pokey.writeAUDC(ch, OTHER_AUDC)
+		return pokey
+	
+	# Every 8-bit AUDF of every channel
+	def check8bit(self, mode, audctl):
+		for ch in range(1, 5):
+			pokey = self.makePOKEY(mode, audctl)
+			for poly in POLYS:
+				for volctrl in VOLCTRLS:
+					for vol in VOLUMES:
+						pokey.writeAUDC(ch, poly << 5 | volctrl << 4 | vol)
+						for audf in range(256):
+							pokey.writeAUDF(ch, audf)
+							self.check(pokey, ch)
+	
+	# Every 16-bit AUDF of the channels AUDCTL joins
+	def check16bit(self, mode, audctl):
+		for ch, bit in [(2, 4), (4, 3)]: # join2and1 and join4and3 bits
+			if not audctl >> bit & 1:
+				continue
+			pokey = self.makePOKEY(mode, audctl)
+			for poly in POLYS_16BIT:
+				for vol in VOLUMES_16BIT:
+					pokey.writeAUDC(ch, poly << 5 | vol)
+					for high in range(256):
+						pokey.writeAUDF(ch, high)
+						for low in range(256):
+							pokey.writeAUDF(ch-1, low)
+							self.check(pokey, ch)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Checks that notes looked up from the note cache are the same as the computed ones, for every register combination.")
+	parser.add_argument('--mode', metavar='mode', nargs=1, type=str, choices=list(MODES), help="Only check this mode, out of: %s. Default is both." % ", ".join(MODES))
+	parser.add_argument('--audctl', metavar='N', nargs=1, type=int, help="Only check this AUDCTL value (0 to 255). Default is all of them.")
+	parser.add_argument('--no16bit', action='store_true', help="Skip 16-bit AUDFs, which take most of the time.")
+	parser.add_argument('--debugpolys', action='store_true', help="Check notes as with --debugpolys in POKEY2MIDI.")
+	args = parser.parse_args()
+	
+	modes = [MODES[args.mode[0]]] if args.mode is not None else list(MODES.values())
+	audctls = range(256)
+	if args.audctl is not None:
+		if not 0 <= args.audctl[0] <= 255:
+			parser.error("AUDCTL must be between 0 and 255")
+		audctls = [args.audctl[0]]
+	
+	mismatches = checkAUDCTL()
+	print("AUDCTL table: 256 values checked, %d mismatch%s" % (mismatches, "es" if mismatches != 1 else ""))
+	
+	checker = NoteChecker(args.debugpolys)
+	start = time.perf_counter()
+	for mode in modes:
+		for audctl in audctls:
+			checker.check8bit(mode, audctl)
+			if pokey2midi.ENABLE_16BIT and not args.no16bit:
+				checker.check16bit(mode, audctl)
+		print("%s: %d cases checked so far, %d mismatch%s (%.0fs)" % (
+			"NTSC" if mode == pokey2midi.NTSC else "PAL", checker.cases, checker.mismatches,
+			"es" if checker.mismatches != 1 else "", time.perf_counter() - start
+		))
+		sys.stdout.flush()
+	mismatches += checker.mismatches
+	
+	if mismatches:
+		print("FAILED: %d mismatch%s" % (mismatches, "es" if mismatches != 1 else ""))
+		sys.exit(1)
+	print("No mismatches")
+
+# EOF
@@ -0,0 +1,215 @@
+'''
+	POKEY2MIDI load test
+	
+	Description:
+		Replays POKEY dumps against a POKEY2MIDI conversion server (see --serve in pokey2midi.py),
+		and compares its throughput with converting each dump with a separate POKEY2MIDI process,
+		as one would without a server. Both convert the same dumps, with the same options and as
+		many at a time, and their MIDI files are checked to be the same.
+		
+		Unless --address is given, a server is started on a Unix socket (or a local port, where
+		there are no Unix sockets) for the test, and stopped afterwards.
+		
+		Dumps are converted whole by default, which mostly measures the conversions themselves.
+		Use --maxtime to only convert the start of each dump, as with short dumps, where starting
+		a process takes most of the time.
+	
+	For usage, run: python loadtest.py -h
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+import concurrent.futures
+
+import pokey2midi
+
+# Settings
+SAMPLES_DIR			= os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "dump")
+SCRIPT				= os.path.join(os.path.dirname(os.path.abspath(__file__)), "pokey2midi.py")
+DEFAULT_REPEAT		= 1
+DEFAULT_CONCURRENCY	= 4
+STARTUP_TIMEOUT		= 30 # seconds to wait for a server to start
+
+# HTTP connection over a Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+	def __init__(self, path, timeout=None):
+		super().__init__("localhost", timeout=timeout)
+		self.path = path
+	
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect(self.path)
+
+# Open a connection to a server address (see pokey2midi.serverAddress)
+def connect(address, timeout=None):
+	if isinstance(address, tuple):
+		return http.client.HTTPConnection(*address, timeout=timeout)
+	return UnixHTTPConnection(address, timeout=timeout)
+
+# Send a request to a server
+# Returns the response status and body
+def request(address, method, path, body=None):
+	conn = connect(address)
+	try:
+		conn.request(method, path, body)
+		response = conn.getresponse()
+		return response.status, response.read()
+	finally:
+		conn.close()
+
+# Wait until a server answers /health
+def waitForServer(address, process=None):
+	deadline = time.time() + STARTUP_TIMEOUT
+	while time.time() < deadline:
+		if process is not None and process.poll() is not None:
+			break
+		try:
+			status, body = request(address, "GET", "/health")
+			if status == 200:
+				return json.loads(body)
+		except OSError:
+			pass
+		time.sleep(0.1)
+	print("ERROR\nThe server didn't start.")
+	sys.exit(1)
+
+# Command line options as a server query (see ConversionHandler.do_POST)
+def query(options):
+	pairs = []
+	for option in options:
+		if option.startswith("--"):
+			pairs.append([option[2:], ""])
+		else:
+			pairs[-1][1] = option
+	return urllib.parse.urlencode([tuple(pair) for pair in pairs])
+
+# Convert a dump with the server
+# Returns the time it took, and the MIDI file
+def convertWithServer(address, dump, options):
+	with open(dump, "rb") as f:
+		data = f.read()
+	start = time.perf_counter()
+	status, body = request(address, "POST", "/convert?" + query(options), data)
+	elapsed = time.perf_counter() - start
+	if status != 200:
+		raise RuntimeError("%s: %d %s" % (os.path.basename(dump), status, body.decode(errors="replace")))
+	return elapsed, body
+
+# Convert a dump with a new POKEY2MIDI process
+# Returns the time it took, and the MIDI file
+def convertWithProcess(dump, options, tmp):
+	fd, output = tempfile.mkstemp(".mid", dir=tmp)
+	os.close(fd)
+	start = time.perf_counter()
+	subprocess.run(
+		[sys.executable, SCRIPT] + options + [dump, output],
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+	)
+	elapsed = time.perf_counter() - start
+	with open(output, "rb") as f:
+		data = f.read()
+	os.remove(output)
+	return elapsed, data
+
+# Run conversions a few at a time
+# Returns the total time, the time of each conversion, and the MIDI files of each dump
+def run(convert, dumps, concurrency):
+	start = time.perf_counter()
+	times = []
+	midis = dict()
+	with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+		for dump, (elapsed, midi) in zip(dumps, pool.map(convert, dumps)):
+			times.append(elapsed)
+			midis[dump] = midi
+	return time.perf_counter() - start, times, midis
+
+# Print throughput and latencies of a run
+def report(name, total, times):
+	times = sorted(times)
+	print("    %-10s %8d %10.2f %10.2f %10.3f %10.3f %10.3f" % (
+		name, len(times), total, len(times) / total, sum(times) / len(times),
+		times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.95))]
+	))
+
+# If running by itself, handle command line options
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Replays POKEY dumps against a POKEY2MIDI conversion server, and compares it with converting them with separate processes.")
+	parser.add_argument('--address', metavar='address', nargs=1, type=str, help="Address of a running server (see --serve in pokey2midi.py). If not given, a server is started for the test.")
+	parser.add_argument('--jobs', metavar='N', nargs=1, type=int, help="Number of workers of the server started for the test. Default is the number of CPUs.")
+	parser.add_argument('--concurrency', metavar='N', nargs=1, type=int, help="Number of conversions to run at the same time. Default is %d." % DEFAULT_CONCURRENCY)
+	parser.add_argument('--repeat', metavar='N', nargs=1, type=int, help="Number of times to convert each dump. Default is %d." % DEFAULT_REPEAT)
+	parser.add_argument('--maxtime', metavar='time', nargs=1, type=float, help="Only convert this many seconds of each dump, as with short dumps.")
+	parser.add_argument('--options', metavar='"options"', nargs=1, type=str, help="Other POKEY2MIDI options to convert with, such as \"--usevol --useinst\".")
+	parser.add_argument('--noprocess', action='store_true', help="Only test the server, without converting with separate processes.")
+	parser.add_argument('dumps', metavar='dump', type=str, nargs="*", help="POKEY dumps (or directories of dumps) to convert. Default is all samples.")
+	args = parser.parse_args()
+	
+	options = args.options[0].split() if args.options is not None else []
+	if args.maxtime is not None:
+		options += ["--maxtime", str(args.maxtime[0])]
+	concurrency = args.concurrency[0] if args.concurrency is not None else DEFAULT_CONCURRENCY
+	repeat = args.repeat[0] if args.repeat is not None else DEFAULT_REPEAT
+	dumps = pokey2midi.findDumps(args.dumps or [SAMPLES_DIR]) * repeat
+	
+	with tempfile.TemporaryDirectory() as tmp:
+		server = None
+		if args.address is not None:
+			address = pokey2midi.serverAddress(args.address[0])
+		else:
+			if hasattr(socket, "AF_UNIX"):
+				address = os.path.join(tmp, "pokey2midi.sock")
+			else:
+				with socket.socket() as s: # find a free port
+					s.bind(("127.0.0.1", 0))
+					address = s.getsockname()
+			where = address if isinstance(address, str) else "%s:%d" % address
+			jobs = ["--jobs", str(args.jobs[0])] if args.jobs is not None else []
+			server = subprocess.Popen(
+				[sys.executable, SCRIPT, "--serve", where] + jobs,
+				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+			)
+		
+		try:
+			health = waitForServer(address, server)
+			print("Server: POKEY2MIDI v%s with %d worker%s" % (
+				health['version'], health['workers'], "s" if health['workers'] != 1 else ""
+			))
+			print("Converting %d dump%s, %d at a time, with options: %s" % (
+				len(dumps), "s" if len(dumps) != 1 else "", concurrency, " ".join(options) or "none"
+			))
+			print("    %-10s %8s %10s %10s %10s %10s %10s" % (
+				"", "Dumps", "Time (s)", "Dumps/s", "Mean (s)", "p50 (s)", "p95 (s)"
+			))
+			
+			total, times, served = run(
+				lambda dump: convertWithServer(address, dump, options), dumps, concurrency
+			)
+			report("server", total, times)
+			sys.stdout.flush()
+			
+			if not args.noprocess:
+				processTotal, processTimes, converted = run(
+					lambda dump: convertWithProcess(dump, options, tmp), dumps, concurrency
+				)
+				report("processes", processTotal, processTimes)
+				print("The server was %.2f times as fast" % (processTotal / total))
+				different = [dump for dump in converted if converted[dump] != served[dump]]
+				for dump in different:
+					print("Different MIDI files for \"%s\"" % dump)
+				if different:
+					sys.exit(1)
+		finally:
+			if server is not None:
+				server.terminate()
+				server.wait()
+
+# EOF
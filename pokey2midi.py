@@ -5,6 +5,7 @@
 	Description:
 		This program converts POKEY data dumps from asapscan into MIDI files
 		asapscan is part of the ASAP (Another Slight Atari Player) software package
+		SAP files of type B and C can also be converted directly, with a built-in player
 	
 	ASAP site: http://asap.sourceforge.net
 	For usage, run: python pokey2midi -h
@@ -33,13 +34,58 @@
 			Helps with cleanup
 '''
 
+import io
 import os
 import re
+import sys
 import bz2
+import gzip
+import lzma
+import zlib
+import array
+import bisect
+import json
 import math
+import mmap
+import time
 import struct
 import argparse
-import mimetypes
+import collections
+import hashlib
+import functools
+import itertools
+import contextlib
+import copy
+import queue
+import signal
+import socketserver
+import threading
+import http.server
+import urllib.parse
+import tracemalloc
+import cProfile
+import multiprocessing
+
+# NumPy is optional, and only used to speed things up
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# resource is only available on Unix, and only used to report peak memory with --profile
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# zstd is optional as well, for zstd-compressed dumps
+try:
+	from compression import zstd # Python 3.14+
+except ImportError:
+	try:
+		import zstandard as zstd
+	except ImportError:
+		zstd = None
 
 # Constants
 VERSION				= "0.85"
@@ -50,13 +96,16 @@ DT_NTSC				= 262 * 114 / 1789772.5 # time between NTSC frames
 DT_PAL				= 312 * 114 / 1773447.0 # time between PAL frames
 FPS_NTSC			= 59.94
 FPS_PAL				= 50
+NO_NOTE				= -32768 # note of a channel that isn't playing one, in note columns (see FrameColumns)
 
 # Settings
 DEFAULT_TIMEBASE 	= 480
 DEFAULT_TEMPO 		= 60
-BPM_COUNT_THRESHOLD	= 20 # Minimum number of intervals to run tempo detector
-BPM_NOTE_THRESHOLD	= 60 # 60 = Middle C
 FPB_LIMITS			= [10,100] # frames per beat (300 to 30 bpm)
+TEMPO_BEATS			= 4 # beats the onsets of a tempo are compared over (see Converter.guessTempos)
+TEMPO_PRIOR			= 120 # most likely tempo in bpm, and how far others are likely to be from it,
+TEMPO_PRIOR_WIDTH	= 1 # in octaves, so twice or half as fast is only taken when it fits much better
+TEMPO_CANDIDATES	= 8 # tempos to suggest
 
 # Debug contants
 ENABLE_16BIT		= True # Enable 16bit?
@@ -70,10 +119,122 @@ DEBUG_POLYS			= False # Also write non-tonal polys (0-4) notes as given by AUDF
 # Use negative values for percussion map? (MIDI channel 9)
 POLY_INSTRUMENT		= [0,0,0,0,0,80,81,80]
 
+# AUDCTL bits, from lowest to highest, with the POKEY flag and feature name of each
+AUDCTL_BITS			= [
+	('use15khz',	"15khz"),		# Use 15 kHz clock for all channels, instead of 64 kHz
+	('highpass2w4',	"highpass2w4"),	# Highpass channel 2 with 4
+	('highpass1w3',	"highpass1w3"),	# Highpass channel 1 with 3
+	('join4and3',	"join4and3"),	# Clock channel 4 with 3 (instead of 64 kHz) (16-bit)
+	('join2and1',	"join2and1"),	# Clock channel 2 with 1 (instead of 64 kHz) (16-bit)
+	('clock3mhz',	"clock3mhz"),	# Clock channel 3 with 1.79 MHz, instead of 64 kHz
+	('clock1mhz',	"clock1mhz"),	# Clock channel 1 with 1.79 MHz, instead of 64 kHz
+	('poly17as9',	"poly17as9")	# 9-bit poly instead of 17-bit poly
+]
+
+# Every possible AUDCTL value, decoded once: (flags, features used)
+AUDCTL_TABLE		= [
+	(
+		tuple(data >> bit & 1 for bit in range(8)),
+		frozenset(feature for bit, (_, feature) in enumerate(AUDCTL_BITS) if data >> bit & 1)
+	)
+	for data in range(256)
+]
+
+# Compiled song cache
+CACHE_DIR			= os.path.join(os.path.expanduser("~"), ".cache", "pokey2midi")
+CACHE_SIZE			= 256 # maximum size in MB
+TIMELINE_HEADER		= "<4sHBBiiiiII" # magic, version, mode, POKEYs, earliest sound, loop start, loop length, stop, frames, AUDCTLs
+TIMELINE_VERSION	= 4 # Change whenever parsing or compiling changes, so old cached songs aren't used
+
+# Input formats, and the first bytes they start with (see Converter.sniffFormat)
+# Anything else is assumed to be a plain text dump
+INPUT_MAGIC			= [
+	("pkd",		b"PKD\x1a"),
+	("bzip2",	b"BZh"),
+	("gzip",	b"\x1f\x8b"),
+	("xz",		b"\xfd7zXZ\x00"),
+	("zstd",	b"\x28\xb5\x2f\xfd"),
+	("sap",		b"SAP\r\n"),
+	("sap",		b"SAP\n")
+]
+READ_BUFFER			= 1 << 20 # size of the chunks dumps are read in, in bytes
+# Errors raised by decompressors for damaged data (see CompressedInput)
+DECOMPRESS_ERRORS	= (EOFError, OSError, zlib.error, lzma.LZMAError) + \
+	((zstd.ZstdError,) if zstd is not None and hasattr(zstd, "ZstdError") else ())
+MODE_GAP			= 0.05 # seconds apart NTSC and PAL timestamps must be to tell them apart (see Converter.detectMode)
+DUMP_EXTENSIONS		= (".txt", ".txt.bz2", ".txt.gz", ".txt.xz", ".txt.zst", ".pkd", ".sap") # for --batch and --pack
+
+# Packed dumps (.pkd), see Converter.packDump
+PKD_MAGIC			= b"PKD\x1a"
+PKD_HEADER			= "<4sHBBI" # magic, version, mode, POKEYs, frames
+PKD_FRAME			= "<I" # frame number, followed by 9 register bytes per POKEY
+PKD_VERSION			= 1
+
+# SAP files, played by SAPPlayer (see Converter.openSAP)
+SAP_TIME			= 15 * 60 # seconds to play without --maxtime, as much as asapscan dumps
+SAP_INIT_TIME		= 5 # maximum time for the INIT routine, in seconds
+SAP_RETURN			= 0xD20A # routines return here, where a jam opcode stops the CPU (like ASAP)
+SCANLINE_CYCLES		= 114 # CPU cycles per scanline
+SCANLINES_NTSC		= 262 # scanlines per frame
+SCANLINES_PAL		= 312
+
+# Finding where songs end, with --autostop (see Converter.autoStop)
+AUTOSTOP_LOOPS		= 1 # loops to keep after the intro, by default
+AUTOSTOP_SILENCE	= 5 # seconds of silence that end a song, by default
+AUTOSTOP_MIN_LOOP	= 8 # shortest loop, in seconds, so a few repeated bars aren't taken for the whole song
+AUTOSTOP_MAX_LOOP	= 600 # longest loop, in seconds, so windows of frames older than this are forgotten
+AUTOSTOP_REPEATS	= 2 # times a loop must repeat, since songs often play a part twice before moving on
+AUTOSTOP_CONFIRM	= 200 # seconds the song must follow a loop for, so a short part played a few times isn't a loop
+AUTOSTOP_WINDOW		= 16 # frames hashed together, to find where the song repeats itself
+AUTOSTOP_HASH_BASE	= 1000003 # base and modulus of the rolling hash
+AUTOSTOP_HASH_MOD	= (1 << 61) - 1
+
+# Dumps read as they're written, from stdin or with --follow (see LiveInput)
+FOLLOW_TIMEOUT		= 10 # seconds a followed dump can go without growing before it's taken as finished
+FOLLOW_POLL			= 0.1 # seconds between checks for more of a followed dump
+
+# Conversion server (see serve)
+SERVE_TIMEOUT		= 60 # maximum time for a conversion, in seconds
+SERVE_MAX_PENDING	= 32 # maximum number of requests waiting for a worker
+SERVE_MAX_UPLOAD	= 1 << 28 # maximum size of a dump, in bytes
+# Options a request can give, with the type of their value (None for flags, which take none)
+# Options that read or write files, or change how POKEY2MIDI runs, aren't allowed
+SERVE_OPTIONS		= {
+	'all': None, 'notrim': None, 'nosplit': None, 'nomerge': None, 'usevol': None,
+	'pitchonly': None, 'useinst': None, 'shortnames': None, 'autostop': None, 'findbpm': None,
+	'tempoonly': None, 'shortnotes': int, 'setinst': str, 'boost': float, 'maxtime': float,
+	'subsong': int, 'loops': int, 'silence': float, 'bpm': float, 'timebase': int
+}
+
+# Maximum number of notes to remember in the note lookup cache (see lookupNote)
+NOTE_CACHE_SIZE		= 1 << 16
+# Number of frames compiled at once, and handed out together as columns (see FrameColumns)
+COMPILE_CHUNK		= 4096
+
+# Number of frames the frame to MIDI tick table grows by (see MIDI.frameToTicks)
+FRAME_TICKS_CHUNK	= 1 << 12
+
+# Variable length numbers of up to 2 bytes (below 2^14), precomputed for MIDI delta times
+VLQ_TABLE			= [bytes([n]) if n < 128 else bytes([n >> 7 | 0x80, n & 0x7F]) for n in range(1 << 14)]
+
+# Conversion stages timed with --profile, in the order they're reported (see ConversionStats)
+PROFILE_STAGES		= ["read", "parse", "play", "autostop", "load", "compile", "record", "assemble", "cache", "save", "detectTempo", "stats"]
+
+# Names of MIDI channel events, by the upper 4 bits of their status byte (see MIDI.countEvents)
+MIDI_EVENT_TYPES	= {
+	0x8: "note off", 0x9: "note on", 0xA: "aftertouch", 0xB: "control change",
+	0xC: "program change", 0xD: "channel pressure", 0xE: "pitch bend"
+}
+
+# Calls of the POKEY methods that compute notes, reported with --profile (see ConversionStats)
+# Notes are mostly looked up (see lookupNote), so these are only counted when a note is computed
+POKEY_CALLS			= collections.Counter()
+
 # Human-readable POKEY state and other goodies
 class POKEY(object):
-	def __init__(self, number, mode):
+	def __init__(self, number, mode, debugPolys=DEBUG_POLYS):
 		self.mode = mode
+		self.debugPolys = debugPolys # see DEBUG_POLYS
 		# Per-channel data
 		self.audf			= [0,0,0,0] # channel frequency data
 		self.vol			= [0,0,0,0] # channel volumes
@@ -88,6 +249,10 @@ class POKEY(object):
 		self.clock3mhz		= False
 		self.clock1mhz		= False
 		self.poly17as9		= False
+		self.audctl			= 0 # raw AUDCTL value
+		
+		self.regs			= None # last data written with update, None if unknown
+		self.notes			= [None,None,None,None] # channel notes, as of the last update
 		
 		self._state		= dict() # internal state
 		self.number		= number # POKEY number
@@ -116,6 +281,33 @@ class POKEY(object):
 		self.writeAUDF(4, data[6])
 		self.writeAUDC(4, data[7])
 		self.writeAUDCTL(data[8])
+		self.regs = None # notes are out of date
+	
+	# Write data to POKEY chip, and update the notes of the channels it changed
+	# A note only depends on its channel's registers and AUDCTL (see lookupNote), so notes of
+	# channels whose registers didn't change are kept as they were. Returns the channels (0 to 3)
+	# whose notes were updated.
+	def update(self, data):
+		last = self.regs
+		if last is None or data[8] != last[8]: # AUDCTL affects all channels
+			self.writeAUDCTL(data[8])
+			changed = [True, True, True, True]
+		elif data == last:
+			return ()
+		else:
+			changed = [data[i] != last[i] or data[i+1] != last[i+1] for i in range(0, 8, 2)]
+		# In 16-bit mode, channels 2 and 4 also depend on AUDF of channels 1 and 3
+		if ENABLE_16BIT:
+			changed[1] = changed[1] or changed[0] and self.join2and1
+			changed[3] = changed[3] or changed[2] and self.join4and3
+		
+		updated = tuple(ch for ch in range(4) if changed[ch])
+		for ch in updated:
+			self.writeAUDF(ch+1, data[2*ch])
+			self.writeAUDC(ch+1, data[2*ch+1])
+			self.notes[ch] = self.lookupNote(ch+1)[0]
+		self.regs = data
+		return updated
 	
 	def writeAUDC(self, ch, data):
 		assert ch > 0
@@ -138,35 +330,16 @@ class POKEY(object):
 		self.audf[ch-1] = data
 	
 	def writeAUDCTL(self, data):
-		self.use15khz		= data >> 0 & 1 # Use 15 kHz clock for all channels, instead of 64 kHz
-		self.highpass2w4	= data >> 1 & 1 # Highpass channel 2 with 4
-		self.highpass1w3	= data >> 2 & 1 # Highpass channel 1 with 3
-		self.join4and3		= data >> 3 & 1 # Clock channel 4 with 3 (instead of 64 kHz) (16-bit)
-		self.join2and1		= data >> 4 & 1 # Clock channel 2 with 1 (instead of 64 kHz) (16-bit)
-		self.clock3mhz		= data >> 5 & 1 # Clock channel 3 with 1.79 MHz, instead of 64 kHz
-		self.clock1mhz		= data >> 6 & 1 # Clock channel 1 with 1.79 MHz, instead of 64 kHz
-		self.poly17as9		= data >> 7 & 1 # 9-bit poly instead of 17-bit poly
-		
+		# Flags are decoded from a table, see AUDCTL_BITS for their meaning
+		self.audctl = data
+		(
+			self.use15khz, self.highpass2w4, self.highpass1w3, self.join4and3,
+			self.join2and1, self.clock3mhz, self.clock1mhz, self.poly17as9
+		) = AUDCTL_TABLE[data][0]
+	
 	@property
 	def AUDCTLFeatures(self):
-		audctl_features = set()
-		if self.use15khz:
-			audctl_features.add("15khz")
-		if self.highpass2w4:
-			audctl_features.add("highpass2w4")
-		if self.highpass1w3:
-			audctl_features.add("highpass1w3")
-		if self.join4and3:
-			audctl_features.add("join4and3")
-		if self.join2and1:
-			audctl_features.add("join2and1")
-		if self.clock3mhz:
-			audctl_features.add("clock3mhz")
-		if self.clock1mhz:
-			audctl_features.add("clock1mhz")
-		if self.poly17as9:
-			audctl_features.add("poly17as9")
-		return audctl_features
+		return AUDCTL_TABLE[self.audctl][1]
 	
 	@property
 	def clock(self): # current global clock, set by AUDCTL
@@ -195,13 +368,14 @@ class POKEY(object):
 	# we need to consider their timbre periods to get the proper frequency.
 	def getFrequency(self, ch):
 		assert ch > 0
+		POKEY_CALLS['getFrequency'] += 1
 		
 		if self.volctrl[ch-1]: # DC mode means no note available, has to be transcribed by hand!
 			return 0
 		
 		# Debug currently unhandled poly settings
 		# Emulate frequencies so that the MIDI note number is the AUDF value for the channel
-		if DEBUG_POLYS and self.poly[ch-1] not in [5,6,7]:
+		if self.debugPolys and self.poly[ch-1] not in [5,6,7]:
 			return 27.5 * math.pow(2,(self.audf[ch-1] - 21)/12)
 		
 		# TODO: For now only, we'll only handle possibly tonal sounds.
@@ -309,6 +483,7 @@ class POKEY(object):
 	# Here, we defined n=0 -> A0, as in the piano. This is MIDI note 21
 	def getNote(self, ch):
 		assert ch > 0
+		POKEY_CALLS['getNote'] += 1
 		freq = self.getFrequency(ch)
 		assert freq >= 0
 		
@@ -357,14 +532,30 @@ class POKEY(object):
 		notename = NOTES[note % 12] + "%d" % ((note + 9) // 12) # human-readable name
 		return (note, notename, freq) # (piano key, note name, frequency)
 	
+	# Same as getNote, but looked up from a cache of previously computed notes
+	# Only returns the piano key and frequency
+	def lookupNote(self, ch):
+		assert ch > 0
+		if DEBUG: # Debug info is only available when notes are computed
+			note = self.getNote(ch)
+			return (note[0], note[2])
+		audf = self.audf[ch-1]
+		# The 16-bit channels also depend on their partner's AUDF
+		if ENABLE_16BIT and (ch == 2 and self.join2and1 or ch == 4 and self.join4and3):
+			audf = audf * 256 + self.audf[ch-2]
+		return lookupNote(
+			self.mode, ch, self.audctl, self.poly[ch-1], self.volctrl[ch-1],
+			self.vol[ch-1] > 0, audf, self.debugPolys
+		)
+	
 	# Get current POKEY state in a human-readable form
 	@property
 	def state(self):
 		# Update current state
 		self._state['audf']		= list(self.audf)
 		self._state['note']		= list([
-										self.getNote(1)[0], self.getNote(2)[0],
-										self.getNote(3)[0], self.getNote(4)[0]
+										self.lookupNote(1)[0], self.lookupNote(2)[0],
+										self.lookupNote(3)[0], self.lookupNote(4)[0]
 									])
 		self._state['vol']			= list(self.vol)
 		self._state['volctrl']		= list(self.volctrl)
@@ -381,16 +572,590 @@ class POKEY(object):
 		return self._state
 
 
+# Note lookup cache
+# The note of a channel only depends on these values, so we only compute notes for combinations
+# that weren't seen before. The computed note is exactly the one POKEY.getNote gives.
+@functools.lru_cache(maxsize=NOTE_CACHE_SIZE)
+def lookupNote(mode, ch, audctl, poly, volctrl, loud, audf, debug_polys):
+	pokey = POKEY(0, mode, debug_polys)
+	pokey.writeAUDCTL(audctl)
+	pokey.poly[ch-1] = poly
+	pokey.volctrl[ch-1] = volctrl
+	pokey.vol[ch-1] = 1 if loud else 0
+	if ENABLE_16BIT and (ch == 2 and pokey.join2and1 or ch == 4 and pokey.join4and3):
+		pokey.audf[ch-2] = audf & 0xFF # 16-bit AUDF, split into the channel pair
+		audf >>= 8
+	pokey.audf[ch-1] = audf
+	note = pokey.getNote(ch)
+	return (note[0], note[2])
+
+
+# MOS 6502 opcodes, in order: mnemonic, addressing mode and cycles
+# Unofficial opcodes are included, since some players use them. KIL jams the CPU.
+MOS6502_OPCODES		= [tuple(op.split()) for op in re.findall(r"\w+ \w+ +\d", """
+	BRK imp 7  ORA izx 6  KIL imp 2  SLO izx 8  NOP zp  3  ORA zp  3  ASL zp  5  SLO zp  5
+	PHP imp 3  ORA imm 2  ASL acc 2  ANC imm 2  NOP abs 4  ORA abs 4  ASL abs 6  SLO abs 6
+	BPL rel 2  ORA izy 5  KIL imp 2  SLO izy 8  NOP zpx 4  ORA zpx 4  ASL zpx 6  SLO zpx 6
+	CLC imp 2  ORA aby 4  NOP imp 2  SLO aby 7  NOP abx 4  ORA abx 4  ASL abx 7  SLO abx 7
+	JSR abs 6  AND izx 6  KIL imp 2  RLA izx 8  BIT zp  3  AND zp  3  ROL zp  5  RLA zp  5
+	PLP imp 4  AND imm 2  ROL acc 2  ANC imm 2  BIT abs 4  AND abs 4  ROL abs 6  RLA abs 6
+	BMI rel 2  AND izy 5  KIL imp 2  RLA izy 8  NOP zpx 4  AND zpx 4  ROL zpx 6  RLA zpx 6
+	SEC imp 2  AND aby 4  NOP imp 2  RLA aby 7  NOP abx 4  AND abx 4  ROL abx 7  RLA abx 7
+	RTI imp 6  EOR izx 6  KIL imp 2  SRE izx 8  NOP zp  3  EOR zp  3  LSR zp  5  SRE zp  5
+	PHA imp 3  EOR imm 2  LSR acc 2  ALR imm 2  JMP abs 3  EOR abs 4  LSR abs 6  SRE abs 6
+	BVC rel 2  EOR izy 5  KIL imp 2  SRE izy 8  NOP zpx 4  EOR zpx 4  LSR zpx 6  SRE zpx 6
+	CLI imp 2  EOR aby 4  NOP imp 2  SRE aby 7  NOP abx 4  EOR abx 4  LSR abx 7  SRE abx 7
+	RTS imp 6  ADC izx 6  KIL imp 2  RRA izx 8  NOP zp  3  ADC zp  3  ROR zp  5  RRA zp  5
+	PLA imp 4  ADC imm 2  ROR acc 2  ARR imm 2  JMP ind 5  ADC abs 4  ROR abs 6  RRA abs 6
+	BVS rel 2  ADC izy 5  KIL imp 2  RRA izy 8  NOP zpx 4  ADC zpx 4  ROR zpx 6  RRA zpx 6
+	SEI imp 2  ADC aby 4  NOP imp 2  RRA aby 7  NOP abx 4  ADC abx 4  ROR abx 7  RRA abx 7
+	NOP imm 2  STA izx 6  NOP imm 2  SAX izx 6  STY zp  3  STA zp  3  STX zp  3  SAX zp  3
+	DEY imp 2  NOP imm 2  TXA imp 2  ANE imm 2  STY abs 4  STA abs 4  STX abs 4  SAX abs 4
+	BCC rel 2  STA izy 6  KIL imp 2  SHA izy 6  STY zpx 4  STA zpx 4  STX zpy 4  SAX zpy 4
+	TYA imp 2  STA aby 5  TXS imp 2  TAS aby 5  SHY abx 5  STA abx 5  SHX aby 5  SHA aby 5
+	LDY imm 2  LDA izx 6  LDX imm 2  LAX izx 6  LDY zp  3  LDA zp  3  LDX zp  3  LAX zp  3
+	TAY imp 2  LDA imm 2  TAX imp 2  LXA imm 2  LDY abs 4  LDA abs 4  LDX abs 4  LAX abs 4
+	BCS rel 2  LDA izy 5  KIL imp 2  LAX izy 5  LDY zpx 4  LDA zpx 4  LDX zpy 4  LAX zpy 4
+	CLV imp 2  LDA aby 4  TSX imp 2  LAS aby 4  LDY abx 4  LDA abx 4  LDX aby 4  LAX aby 4
+	CPY imm 2  CMP izx 6  NOP imm 2  DCP izx 8  CPY zp  3  CMP zp  3  DEC zp  5  DCP zp  5
+	INY imp 2  CMP imm 2  DEX imp 2  SBX imm 2  CPY abs 4  CMP abs 4  DEC abs 6  DCP abs 6
+	BNE rel 2  CMP izy 5  KIL imp 2  DCP izy 8  NOP zpx 4  CMP zpx 4  DEC zpx 6  DCP zpx 6
+	CLD imp 2  CMP aby 4  NOP imp 2  DCP aby 7  NOP abx 4  CMP abx 4  DEC abx 7  DCP abx 7
+	CPX imm 2  SBC izx 6  NOP imm 2  ISB izx 8  CPX zp  3  SBC zp  3  INC zp  5  ISB zp  5
+	INX imp 2  SBC imm 2  NOP imp 2  SBC imm 2  CPX abs 4  SBC abs 4  INC abs 6  ISB abs 6
+	BEQ rel 2  SBC izy 5  KIL imp 2  ISB izy 8  NOP zpx 4  SBC zpx 4  INC zpx 6  ISB zpx 6
+	SED imp 2  SBC aby 4  NOP imp 2  ISB aby 7  NOP abx 4  SBC abx 4  INC abx 7  ISB abx 7
+""")]
+
+# Number of operand bytes of each addressing mode
+MOS6502_OPERANDS	= {
+	'imp': 0, 'acc': 0, 'imm': 1, 'rel': 1, 'zp': 1, 'zpx': 1, 'zpy': 1, 'izx': 1, 'izy': 1,
+	'abs': 2, 'abx': 2, 'aby': 2, 'ind': 2
+}
+
+# What each instruction does, as Python code for the translator (see MOS6502.translate)
+# Registers and flags are local variables: a, x, y, s, c (carry), ov (overflow), dm (decimal
+# mode), im (interrupts disabled), and fn and fz, the values N and Z were last set from. Operands
+# are read into t, and read-modify-write instructions leave the value to write back in t.
+MOS6502_READ		= {
+	'LDA': "a = fn = fz = t",
+	'LDX': "x = fn = fz = t",
+	'LDY': "y = fn = fz = t",
+	'LAX': "a = x = fn = fz = t",
+	'AND': "a = fn = fz = a & t",
+	'ORA': "a = fn = fz = a | t",
+	'EOR': "a = fn = fz = a ^ t",
+	'ADC': "if dm:\n\ta, c, ov, fn, fz = cpu.decimalADC(a, t, c)\nelse:\n\tu = a + t + c\n\tov = (a ^ u) & (t ^ u) & 0x80\n\tc = u >> 8\n\ta = fn = fz = u & 0xFF",
+	'SBC': "if dm:\n\ta, c, ov, fn, fz = cpu.decimalSBC(a, t, c)\nelse:\n\tt ^= 0xFF\n\tu = a + t + c\n\tov = (a ^ u) & (t ^ u) & 0x80\n\tc = u >> 8\n\ta = fn = fz = u & 0xFF",
+	'CMP': "u = a + 0x100 - t\nc = u >> 8\nfn = fz = u & 0xFF",
+	'CPX': "u = x + 0x100 - t\nc = u >> 8\nfn = fz = u & 0xFF",
+	'CPY': "u = y + 0x100 - t\nc = u >> 8\nfn = fz = u & 0xFF",
+	'BIT': "fz = a & t\nfn = t\nov = t & 0x40",
+	'NOP': "",
+	'ANC': "a = fn = fz = a & t\nc = a >> 7",
+	'ALR': "t &= a\nc = t & 1\na = fn = fz = t >> 1",
+	'ARR': "t &= a\na = fn = fz = t >> 1 | c << 7\nc = a >> 6 & 1\nov = (a ^ a << 1) & 0x40",
+	'SBX': "u = (a & x) + 0x100 - t\nc = u >> 8\nx = fn = fz = u & 0xFF",
+	'ANE': "a = fn = fz = (a | 0xEE) & x & t",
+	'LXA': "a = x = fn = fz = (a | 0xEE) & t",
+	'LAS': "a = x = s = fn = fz = s & t"
+}
+MOS6502_MODIFY		= {
+	'ASL': "c = t >> 7\nt = fn = fz = t << 1 & 0xFF",
+	'LSR': "c = t & 1\nt = fn = fz = t >> 1",
+	'ROL': "t = t << 1 | c\nc = t >> 8\nt = fn = fz = t & 0xFF",
+	'ROR': "t |= c << 8\nc = t & 1\nt = fn = fz = t >> 1",
+	'INC': "t = fn = fz = t + 1 & 0xFF",
+	'DEC': "t = fn = fz = t - 1 & 0xFF"
+}
+# Unofficial read-modify-write instructions, which do both
+MOS6502_COMBINED	= {
+	'SLO': ('ASL', 'ORA'), 'RLA': ('ROL', 'AND'), 'SRE': ('LSR', 'EOR'),
+	'RRA': ('ROR', 'ADC'), 'DCP': ('DEC', 'CMP'), 'ISB': ('INC', 'SBC')
+}
+# Value stored by each store instruction (ad is the address)
+MOS6502_STORE		= {
+	'STA': "a", 'STX': "x", 'STY': "y", 'SAX': "a & x",
+	'SHA': "a & x & (ad >> 8) + 1", 'SHX': "x & (ad >> 8) + 1", 'SHY': "y & (ad >> 8) + 1",
+	'TAS': "s & (ad >> 8) + 1"
+}
+MOS6502_IMPLIED		= {
+	'TAX': "x = fn = fz = a", 'TAY': "y = fn = fz = a", 'TXA': "a = fn = fz = x",
+	'TYA': "a = fn = fz = y", 'TSX': "x = fn = fz = s", 'TXS': "s = x",
+	'INX': "x = fn = fz = x + 1 & 0xFF", 'INY': "y = fn = fz = y + 1 & 0xFF",
+	'DEX': "x = fn = fz = x - 1 & 0xFF", 'DEY': "y = fn = fz = y - 1 & 0xFF",
+	'CLC': "c = 0", 'SEC': "c = 1", 'CLI': "im = 0", 'SEI': "im = 1", 'CLV': "ov = 0",
+	'CLD': "dm = 0", 'SED': "dm = 1", 'NOP': "",
+	'PHA': "m[0x100 | s] = a\ns = s - 1 & 0xFF",
+	'PHP': "m[0x100 | s] = cpu.flags(fn, ov, dm, im, fz, c) | 0x10\ns = s - 1 & 0xFF",
+	'PLA': "s = s + 1 & 0xFF\na = fn = fz = m[0x100 | s]",
+	'PLP': "s = s + 1 & 0xFF\nfn, ov, dm, im, fz, c = cpu.unpackFlags(m[0x100 | s])"
+}
+# Branches, and the condition they're taken on
+MOS6502_BRANCH		= {
+	'BPL': "not fn & 0x80", 'BMI': "fn & 0x80", 'BVC': "not ov", 'BVS': "ov",
+	'BCC': "not c", 'BCS': "c", 'BNE': "fz", 'BEQ': "not fz"
+}
+MOS6502_REGISTERS	= ["a", "x", "y", "s", "c", "ov", "dm", "im", "fn", "fz"]
+MOS6502_NAMES		= re.compile(r"\b(%s)\b" % "|".join(MOS6502_REGISTERS))
+# Registers assigned to, alone or in a tuple
+MOS6502_ASSIGNED	= re.compile(r"\b(%s)\b(?=\s*(?:,[\w, ]*)?[-+&|^]?=(?!=))" % "|".join(MOS6502_REGISTERS))
+MOS6502_BLOCK_SIZE	= 64 # maximum instructions in a translated block
+
+# MOS 6502 CPU, as found in Atari 8-bit computers, with just enough of the hardware around it
+# to play SAP files (see SAPPlayer)
+# Code isn't interpreted one instruction at a time. Instead, each block of code (up to the next
+# jump or branch) is translated into a Python function the first time it runs, and the function is
+# called from then on. Players run the same code every frame, so translating is well worth it.
+# Self-modifying code, which players use a lot, is handled by translating blocks again when their
+# code is written to: operands that get written to are read from memory from then on, instead of
+# being translated as constants.
+class MOS6502(object):
+	def __init__(self):
+		self.memory = bytearray(0x10000)
+		self.a = self.x = self.y = 0
+		self.s = 0xFF
+		self.c = self.ov = self.dm = self.fn = 0
+		self.im = 1
+		self.fz = 1
+		self.pc = SAP_RETURN
+		self.cycle = 0 # current cycle
+		
+		self.blocks = dict() # translated blocks, by address
+		self.code = bytearray(0x10000) # whether each address is part of a translated block
+		self.owners = dict() # blocks translated from each address
+		self.extents = dict() # addresses each block was translated from
+		self.volatile = set() # code addresses that were written to (see translate)
+		self.limit = 0 # cycle to run until (see run)
+		self.functions = dict() # functions for each translated source code, to reuse them
+	
+	# Memory-mapped hardware, from $D000 to $D7FF
+	# Reads and writes of any other address go straight to memory
+	def read(self, address, cycle):
+		return self.memory[address]
+	
+	def write(self, address, data, cycle):
+		self.memory[address] = data
+	
+	# The status register, from the flags
+	def flags(self, fn, ov, dm, im, fz, c):
+		return fn & 0x80 | (0x40 if ov else 0) | 0x20 | dm << 3 | im << 2 | (0 if fz else 2) | c
+	
+	def unpackFlags(self, p):
+		return p, p & 0x40, p >> 3 & 1, p >> 2 & 1, ~p & 2, p & 1
+	
+	# ADC and SBC in decimal mode, as the NMOS 6502 does them
+	# Return the new A, C, V, and the values N and Z are set from
+	def decimalADC(self, a, t, c):
+		u = (a & 0x0F) + (t & 0x0F) + c
+		if u >= 10:
+			u = (u - 10) | 0x10
+		u += (a & 0xF0) + (t & 0xF0)
+		fn = u # N and V come from the result before it's adjusted
+		ov = (u ^ a) & ~(t ^ a) & 0x80
+		if u >= 0xA0:
+			u += 0x60
+		return u & 0xFF, u >> 8 and 1, ov, fn, (a + t + c) & 0xFF
+	
+	def decimalSBC(self, a, t, c):
+		u = a - t - 1 + c
+		ov = (a ^ u) & (a ^ t) & 0x80
+		low = (a & 0x0F) - (t & 0x0F) - 1 + c
+		high = (a >> 4) - (t >> 4)
+		if low & 0x10:
+			low -= 6
+			high -= 1
+		if high & 0x10:
+			high -= 6
+		return (high << 4 | low & 0x0F) & 0xFF, 0 if u < 0 else 1, ov, u & 0xFF, u & 0xFF
+	
+	# Call a routine, which returns to SAP_RETURN
+	def call(self, address, a=None, x=None, y=None):
+		self.memory[SAP_RETURN] = 0xD2 # KIL, in case anything jumps there
+		self.memory[0x1FE] = (SAP_RETURN - 1) & 0xFF # return address, minus one, as JSR does
+		self.memory[0x1FF] = (SAP_RETURN - 1) >> 8
+		self.s = 0xFD
+		self.pc = address
+		if a is not None:
+			self.a, self.x, self.y = a & 0xFF, x & 0xFF, y & 0xFF
+	
+	# Run until the given cycle, or until the routine being run returns
+	# Returns whether the routine returned
+	def run(self, limit):
+		self.limit = limit
+		blocks = self.blocks
+		pc = self.pc
+		while pc != SAP_RETURN and self.cycle < limit:
+			block = blocks.get(pc)
+			if block is None:
+				block = self.translate(pc)
+			pc = block()
+		self.pc = pc
+		return pc == SAP_RETURN
+	
+	# Code was written to, so the blocks translated from it are no longer valid
+	# The address is volatile from then on (see translate)
+	def invalidate(self, address):
+		self.volatile.add(address)
+		for start in self.owners.pop(address, ()):
+			del self.blocks[start]
+			for other in self.extents.pop(start):
+				owners = self.owners.get(other)
+				if owners is not None:
+					owners.discard(start)
+					if not owners:
+						del self.owners[other]
+						self.code[other] = 0
+		self.code[address] = 0
+	
+	# Translate a block of code into a Python function
+	# The function runs the block, adds the cycles it took, and returns the address to go on from.
+	# Blocks go on through conditional branches (leaving the block if they're taken), jumps and
+	# subroutine calls, up to a return or an indirect jump. Branches back to the start of the block
+	# loop within the function, as long as the cycle limit of run isn't reached.
+	# Volatile addresses were written to while they were code: volatile operands are read from
+	# memory instead of being translated as constants, and blocks stop before volatile opcodes, so
+	# they're only translated at the start of a block.
+	def translate(self, start):
+		m = self.memory
+		lines = []
+		addresses = [] # addresses translated (see invalidate)
+		
+		# Operand bytes, as constants unless they're volatile
+		def operand(address):
+			address &= 0xFFFF
+			if address in self.volatile:
+				return "m[%d]" % address
+			addresses.append(address)
+			return "%d" % m[address]
+		
+		def emit(code, indent=1):
+			for line in code.split("\n"):
+				lines.append("\t" * indent + line)
+		
+		# Go on from the given address, after adding the cycles so far
+		# Going back to the start of the block loops, and anything else leaves it
+		def goto(target, extra=0, indent=1):
+			if target == start:
+				emit("cpu.cycle += %d\nif cpu.cycle < cpu.limit:\n\tcontinue\n@SAVE@\nreturn %d" % (
+					cycles + extra, start
+				), indent)
+				loops[0] = True
+			else:
+				emit("@SAVE@\ncpu.cycle += %d\nreturn %s" % (cycles + extra, target), indent)
+		
+		# Memory reads and writes, to the address given as a constant or in ad
+		def read(address, constant):
+			when = "cpu.cycle + %d" % (cycles + size - 1)
+			if not constant:
+				return "(m[ad] if ad & 0xF800 != 0xD000 else cpu.read(ad, %s))" % when
+			elif int(address) & 0xF800 == 0xD000:
+				return "cpu.read(%s, %s)" % (address, when)
+			return "m[%s]" % address
+		
+		# Do something with an operand, which goes straight into the code if it's only used once
+		def use(value, code):
+			if len(re.findall(r"\bt\b", code)) == 1:
+				emit(re.sub(r"\bt\b", lambda match: value, code))
+			else:
+				emit("t = %s\n%s" % (value, code))
+		
+		# Writing to code leaves the block right away, as it may have just changed
+		def write(address, value, constant):
+			when = "cpu.cycle + %d" % (cycles + size - 1)
+			if constant and int(address) & 0xF800 == 0xD000:
+				emit("cpu.write(%s, %s, %s)" % (address, value, when))
+				return
+			indent = 1
+			if not constant:
+				emit("if ad & 0xF800 == 0xD000:\n\tcpu.write(ad, %s, %s)\nelse:" % (value, when))
+				indent = 2
+			emit("m[%s] = %s\nif code[%s]:\n\tcpu.invalidate(%s)" % (address, value, address, address), indent)
+			goto(following, size, indent + 1)
+		
+		loops = [False]
+		cycles = 0 # cycles of the instructions translated so far
+		seen = set()
+		pc = start
+		for n in range(MOS6502_BLOCK_SIZE):
+			if pc == SAP_RETURN or pc in seen or pc in self.volatile and pc != start:
+				goto(pc)
+				break
+			seen.add(pc)
+			name, mode, size = MOS6502_OPCODES[m[pc]]
+			size = int(size)
+			addresses.append(pc)
+			following = (pc + 1 + MOS6502_OPERANDS[mode]) & 0xFFFF
+			
+			# Effective address, in ad unless it's a constant
+			constant = False
+			address = "ad"
+			if mode in ("zp", "abs", "ind"):
+				lo = operand(pc + 1)
+				hi = operand(pc + 2) if mode != "zp" else "0"
+				if lo.isdigit() and hi.isdigit():
+					address = "%d" % (int(lo) | int(hi) << 8)
+					constant = True
+				else:
+					emit("ad = %s | %s << 8" % (lo, hi))
+			elif mode in ("zpx", "zpy"):
+				emit("ad = %s + %s & 0xFF" % (operand(pc + 1), mode[2]))
+			elif mode in ("abx", "aby"):
+				emit("ad = (%s | %s << 8) + %s & 0xFFFF" % (operand(pc + 1), operand(pc + 2), mode[2]))
+			elif mode == "izx":
+				emit("u = %s + x & 0xFF\nad = m[u] | m[u + 1 & 0xFF] << 8" % operand(pc + 1))
+			elif mode == "izy":
+				lo = operand(pc + 1)
+				emit("ad = (m[%s] | m[%s + 1 & 0xFF] << 8) + y & 0xFFFF" % (lo, lo))
+			
+			if name in MOS6502_IMPLIED and mode == "imp":
+				emit(MOS6502_IMPLIED[name])
+			elif name in MOS6502_READ:
+				if mode == "imm":
+					use(operand(pc + 1), MOS6502_READ[name])
+				elif name != "NOP":
+					use(read(address, constant), MOS6502_READ[name])
+			elif name in MOS6502_MODIFY or name in MOS6502_COMBINED:
+				modify, then = MOS6502_COMBINED.get(name, (name, None))
+				if mode == "acc":
+					emit("t = a\n" + MOS6502_MODIFY[modify] + "\na = t")
+				else:
+					emit("t = " + read(address, constant))
+					emit(MOS6502_MODIFY[modify])
+					if then is not None:
+						emit(MOS6502_READ[then])
+					write(address, "t", constant)
+			elif name in MOS6502_STORE:
+				if name == "TAS":
+					emit("s = a & x")
+				if constant and "ad" in MOS6502_STORE[name]:
+					emit("ad = %s" % address)
+				write(address, MOS6502_STORE[name], constant)
+			elif name in MOS6502_BRANCH:
+				cycles += size
+				offset = operand(pc + 1)
+				emit("if %s:" % MOS6502_BRANCH[name])
+				if offset.isdigit():
+					target = (following + (int(offset) ^ 0x80) - 0x80) & 0xFFFF
+					goto(target, 1 + ((target ^ following) >> 8 and 1), 2)
+				else:
+					goto("%d + (%s ^ 0x80) - 0x80 & 0xFFFF" % (following, offset), 1, 2)
+				pc = following
+				continue
+			elif name in ("JMP", "JSR") and mode == "abs":
+				if name == "JSR":
+					emit("m[0x100 | s] = %d\ns = s - 1 & 0xFF\nm[0x100 | s] = %d\ns = s - 1 & 0xFF" % (
+						(pc + 2 & 0xFFFF) >> 8, pc + 2 & 0xFF
+					))
+				if not constant:
+					cycles += size
+					goto("ad")
+					break
+				following = int(address)
+			else: # Anything else leaves the block, to where the CPU goes from here
+				cycles += size
+				if name == "JMP": # the pointer's high byte never comes from the next page
+					if constant:
+						address = int(address)
+						goto("m[%d] | m[%d] << 8" % (address, address & 0xFF00 | (address + 1) & 0xFF))
+					else:
+						goto("m[ad] | m[ad & 0xFF00 | ad + 1 & 0xFF] << 8")
+				elif name == "RTS":
+					emit("s = s + 2 & 0xFF")
+					goto("(m[0x100 | s - 1 & 0xFF] | m[0x100 | s] << 8) + 1 & 0xFFFF")
+				elif name == "RTI":
+					emit("s = s + 3 & 0xFF\nfn, ov, dm, im, fz, c = cpu.unpackFlags(m[0x100 | s - 2 & 0xFF])")
+					goto("m[0x100 | s - 1 & 0xFF] | m[0x100 | s] << 8")
+				elif name == "BRK":
+					emit("m[0x100 | s] = %d\ns = s - 1 & 0xFF\nm[0x100 | s] = %d\ns = s - 1 & 0xFF" % (
+						(pc + 2 & 0xFFFF) >> 8, pc + 2 & 0xFF
+					))
+					emit("m[0x100 | s] = cpu.flags(fn, ov, dm, im, fz, c) | 0x10\ns = s - 1 & 0xFF\nim = 1")
+					goto("m[0xFFFE] | m[0xFFFF] << 8")
+				else: # KIL jams the CPU, so the routine is over
+					goto(SAP_RETURN)
+				break
+			cycles += size
+			pc = following
+		else:
+			goto(pc)
+		
+		# Only the registers the block uses are loaded, and only those it changes are saved
+		body = "\n".join(lines)
+		used = set(MOS6502_NAMES.findall(body))
+		changed = set(MOS6502_ASSIGNED.findall(body))
+		head = ["def block(cpu=cpu, m=m, code=code):"]
+		head += ["\t%s = cpu.%s" % (r, r) for r in MOS6502_REGISTERS if r in used]
+		if loops[0]:
+			head.append("\twhile True:")
+			body = body.replace("\n", "\n\t")
+			body = "\t" + body
+		source = "\n".join(head) + "\n" + re.sub(
+			r"(?m)^(\t*)@SAVE@$",
+			lambda match: "\n".join(
+				"%scpu.%s = %s" % (match.group(1), r, r) for r in MOS6502_REGISTERS if r in changed
+			) or match.group(1) + "pass",
+			body
+		)
+		
+		function = self.functions.get(source)
+		if function is None:
+			scope = {'cpu': self, 'm': m, 'code': self.code}
+			exec(source, scope)
+			function = self.functions[source] = scope["block"]
+		
+		self.blocks[start] = function
+		self.extents[start] = addresses
+		for address in addresses:
+			self.owners.setdefault(address, set()).add(start)
+			self.code[address] = 1
+		return function
+
+# Bits of the 17-bit poly counter POKEY reads RANDOM from, one per cycle
+@functools.lru_cache(maxsize=1)
+def poly17():
+	bits = bytearray(131071)
+	state = 0x1FFFF
+	for n in range(131071):
+		bits[n] = state & 1
+		state = state >> 1 | ((state ^ state >> 5) & 1) << 16
+	return bits
+
+# RANDOM, at a given cycle
+def randomByte(cycle):
+	bits = poly17()
+	n = cycle % 131071
+	return sum(bits[(n + k) % 131071] << k for k in range(8))
+
+# SAP file, and the player that plays it
+# Only SAP files of type B and C are supported, which is most of them: the player routine is
+# called once per frame (or more, with FASTPLAY), and the POKEY registers are taken at the end
+# of each frame, just as asapscan dumps them
+class SAPPlayer(MOS6502):
+	def __init__(self, data):
+		super().__init__()
+		self.tags = dict()
+		
+		end = data.find(b"\xFF\xFF")
+		if not data.startswith(b"SAP") or end < 0:
+			raise ConversionError("Incorrect SAP file.")
+		for line in data[:end].decode("latin-1").splitlines()[1:]:
+			tag, _, value = line.strip().partition(" ")
+			self.tags[tag] = value.strip()
+		self.type = self.tags.get("TYPE")
+		self.stereo = "STEREO" in self.tags
+		self.mode = NTSC if "NTSC" in self.tags else PAL
+		self.numSongs = int(self.tags.get("SONGS", 1))
+		self.defaultSong = int(self.tags.get("DEFSONG", 0))
+		try:
+			self.init = int(self.tags.get("INIT", "0"), 16)
+			self.player = int(self.tags["PLAYER"], 16)
+			self.music = int(self.tags.get("MUSIC", "0"), 16)
+			self.scanlines = SCANLINES_NTSC if self.mode == NTSC else SCANLINES_PAL
+			self.fastplay = int(self.tags.get("FASTPLAY", self.scanlines))
+		except (KeyError, ValueError):
+			raise ConversionError("Incorrect SAP file.")
+		if self.type not in ("B", "C"):
+			raise ConversionError(
+				"Only SAP files of type B and C can be played. For other types, use asapscan to dump " +
+				"the POKEY registers to a text file, and convert it instead."
+			)
+		
+		# Load the binary part into memory, in blocks of (first address, last address, data)
+		pos = end
+		while pos < len(data):
+			if data[pos:pos+2] == b"\xFF\xFF":
+				pos += 2
+			if pos + 4 > len(data):
+				raise ConversionError("Incorrect SAP file.")
+			first = data[pos] | data[pos+1] << 8
+			last = data[pos+2] | data[pos+3] << 8
+			if last < first or pos + 4 + last - first + 1 > len(data):
+				raise ConversionError("Incorrect SAP file.")
+			self.memory[first:last+1] = data[pos+4:pos+4+last-first+1]
+			pos += 4 + last - first + 1
+		
+		self.pokeys = [bytearray(9) for n in range(2 if self.stereo else 1)] # AUDF1-4, AUDC1-4, AUDCTL
+		self.frameStart = 0 # cycle the current frame started at
+	
+	# Hardware registers players use
+	def read(self, address, cycle):
+		register = address & 0xFF1F
+		if register == 0xD014: # PAL
+			return 0x0F if self.mode == NTSC else 0x01
+		elif register == 0xD20A or register == 0xD21A: # RANDOM, from the 17-bit poly counter
+			return randomByte(cycle)
+		elif register == 0xD20E or register == 0xD21E: # IRQST, no interrupts pending
+			return 0xFF
+		elif register == 0xD40B or register == 0xD41B: # VCOUNT
+			return (cycle - self.frameStart) // SCANLINE_CYCLES % self.scanlines >> 1
+		elif register == 0xD40F or register == 0xD41F: # NMIST
+			return 0x5F if (cycle - self.frameStart) // SCANLINE_CYCLES >= 248 else 0x1F
+		return self.memory[address]
+	
+	def write(self, address, data, cycle):
+		if address >> 8 == 0xD2: # POKEY
+			register = address & 0x0F
+			if register < 9:
+				self.pokeys[address >> 4 & 1 if self.stereo else 0][register] = data
+		elif address & 0xFF0F == 0xD40A: # WSYNC, wait for the next scanline
+			self.cycle += SCANLINE_CYCLES - (cycle - self.frameStart) % SCANLINE_CYCLES
+		else:
+			self.memory[address] = data
+	
+	# Call a routine of the player, and wait for it to return, as INIT routines do
+	def initialize(self, address, a, x, y):
+		self.call(address, a, x, y)
+		self.cycle = 0
+		if not self.run(SAP_INIT_TIME * self.scanlines * SCANLINE_CYCLES * (60 if self.mode == NTSC else 50)):
+			raise ConversionError("The INIT routine of the SAP file didn't return.")
+	
+	# Start playing a subsong
+	def start(self, song):
+		if self.type == "B":
+			self.initialize(self.init, song, 0, 0)
+		else:
+			self.initialize(self.player + 3, 0x70, self.music, self.music >> 8)
+			self.initialize(self.player + 3, 0x00, song, 0)
+		self.cycle = 0
+		self.nextPlay = 0
+	
+	# Play a frame, calling the player routine whenever it's due
+	def playFrame(self):
+		self.frameStart = self.cycle
+		end = self.cycle + self.scanlines * SCANLINE_CYCLES
+		while self.cycle < end:
+			if self.cycle >= self.nextPlay:
+				self.call(self.player if self.type == "B" else self.player + 6)
+				self.nextPlay += self.fastplay * SCANLINE_CYCLES
+			if self.run(min(end, self.nextPlay)):
+				self.cycle = min(end, self.nextPlay)
+
+
+# A single MIDI track, with its events encoded as soon as they are added
+# Events must be added in chronological order, which is how the converter generates them
+class MIDITrack(object):
+	def __init__(self):
+		self.data = bytearray() # encoded track data, with delta times
+		self.tick = 0 # tick of the last event
+		self.numNotes = 0 # number of notes in the track
+		self.notes = dict() # notes currently on, used to mark short notes
+
 # Basic MIDI writing class
 class MIDI(object):
 	def __init__(self, timebase=DEFAULT_TIMEBASE, tempo=DEFAULT_TEMPO):
 		self.timebase = round(timebase/24)*24 # lock to multiples of 24, as is standard
 		self.tempo = tempo
 		self.tracks = []
-		self.numNotes = [] # number of notes in each track
 		
-		self.timeOffset = 0 # time to subtract from every sound (note/ctrl) event, to remove silence
+		self.frameOffset = 0 # frame to subtract from every sound (note/ctrl) event, to remove silence
 		self.scaleFactor = 1.0 # scale times by this factor, to adjust for a known tempo
+		self.frameTime = DT_PAL # time between frames, in seconds (see setFrameTime)
+		self.frameTicks = array.array('q') # MIDI tick of each frame, counted from the offset (see frameToTicks)
+		
+		self.shortNoteCutoff = None # notes shorter than this (in beats) are moved to other channels
+		self.numFiltered = 0 # number of short notes found
+		self.numNoteOns = 0 # number of notes played, in all tracks
 		
 		# Initialize conductor track, initially blank
 		self.newTrack()
@@ -398,6 +1163,8 @@ class MIDI(object):
 	# Writes variable length number, as per MIDI standard
 	def variableLengthNumber(self, num):
 		assert num >= 0
+		if num < len(VLQ_TABLE): # small numbers, which are most of them, are ready to use
+			return VLQ_TABLE[num]
 		lst = struct.pack("=B",num & 0x7f)
 		while 1:
 			num = num >> 7
@@ -408,121 +1175,116 @@ class MIDI(object):
 	
 	# Create a new MIDI track
 	def newTrack(self):
-		self.tracks.append(dict())
-		self.numNotes.append(0)
+		self.tracks.append(MIDITrack())
 		return len(self.tracks)-1
 	
+	# Put the tracks (except the conductor track) in a given order of track numbers
+	def sortTracks(self, order):
+		self.tracks = [self.tracks[0]] + [self.tracks[t] for t in order]
+	
 	# Add event to a MIDI track
-	# time is given in seconds, data is a list with event name and data
-	# ['Event name', data...]
-	# We use a "Raw" event to write arbitrary data, instead of implementing all the useless events
-	def addEvent(self, track, time, data):
+	# The time is given in MIDI ticks, data is the raw MIDI event data
+	# Since events come in order, they are written straight away, only their delta times are added
+	# Returns the position of the event data in the track
+	def addEventAtTick(self, track, ticks, data):
 		assert 0 <= track and track < len(self.tracks)
-		ticks = self.timeToTicks(time)
 		assert ticks >= 0
-		if ticks not in self.tracks[track]:
-			self.tracks[track][ticks] = []
-		self.tracks[track][ticks].append( data )
+		trk = self.tracks[track]
+		assert ticks >= trk.tick # events must be in order
+		trk.data += self.variableLengthNumber(ticks - trk.tick)
+		pos = len(trk.data)
+		trk.data += data
+		trk.tick = ticks
+		return pos
 	
 	# Add meta track name
 	def setTrackName(self, track, name):
-		self.addEvent(track, 0, [
-			'Raw', b"\xFF\x03" + self.variableLengthNumber(len(name.encode())) + name.encode()
-		])
+		self.addEventAtTick(track, 0,
+			b"\xFF\x03" + self.variableLengthNumber(len(name.encode())) + name.encode()
+		)
 	
 	# Add meta instrument name
 	def setInstrumentName(self, track, name):
-		self.addEvent(track, 0, [
-			'Raw', b"\xFF\x04" + self.variableLengthNumber(len(name.encode())) + name.encode()
-		])
+		self.addEventAtTick(track, 0,
+			b"\xFF\x04" + self.variableLengthNumber(len(name.encode())) + name.encode()
+		)
 	
-	# Add a Note On event
-	def noteOn(self, track, time, channel, key, velocity):
+	# Add a Note On event, at a given tick (see frameToTicks)
+	def noteOn(self, track, ticks, channel, key, velocity):
 		velocity = min(127,max(0,int(velocity))) # Force 0-127 range
-		time -= self.timeOffset # Remove offset, if any
-		self.addEvent( track, time, [
-			'On', channel, key, velocity
-		])
-		self.numNotes[track] += 1
+		if self.shortNoteCutoff is not None and velocity == 0:
+			channel = self.markShortNote(track, ticks, channel, key)
+		pos = self.addEventAtTick( track, ticks, struct.pack("=BBB", 0x90 + channel, key, velocity) )
+		if self.shortNoteCutoff is not None and velocity > 0:
+			notes = self.tracks[track].notes
+			if (channel,key) not in notes: # If not a previously active note, mark it as active
+				notes[(channel,key)] = (ticks, pos) # save where it began
+		self.tracks[track].numNotes += 1
+		if velocity > 0:
+			self.numNoteOns += 1
 	
 	# Add a Note Off event
-	def noteOff(self, track, time, channel, key):
+	def noteOff(self, track, ticks, channel, key):
 		# Offs can be (and are usually) treated as On events with zero velocity
-		self.noteOn(track, time, channel, key, 0)
+		self.noteOn(track, ticks, channel, key, 0)
 	
 	# Add a Controller Change event
-	def ctrlChange(self, track, time, channel, ctrl, value):
-		time -= self.timeOffset
-		self.addEvent( track, time, [
-			'Ctrl', channel, ctrl, value
-		])
+	def ctrlChange(self, track, ticks, channel, ctrl, value):
+		self.addEventAtTick( track, ticks, struct.pack("=BBB", 0xB0 + channel, ctrl, value) )
 	
 	# Add a Program (Instrument) Change event
-	def progChange(self, track, time, channel, inst):
-		time -= self.timeOffset
-		self.addEvent( track, time, [
-			'Prog', channel, inst
-		])
+	def progChange(self, track, ticks, channel, inst):
+		self.addEventAtTick( track, ticks, struct.pack("=BB", 0xC0 + channel, inst) )
 	
-	# Convert time in seconds to MIDI ticks
-	def timeToTicks(self, time):
-		return round( time * self.timebase * self.scaleFactor )
+	# Set the time between frames, once the timebase and scale factor are set
+	# Frames are converted to MIDI ticks with a table, which is built again from here
+	def setFrameTime(self, dt):
+		self.frameTime = dt
+		self.frameTicks = array.array('q')
 	
+	# Convert a frame number to MIDI ticks, after removing the offset
+	# Every frame is a whole number of frames from the offset, so its ticks are worked out just
+	# once, straight from that number, and no rounding errors add up however long the song is.
+	# The table grows as later frames come in, since songs are assembled as they're read.
+	def frameToTicks(self, frame):
+		frame -= self.frameOffset
+		assert frame >= 0
+		ticks = self.frameTicks
+		if frame >= len(ticks):
+			dt, timebase, scale = self.frameTime, self.timebase, self.scaleFactor
+			end = frame + FRAME_TICKS_CHUNK
+			ticks.extend(round(n * dt * timebase * scale) for n in range(len(ticks), end))
+		return ticks[frame]
+	
+	# Mark notes shorter than a cutoff (in beats) from now on
+	# Notes are checked as they end, and short ones are moved to other channels
 	def filterNotesByLength(self, cutoff):
-		print("Marking notes shorter than 1/%d of a beat..." % (1.0/cutoff))
-		notes = {} # current notes being played in each channel
-		filtered = [] # notes to filter
-		for tn, track in enumerate(self.tracks): # for each track
-			for t in sorted(track.keys()): # we go through the timestamps
-				for en, ev in enumerate(track[t]): # and each of their events
-					if ev[0] != "On": continue # we only care about Note On events
-					_, ch, key, vel = ev
-					if vel > 0: # NoteOn triggered
-						if (ch,key) not in notes: # If not a previously active note, mark it as active
-							notes[(ch,key)] = (t,ev) # save its track & event
-					else: # Otherwise, we have a NoteOff
-						# We now check for the length of the note
-						if (ch,key) in notes: # If it was previously active (we check just in case)
-							# Grab info about where it began
-							starttime, starten = notes[(ch,key)]
-							dur = t - starttime # compute duration (in MIDI ticks)
-							if (dur / self.timebase) < cutoff: # If duration lower than the cutoff, we filter it
-								# We append the 
-								filtered.append([
-									tn,
-									notes[(ch,key)],
-									(t,ev)
-								])
-							del notes[(ch,key)]
-						# else:
-							#print("Invalid off note found.")
-							#exit()
-		# We now have a list of notes to filter
-		print("%d note%s filtered" % (len(filtered), "s" if len(filtered) != 0 else ""))
-		for note in filtered: # We switch channel for these very short notes
-			tn, non, noff = note
-			
-			self.tracks[tn][non[0]].remove(non[1]) # remove NoteOn event
-			non[1][1] += 8 # tweak channel
-			# if non[1][1] >= 9: # skip percussion MIDI channel
-				# non[1][1] += 1
-			self.tracks[tn][non[0]].append(non[1]) # append tweaked NoteOn event
-			
-			# Do the same with the NoteOff
-			self.tracks[tn][noff[0]].remove(noff[1])
-			noff[1][1] += 8
-			# if noff[1][1] >= 9:
-				# noff[1][1] += 1 # skip percussion
-			self.tracks[tn][noff[0]].append(noff[1])
-			
+		self.shortNoteCutoff = cutoff
+		self.numFiltered = 0
 	
-	# Save MIDI to a path
-	def save(self, path):
+	# Check the length of a note that is ending, at a given tick
+	# If it's too short, its Note On gets switched to another channel, and so must its Note Off
+	# Returns the channel for the Note Off
+	def markShortNote(self, track, ticks, channel, key):
+		trk = self.tracks[track]
+		if (channel,key) not in trk.notes: # If it wasn't previously active, there's nothing to do
+			return channel
+		# Grab info about where it began
+		starttime, pos = trk.notes.pop((channel,key))
+		dur = ticks - starttime # compute duration (in MIDI ticks)
+		if (dur / self.timebase) < self.shortNoteCutoff: # If duration lower than the cutoff, we filter it
+			trk.data[pos] += 8 # tweak channel of the Note On
+			self.numFiltered += 1
+			return channel + 8 # and the Note Off
+		return channel
+	
+	# Serialize MIDI as the contents of a MIDI file
+	def serialize(self):
 		# Assemble conductor track, track 0, which must contain only meta events
-		self.tracks[0] = dict()
-		self.addEvent(0, 0, [
-			'Raw', b"\xFF\x51\x03" + struct.pack(">L",int(60e6/self.tempo))[1:]
-		])
+		self.tracks[0] = MIDITrack()
+		self.addEventAtTick(0, 0,
+			b"\xFF\x51\x03" + struct.pack(">L",int(60e6/self.tempo))[1:]
+		)
 		
 		# Watermark
 		self.setTrackName(
@@ -530,63 +1292,150 @@ class MIDI(object):
 			"Converted with POKEY2MIDI v%s by LucasVB (http://1ucasvb.com/)" % VERSION
 		) 
 		
-		# Only write non-empty tracks
-		tracks = [self.tracks[0]] + [
-			track for t, track in enumerate(self.tracks) if self.numNotes[t] > 0
-		]
+		tracks = self.outputTracks()
 		
-		# Write MIDI file to disk
+		data = bytearray(b"MThd") # header
+		data += struct.pack(">L", 6) # header length
+		data += struct.pack(">H", 1) # MIDI format 1 (multiple tracks, single sequence)
+		data += struct.pack(">H", len(tracks)) # num tracks + conductor track
+		data += struct.pack(">H", self.timebase) # timebase
+		for track in tracks:
+			data += b"MTrk" # track header
+			data += struct.pack(">L", len(track.data) + 4) # track length, with End of Track
+			data += track.data
+			data += b"\x00\xFF\x2F\x00" # Obligatory End of Track marker
+		return bytes(data)
+	
+	# Tracks that are written to the MIDI file: the conductor track, and all non-empty tracks
+	def outputTracks(self):
+		return [self.tracks[0]] + [
+			track for track in self.tracks if track.numNotes > 0
+		]
+	
+	# Count the events of each track written to the MIDI file, by type
+	# Tracks are only kept as encoded data, so this decodes them again (see addEventAtTick)
+	# Returns a list of (track name, counts of each event type)
+	def countEvents(self):
+		result = []
+		for n, track in enumerate(self.outputTracks()):
+			data = track.data
+			name = "Track %d" % n
+			counts = collections.Counter()
+			pos = 0
+			while pos < len(data):
+				while data[pos] & 0x80: # skip delta time
+					pos += 1
+				status = data[pos+1]
+				pos += 1
+				if status == 0xFF: # meta event, with its length as a variable length number
+					meta = data[pos+1]
+					pos += 2
+					length = 0
+					while data[pos] & 0x80:
+						length = length << 7 | data[pos] & 0x7F
+						pos += 1
+					length = length << 7 | data[pos]
+					pos += 1
+					if meta == 0x03: # track name
+						name = data[pos:pos+length].decode(errors="replace")
+					pos += length
+					counts['meta'] += 1
+				else:
+					kind = MIDI_EVENT_TYPES[status >> 4]
+					if kind == "note on" and data[pos+2] == 0:
+						kind = "note off"
+					counts[kind] += 1
+					pos += 2 if status >> 4 in (0xC, 0xD) else 3
+			result.append( (name, counts) )
+		return result
+	
+	# Save MIDI to a path
+	def save(self, path):
+		data = self.serialize()
+		# Write MIDI file to disk, all at once
 		with open(path, "wb") as mf:
-			mf.write(b"MThd") # header
-			mf.write(struct.pack(">L", 6)) # header length
-			mf.write(struct.pack(">H", 1)) # MIDI format 1 (multiple tracks, single sequence)
-			mf.write(struct.pack(">H", len(tracks))) # num tracks + conductor track
-			mf.write(struct.pack(">H", self.timebase)) # timebase
-			for track in tracks:
-				mf.write(b"MTrk") # track header
-				mf.write(struct.pack(">L", 0)) # track length (will overwrite later, futher down)
-				trkpos = mf.tell() # save pos for the beginning of track data, we'll use it later
-				# // begin track data
-				
-				ltick = 0 # last tick
-				ticks = sorted(track.keys())
-				for tick in ticks:
-					first = True # first event at this tick?
-					for ev in track[tick]:
-						if first: # If first event at this tick, we use delta and update ltime
-							delta = tick - ltick
-							first = False
-						else: # Next events at this tick are simultaneous, so their deltas are zero
-							delta = 0
-						if ev[0] == "Raw":
-							mf.write(self.variableLengthNumber(delta))
-							mf.write(ev[1])
-						if ev[0] == "On":
-							mf.write(self.variableLengthNumber(delta))
-							channel, key, velocity = ev[1:]
-							mf.write(struct.pack("=B", 0x90 + channel))
-							mf.write(struct.pack("=B", key))
-							mf.write(struct.pack("=B", velocity))
-						if ev[0] == "Ctrl":
-							mf.write(self.variableLengthNumber(delta))
-							channel, ctrl, val = ev[1:]
-							mf.write(struct.pack("=B", 0xB0 + channel))
-							mf.write(struct.pack("=B", ctrl))
-							mf.write(struct.pack("=B", val))
-						if ev[0] == "Prog":
-							mf.write(self.variableLengthNumber(delta))
-							channel, inst = ev[1:]
-							mf.write(struct.pack("=B", 0xC0 + channel))
-							mf.write(struct.pack("=B", inst))
-					ltick = tick
-					
-				# // end generated track data
-				mf.write(b"\x00\xFF\x2F\x00") # Obligatory End of Track marker
-				# find total track size
-				trklen = mf.tell() - trkpos # find total chunk size
-				mf.seek(trkpos - 4) # go back to track length data
-				mf.write(struct.pack(">L", trklen)) # overwrite proper length
-				mf.seek(trkpos + trklen) # go back to end of data chunk
+			mf.write(data)
+
+
+# Note state of a MIDI channel while assembling, one for each channel of each POKEY
+class ChannelState(object):
+	__slots__ = ('note', 'vol', 'track')
+	
+	def __init__(self):
+		self.note = None # MIDI note being played, None if there is none
+		self.vol = 0 # 4-bit volume of the note
+		self.track = None # MIDI track of the note
+
+# What happens to a note being played when its channel gets a new note and volume
+NOTE_KILL			= 0 # the note ends (and a new one may start)
+NOTE_HOLD			= 1 # the note goes on
+NOTE_VOLUME			= 2 # the note goes on, with a new channel volume
+
+# Note transition functions, which take the channel state, and the new MIDI note and volume
+# One of these is used for all channels, as given by the options (see Converter.noteTransition)
+
+# If AlwaysRetrigger is set, the previous note is always killed
+def retriggerNote(channel, note, vol):
+	return NOTE_KILL
+
+# If new note is different, always cancel old note and retrigger
+# Always kill if current volume is zero
+# Timbre changes while keeping the note fixed (usually used for percussive effects) don't kill the
+# note for now
+# TODO: verify when this happens to know exactly how to handle it
+def holdNote(channel, note, vol):
+	if channel.note != note or vol == 0:
+		return NOTE_KILL
+	return NOTE_HOLD
+
+# If we're using the channel volume, we update it if changed, instead of sending a new note.
+# No need to kill. But ONLY if it's the same note!
+def channelVolumeNote(channel, note, vol):
+	if channel.note != note or vol == 0:
+		return NOTE_KILL
+	if channel.vol != vol:
+		return NOTE_VOLUME
+	return NOTE_HOLD
+
+# Otherwise, we kill if the note is rising. This usually means a re-trigger of the note in the
+# actual music. Decaying sounds are usually used for decaying envelopes, so the natural decay of
+# the MIDI note should work fine. Of course, only if we have set MergeDecays to True
+# Note, however, that if a song uses a ramping up attack, this just results in many quick notes
+# rising up in volume, which is usually fine.
+def mergeDecaysNote(channel, note, vol):
+	if channel.vol <= vol:
+		return NOTE_KILL
+	return holdNote(channel, note, vol)
+
+
+# Compiled song frames, as columns (see Song.compileFrames)
+# Instead of the state of every POKEY in every frame, each value has a typed array of its own: one
+# for the frame numbers, and for each channel of each POKEY (numbered pn*4 + ch, like MIDI
+# channels), one for its notes (NO_NOTE when there's none), one for its 4-bit volumes and one for
+# its polys. Values at the same position in every column belong to the same frame.
+class FrameColumns(object):
+	__slots__ = ('frames', 'notes', 'vols', 'polys')
+	
+	def __init__(self, numChannels):
+		self.frames = array.array('I')
+		self.notes = [array.array('h') for midi_ch in range(numChannels)]
+		self.vols = [array.array('B') for midi_ch in range(numChannels)]
+		self.polys = [array.array('B') for midi_ch in range(numChannels)]
+	
+	def __len__(self):
+		return len(self.frames)
+	
+	# All columns, frame numbers first, then the notes, volumes and polys of each channel
+	def columns(self):
+		return [self.frames] + [
+			column for midi_ch in range(len(self.notes))
+			for column in (self.notes[midi_ch], self.vols[midi_ch], self.polys[midi_ch])
+		]
+	
+	# Add the frames of other columns after these
+	def extend(self, other):
+		for column, more in zip(self.columns(), other.columns()):
+			column.extend(more)
 
 
 # Song management class
@@ -594,69 +1443,670 @@ class MIDI(object):
 class Song(object):
 	def __init__(self, converter):
 		self.pokeys = []
-		self.states = dict()
-		self.music = dict()
 		self.converter = converter
+		self.mode = None
+		self.voices = [] # voices are different timbres at each channel and POKEY
+		self.features = set() # AUDCTL features used
+		self.audctls = set() # AUDCTL values used
+		self.earliestFrame = None # frame of the earliest sound, if any
+		self.loopStart = None # frame the song loops from, and how many frames long the loop is, if
+		self.loopLength = None # found with --autostop
+		self.stopFrame = None # frame --autostop stopped the song at, if it did
+		self._columns = None # recorded frames, if recorded (see recordFrames)
+		self.numNotesUpdated = 0 # channel notes computed while compiling
+		self.numNotesSkipped = 0 # channel notes reused instead: unchanged ones, or repeats in a NumPy chunk
 	
 	@property
 	def numPOKEY(self):
 		return len(self.pokeys)
 	
+	# Time between frames, in seconds
+	@property
+	def frameTime(self):
+		return DT_NTSC if self.mode == NTSC else DT_PAL
+	
+	# Time of the earliest sound, in seconds, or None if there's no sound
+	@property
+	def earliestSound(self):
+		return self.earliestFrame * self.frameTime if self.earliestFrame is not None else None
+	
 	# Initializes POKEYs
 	def initPOKEY(self, n, mode):
-		self.pokeys = [POKEY(pn, mode) for pn in range(n)]
-	
-	# Add a new POKEY state
-	def addState(self, t, data):
-		self.states[t] = data
-	
-	# Compile POKEY states into timed note information and so on
-	def compile(self):
-		music = dict()
-		voices = set() # voices are different timbres at each channel and POKEY
-		features = set() # AUDCTL features used
-		earliest_sound = 1e6 # just some big number, simplifies logic
-		total = len(self.states)
-		lpc = None # last percentage
-		print("Compiling song...")
-		for n, t in enumerate(self.states):
-			data = self.states[t]
-			music[t] = []
+		self.mode = mode
+		self.pokeys = [POKEY(pn, mode, self.converter.DebugPolys) for pn in range(n)]
+	
+	# Compile POKEY states into timed note information, a chunk of frames at a time
+	# This is a generator: it takes (frame, data) frames and yields FrameColumns of up to
+	# COMPILE_CHUNK frames as they come in, so the song never has to be in memory as a whole.
+	# Voices, AUDCTL features and the earliest sound are updated as we go, and are final once all
+	# frames are consumed. The earliest sound is always known before the chunk it's in is yielded.
+	# If NumPy is available, chunks are compiled in a vectorized way
+	def compileFrames(self, frames, mode):
+		if np is not None and not DEBUG: # Debug info needs the POKEYs to do all the work
+			return self.compileFramesNumPy(frames, mode)
+		return self.compileFramesPython(frames, mode)
+	
+	# Pure Python backend of compileFrames, one POKEY write at a time
+	# Only channels whose registers changed are updated (see POKEY.update), the others keep the
+	# notes of the previous frame.
+	def compileFramesPython(self, frames, mode):
+		voices = set()
+		audctls = self.audctls
+		columns = None
+		for frame, data in frames:
+			if not self.pokeys: # Initialize POKEYs once we know how many there are
+				self.initPOKEY(len(data), mode)
+			if columns is None:
+				columns = FrameColumns(self.numPOKEY * 4)
+			columns.frames.append(frame)
 			for pn, pokey in enumerate(self.pokeys):
-				pokey.write(data[pn]) # write data to POKEY
-				features = features | pokey.AUDCTLFeatures # add which AUDCTL features were used
-				state = pokey.state.copy() # copy POKEY states dict
-				# Append music data
-				music[t].append({
-					'poly': state['poly'],
-					'note': state['note'],
-					'vol': state['vol']
-				})
+				updated = pokey.update(data[pn]) # write data to POKEY
+				self.numNotesUpdated += len(updated)
+				self.numNotesSkipped += 4 - len(updated)
 				for ch in range(4):
+					note = pokey.notes[ch]
+					columns.notes[pn*4 + ch].append(NO_NOTE if note is None else note)
+					columns.vols[pn*4 + ch].append(pokey.vol[ch])
+					columns.polys[pn*4 + ch].append(pokey.poly[ch])
+				if not updated: # Nothing new, including voices and sounds
+					continue
+				audctls.add(pokey.audctl) # add which AUDCTL value was used
+				for ch in updated: # the other channels are the same as before
 					# add voice used
-					voices.add( self.converter.voice(pn, ch, state['poly'][ch]) )
+					voices.add( self.converter.voice(pn, ch, pokey.poly[ch]) )
 					# if this channel is producing sound
-					if not state['volctrl'][ch] and \
-						state['note'][ch] is not None \
-						and state['vol'][ch] > 0:
+					if not pokey.volctrl[ch] and \
+						pokey.notes[ch] is not None \
+						and pokey.vol[ch] > 0:
 							# and if this sound is earlier than the known earliest sound
-							if t < earliest_sound:
-								earliest_sound = t # update earliest known sound
-			pc = int((n+1) / total * 100) # current percentage
-			if (pc % 10) == 0 and pc != lpc: # print multiples of 10%
-				# print( "%d%% " % pc, end="" )
-				lpc = pc
-		
-		print("Done!")
-		voices = sorted(voices) # update voices from set to ordered list
-		# Save results to memory
-		self.music = music
-		self.voices = voices
-		self.times = list(sorted(music.keys()))
-		self.earliestSound = earliest_sound
-		# Display AUDCTL features used
-		print( "AUDCTL features used:", ", ".join(list(features)) if len(features) else "None" )
+							if self.earliestFrame is None or frame < self.earliestFrame:
+								self.earliestFrame = frame # update earliest known sound
+			if len(columns) == COMPILE_CHUNK:
+				yield columns
+				columns = None
+		if columns is not None:
+			yield columns
+		
+		self.voices = sorted(voices) # update voices from set to ordered list
+		for audctl in audctls: # add which AUDCTL features were used
+			self.features |= AUDCTL_TABLE[audctl][1]
+	
+	# NumPy backend of compileFrames
+	# A chunk of frames is a (frames x POKEYs x 9) array of register values, so every register
+	# field is decoded for the whole chunk at once. Notes only depend on a few of these fields
+	# (see lookupNote), so each distinct combination in the chunk is looked up just once.
+	def compileFramesNumPy(self, frames, mode):
+		voices = set()
+		audctls = self.audctls
+		frames = iter(frames)
+		while True:
+			chunk = list(itertools.islice(frames, COMPILE_CHUNK))
+			if not chunk:
+				break
+			if not self.pokeys: # Initialize POKEYs once we know how many there are
+				self.initPOKEY(len(chunk[0][1]), mode)
+			
+			# AUDF1 AUDC1 AUDF2 AUDC2 AUDF3 AUDC3 AUDF4 AUDC4 AUDCTL
+			regs = np.frombuffer(
+				b"".join([b"".join(data) for frame, data in chunk]), dtype=np.uint8
+			).reshape(len(chunk), self.numPOKEY, 9)
+			audf = regs[:, :, 0:8:2].astype(np.int64)
+			audc = regs[:, :, 1:8:2].astype(np.int64)
+			audctl = regs[:, :, 8:9].astype(np.int64) # kept as a column, so it applies to all channels
+			
+			vol = audc & 0b00001111 # 4-bit channel volume
+			volctrl = audc >> 4 & 1 # Volume Control only
+			poly = audc >> 5 # Poly
+			
+			# 16-bit AUDFs for channels 2 and 4, when joined with 1 and 3
+			if ENABLE_16BIT:
+				join2and1, join4and3 = audctl[:, :, 0] >> 4 & 1, audctl[:, :, 0] >> 3 & 1
+				audf[:, :, 1] = np.where(join2and1, audf[:, :, 1] * 256 + audf[:, :, 0], audf[:, :, 1])
+				audf[:, :, 3] = np.where(join4and3, audf[:, :, 3] * 256 + audf[:, :, 2], audf[:, :, 3])
+			
+			# Pack everything a note depends on into a single number, and look up each one once
+			key = np.arange(4, dtype=np.int64) # channel
+			key = key << 8 | audctl
+			key = key << 3 | poly
+			key = key << 1 | volctrl
+			key = key << 1 | (vol > 0)
+			key = key << 16 | audf
+			keys, inverse = np.unique(key, return_inverse=True)
+			self.numNotesUpdated += len(keys)
+			self.numNotesSkipped += key.size - len(keys)
+			# Notes are stored as note + 21, and 511 for no note
+			codes = np.empty(len(keys), dtype=np.int64)
+			for n, k in enumerate(keys.tolist()):
+				note = lookupNote(
+					mode, (k >> 29) + 1, k >> 21 & 0xFF, k >> 18 & 7, k >> 17 & 1, k >> 16 & 1,
+					k & 0xFFFF, self.converter.DebugPolys
+				)[0]
+				codes[n] = 511 if note is None else note + 21
+			note = codes[inverse.reshape(key.shape)]
+			
+			# Earliest sound is the first frame with any channel producing sound
+			sounding = (volctrl == 0) & (note != 511) & (vol > 0)
+			first = np.flatnonzero(sounding.any(axis=(1, 2)))
+			if len(first) and (self.earliestFrame is None or chunk[first[0]][0] < self.earliestFrame):
+				self.earliestFrame = chunk[first[0]][0]
+			
+			# Voices and AUDCTL values used
+			used = np.arange(self.numPOKEY)[:, None] << 5 | np.arange(4) << 3 | poly
+			for v in np.unique(used).tolist():
+				voices.add( self.converter.voice(v >> 5, v >> 3 & 3, v & 7) )
+			audctls.update(np.unique(audctl).tolist())
+			
+			# Keep the POKEYs in the same state as if we had written to them
+			for pn, pokey in enumerate(self.pokeys):
+				pokey.write(chunk[-1][1][pn])
+			
+			# Hand out the chunk as columns, with a row of values for each channel of each POKEY
+			columns = FrameColumns(self.numPOKEY * 4)
+			columns.frames.extend(frame for frame, data in chunk)
+			note = np.where(note == 511, NO_NOTE, note - 21)
+			for column, values in [(columns.notes, note), (columns.vols, vol), (columns.polys, poly)]:
+				for a, row in zip(column, values.reshape(len(chunk), -1).T):
+					a.frombytes(row.astype(a.typecode).tobytes())
+			yield columns
+		
+		self.voices = sorted(voices) # update voices from set to ordered list
+		for audctl in audctls: # add which AUDCTL features were used
+			self.features |= AUDCTL_TABLE[audctl][1]
+	
+	# Pass compiled frames through, keeping a copy of them to save later (see saveTimeline)
+	# The copy is kept as columns too, with all frames in the same FrameColumns
+	def recordFrames(self, frames, mode):
+		recorded = self._columns = FrameColumns(0)
+		for columns in frames:
+			if not recorded: # We know how many channels there are once the first frames are in
+				recorded = self._columns = FrameColumns(len(columns.notes))
+			recorded.extend(columns)
+			yield columns
+	
+	# Number of recorded frames in which each channel (of each POKEY) is producing sound
+	def soundingFrames(self):
+		return [
+			sum(1 for note, vol in zip(notes, vols) if note != NO_NOTE and vol > 0)
+			for notes, vols in zip(self._columns.notes, self._columns.vols)
+		]
+	
+	# Autocorrelation of the note onsets of the recorded frames, from 0 to maxLag frames apart
+	# Onsets are the frames where a channel starts playing a note, or changes to another note.
+	# Each channel of each POKEY is an onset train of its own, with its mean taken out, and their
+	# autocorrelations are added up, so notes of different channels don't count as repetitions.
+	# Every value is scaled to the number of frames it was taken over, and relative to the value at
+	# 0 frames apart, so 1 is a perfect repetition. Returns a list, or None if there are no onsets.
+	# If NumPy is available, all channels are correlated at once, with an FFT.
+	def onsetAutocorrelation(self, maxLag):
+		if not self._columns:
+			return None
+		if np is not None:
+			ac = self.onsetAutocorrelationNumPy(maxLag)
+		else:
+			ac = self.onsetAutocorrelationPython(maxLag)
+		n = self._columns.frames[-1] + 1
+		if ac[0] <= 0:
+			return None
+		return [ac[lag] * n / (n - lag) / ac[0] if lag < n else 0.0 for lag in range(maxLag + 1)]
+	
+	# Pure Python backend of onsetAutocorrelation
+	# Onset trains are bitmasks, so the onsets of a channel that repeat lag frames later are the bits
+	# left in mask & (mask >> lag)
+	def onsetAutocorrelationPython(self, maxLag):
+		columns = self._columns
+		n = columns.frames[-1] + 1
+		popcount = getattr(int, "bit_count", lambda mask: bin(mask).count("1")) # int.bit_count is Python 3.10+
+		ac = [0.0] * (maxLag + 1)
+		for notes, vols in zip(columns.notes, columns.vols):
+			frames = []
+			previous = None # note playing in the frame before, if any
+			for frame, note, vol in zip(columns.frames, notes, vols):
+				if note == NO_NOTE or vol == 0:
+					note = None
+				elif note != previous:
+					frames.append(frame)
+				previous = note
+			if not frames:
+				continue
+			train = bytearray((n + 7) // 8)
+			for frame in frames:
+				train[frame >> 3] |= 1 << (frame & 7)
+			mask = int.from_bytes(train, "little")
+			mean = len(frames) / n
+			for lag in range(min(maxLag + 1, n)):
+				# Sum of (x[i] - mean) * (x[i+lag] - mean), for i from 0 to n-lag-1
+				before = bisect.bisect_left(frames, n - lag) # onsets in x[0:n-lag]
+				after = len(frames) - bisect.bisect_left(frames, lag) # onsets in x[lag:n]
+				repeats = popcount(mask & (mask >> lag))
+				ac[lag] += repeats - mean * (before + after) + (n - lag) * mean * mean
+		return ac
+	
+	# NumPy backend of onsetAutocorrelation
+	def onsetAutocorrelationNumPy(self, maxLag):
+		columns = self._columns
+		n = columns.frames[-1] + 1
+		frames = np.frombuffer(columns.frames, dtype=np.uint32).astype(np.int64)
+		notes = np.array([np.frombuffer(a, dtype=np.int16) for a in columns.notes]) # channels x frames
+		vols = np.array([np.frombuffer(a, dtype=np.uint8) for a in columns.vols])
+		notes = np.where(vols > 0, notes, NO_NOTE)
+		previous = np.concatenate([np.full_like(notes[:, :1], NO_NOTE), notes[:, :-1]], axis=1)
+		onsets = (notes != NO_NOTE) & (notes != previous)
 		
+		trains = np.zeros((len(notes), n))
+		trains[:, frames] = onsets
+		trains -= trains.mean(axis=1, keepdims=True)
+		size = 1 << (n + maxLag).bit_length() # padded, so the end doesn't wrap around to the start
+		spectrum = np.fft.rfft(trains, size, axis=1)
+		ac = np.fft.irfft(spectrum.real**2 + spectrum.imag**2, size, axis=1)[:, :maxLag + 1].sum(axis=0)
+		return ac.tolist()
+	
+	# Compact binary form of the recorded frames, and all that's needed to assemble them again
+	def saveTimeline(self):
+		earliest, loopStart, loopLength, stop = [-1 if n is None else n for n in
+			(self.earliestFrame, self.loopStart, self.loopLength, self.stopFrame)
+		]
+		header = struct.pack(TIMELINE_HEADER,
+			b"P2MT", TIMELINE_VERSION, self.mode, self.numPOKEY, earliest, loopStart, loopLength, stop,
+			len(self._columns), len(self.audctls)
+		)
+		data = self._columns.columns()
+		if sys.byteorder != "little": # always saved as little endian
+			data = [array.array(a.typecode, a) for a in data]
+			for a in data:
+				a.byteswap()
+		return zlib.compress(header + bytes(sorted(self.audctls)) + b"".join(a.tobytes() for a in data))
+	
+	# Load a timeline created by saveTimeline
+	# Returns a generator of FrameColumns, just like compileFrames. The song metadata (mode, earliest
+	# sound, loop, AUDCTL features) is available right away, and the voices once all frames are
+	# consumed, as with compileFrames.
+	# Raises TimelineError if the timeline is damaged, or was saved by another version.
+	def loadTimeline(self, data):
+		try:
+			data = zlib.decompress(data)
+			magic, version, mode, numPOKEY, earliest, loopStart, loopLength, stop, numFrames, numAudctl = \
+				struct.unpack_from(TIMELINE_HEADER, data)
+		except (zlib.error, struct.error) as e:
+			raise TimelineError("Damaged timeline: %s" % e)
+		if magic != b"P2MT" or version != TIMELINE_VERSION:
+			raise TimelineError("Not a timeline of this version")
+		pos = struct.calcsize(TIMELINE_HEADER)
+		columns = FrameColumns(numPOKEY * 4)
+		if len(data) != pos + numAudctl + numFrames * sum(a.itemsize for a in columns.columns()):
+			raise TimelineError("Damaged timeline: wrong size")
+		self.initPOKEY(numPOKEY, mode)
+		self.audctls = set(data[pos:pos+numAudctl])
+		for audctl in self.audctls:
+			self.features |= AUDCTL_TABLE[audctl][1]
+		pos += numAudctl
+		
+		for a in columns.columns():
+			a.frombytes(data[pos:pos + numFrames * a.itemsize])
+			pos += numFrames * a.itemsize
+			if sys.byteorder != "little":
+				a.byteswap()
+		
+		if earliest >= 0:
+			self.earliestFrame = earliest
+		if loopStart >= 0:
+			self.loopStart, self.loopLength = loopStart, loopLength
+		if stop >= 0:
+			self.stopFrame = stop
+		self._columns = columns
+		return self.replayFrames(columns)
+	
+	# Hand out loaded frames (see loadTimeline)
+	# They're all in memory already, so they're handed out all at once
+	def replayFrames(self, columns):
+		# Voices come from the polys used by each channel
+		voices = set()
+		for midi_ch, polys in enumerate(columns.polys):
+			for poly in set(polys):
+				voices.add( self.converter.voice(midi_ch >> 2, midi_ch & 3, poly) )
+		
+		if columns:
+			yield columns
+		self.voices = sorted(voices)
+
+# On-disk cache of compiled songs
+# Songs are stored by a hash of their input file, so converting the same dump again (say, with
+# different MIDI options) skips reading and compiling it. When the cache grows beyond its maximum
+# size, the least recently used songs are removed.
+class SongCache(object):
+	def __init__(self, path=CACHE_DIR, size=CACHE_SIZE):
+		self.path = path
+		self.size = size * 1024 * 1024 # maximum size in bytes
+	
+	# Get the cache key for an input file
+	# Besides the file itself, it includes anything else that changes how it's compiled
+	def key(self, file, converter):
+		h = hashlib.sha256()
+		h.update(("%s %d %r %d\n" % (
+			VERSION, TIMELINE_VERSION, converter.compileOptions(), ENABLE_16BIT
+		)).encode())
+		with open(file, "rb") as f:
+			for block in iter(lambda: f.read(1 << 20), b""):
+				h.update(block)
+		return h.hexdigest()
+	
+	def filePath(self, key):
+		return os.path.join(self.path, key + ".p2mt")
+	
+	# Load a cached song, or None if it's not in the cache
+	def load(self, key):
+		path = self.filePath(key)
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+			os.utime(path) # mark as recently used
+		except OSError:
+			return None
+		return data
+	
+	# Remove a song from the cache, such as a damaged one
+	def remove(self, key):
+		try:
+			os.remove(self.filePath(key))
+		except OSError: # someone else removed it
+			pass
+	
+	# Save a song to the cache
+	def save(self, key, data):
+		os.makedirs(self.path, exist_ok=True)
+		path = self.filePath(key)
+		temp = "%s.%d.tmp" % (path, os.getpid()) # so no one ever reads a partially written file
+		with open(temp, "wb") as f:
+			f.write(data)
+		os.replace(temp, path)
+		self.evict()
+	
+	# Remove the least recently used songs until the cache is within its maximum size
+	def evict(self):
+		files = []
+		for name in os.listdir(self.path):
+			if not name.endswith(".p2mt"):
+				continue
+			try:
+				stat = os.stat(os.path.join(self.path, name))
+			except OSError: # someone else removed it
+				continue
+			files.append( (stat.st_mtime, stat.st_size, os.path.join(self.path, name)) )
+		total = sum(size for _, size, _ in files)
+		for _, size, path in sorted(files):
+			if total <= self.size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+
+# Conversion statistics, collected with --profile
+# Stages are timed exclusively: a stage that pulls frames from an earlier one (see stage) doesn't
+# count the time spent in it. Apart from counting note computations (see POKEY_CALLS), which are
+# rare, everything here only happens while collecting, so conversions that aren't profiled don't
+# pay for any of it.
+class ConversionStats(object):
+	def __init__(self, memory=False):
+		self.memory = memory # also trace peak memory with tracemalloc (slows conversions down a lot)
+		self.times = collections.Counter() # time spent in each stage, in seconds
+		self.items = collections.Counter() # items (lines or frames) handed out by each stage
+		self.calls = collections.Counter() # calls of the POKEY methods that compute notes (see POKEY_CALLS)
+		self.counters = dict() # other counters, from the song and the MIDI
+		self.events = [] # events of each MIDI track, by type
+		self.cacheHits = 0 # note lookup cache hits and misses
+		self.cacheMisses = 0
+		self.peakMemory = None # peak traced memory, in bytes
+		self.peakRSS = None # peak resident memory of the process, in bytes
+		self.totalTime = 0.0
+		self.current = None # stage being timed
+		self.clock = None # when it started being timed
+	
+	# Switch timing to another stage (or None), and return the previous one
+	def switch(self, name):
+		now = time.perf_counter()
+		if self.current is not None:
+			self.times[self.current] += now - self.clock
+		self.clock = now
+		previous, self.current = self.current, name
+		return previous
+	
+	# Time everything in a block as a stage
+	@contextlib.contextmanager
+	def measure(self, name):
+		previous = self.switch(name)
+		try:
+			yield
+		finally:
+			self.switch(previous)
+	
+	# Time a stage of the pipeline, and count the items it hands out
+	# Only the time spent getting each item is counted, not the time spent by whoever uses it
+	# Compiled frames are handed out as columns of many frames, which count as that many items
+	def stage(self, name, items):
+		items = iter(items)
+		while True:
+			previous = self.switch(name)
+			try:
+				item = next(items)
+			except StopIteration:
+				return
+			finally:
+				self.switch(previous)
+			self.items[name] += len(item) if isinstance(item, FrameColumns) else 1
+			yield item
+	
+	# Collect statistics of whatever runs in the block
+	# Note computations and lookups are counted for the whole process, so only the calls made while
+	# it runs are kept
+	@contextlib.contextmanager
+	def collect(self):
+		calls = POKEY_CALLS.copy()
+		cache = lookupNote.cache_info()
+		tracing = self.memory and not tracemalloc.is_tracing()
+		if tracing:
+			tracemalloc.start()
+		elif self.memory:
+			tracemalloc.reset_peak()
+		start = time.perf_counter()
+		try:
+			yield self
+		finally:
+			self.totalTime += time.perf_counter() - start
+			if self.memory:
+				self.peakMemory = tracemalloc.get_traced_memory()[1]
+			if resource is not None: # in KB, except on macOS
+				self.peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+				self.peakRSS *= 1 if sys.platform == "darwin" else 1024
+			if tracing:
+				tracemalloc.stop()
+			info = lookupNote.cache_info()
+			self.cacheHits += info.hits - cache.hits
+			self.cacheMisses += info.misses - cache.misses
+			for name in ("getNote", "getFrequency"):
+				self.calls[name] += POKEY_CALLS[name] - calls[name]
+	
+	# Keep the counters of a converted song and its MIDI
+	def record(self, song, midi):
+		self.counters['notesUpdated'] = song.numNotesUpdated
+		self.counters['notesSkipped'] = song.numNotesSkipped
+		self.counters['noteOns'] = midi.numNoteOns
+		self.counters['shortNotes'] = midi.numFiltered
+		self.events = midi.countEvents()
+	
+	# Number of dump frames read, and kept once duplicates were removed
+	# Packed dumps only have frames that were kept to begin with, and so do played SAP files
+	@property
+	def framesRead(self):
+		return self.items["read"]
+	
+	@property
+	def framesKept(self):
+		for name in ("parse", "play"):
+			if name in self.items:
+				return self.items[name]
+		return self.items["read"]
+	
+	# Stages that were timed, in order
+	@property
+	def stages(self):
+		return [name for name in PROFILE_STAGES if name in self.times]
+	
+	# Events of all MIDI tracks, by type
+	def totalEvents(self):
+		total = collections.Counter()
+		for name, counts in self.events:
+			total.update(counts)
+		return total
+	
+	# Statistics as a dictionary, as saved with --stats-json
+	def summary(self):
+		lookups = self.cacheHits + self.cacheMisses
+		return {
+			'totalTime': self.totalTime,
+			'stages': {
+				name: {'time': self.times[name], 'items': self.items.get(name)}
+				for name in self.stages
+			},
+			'framesRead': self.framesRead,
+			'framesKept': self.framesKept,
+			'calls': dict(self.calls),
+			'noteCache': {
+				'hits': self.cacheHits,
+				'misses': self.cacheMisses,
+				'hitRate': self.cacheHits / lookups if lookups else None
+			},
+			'counters': self.counters,
+			'events': dict(self.totalEvents()),
+			'trackEvents': [{'track': name, 'events': dict(counts)} for name, counts in self.events],
+			'peakMemory': self.peakMemory,
+			'peakRSS': self.peakRSS
+		}
+	
+	# Print a human-readable report
+	def report(self):
+		print("Profile:")
+		print("    %-14s %10s %10s" % ("Stage", "Time (s)", "Items"))
+		for name in self.stages:
+			print("    %-14s %10.3f %10s" % (name, self.times[name], self.items.get(name, "")))
+		print("    %-14s %10.3f" % ("other", self.totalTime - sum(self.times.values())))
+		print("    %-14s %10.3f" % ("total", self.totalTime))
+		if self.framesRead:
+			print("Frames read: %d, kept after removing duplicates: %d (%.1f%%)" % (
+				self.framesRead, self.framesKept, 100 * self.framesKept / self.framesRead
+			))
+		if self.counters.get('notesUpdated'):
+			print("Channel notes computed: %d, reused: %d" % (
+				self.counters['notesUpdated'], self.counters['notesSkipped']
+			))
+		print("Calls: getNote %d, getFrequency %d" % (self.calls['getNote'], self.calls['getFrequency']))
+		lookups = self.cacheHits + self.cacheMisses
+		if lookups:
+			print("Note lookup cache: %d hits, %d misses (%.1f%% hit rate)" % (
+				self.cacheHits, self.cacheMisses, 100 * self.cacheHits / lookups
+			))
+		if self.events:
+			print("MIDI events: " + ", ".join("%s %d" % event for event in sorted(self.totalEvents().items())))
+			for name, counts in self.events:
+				print("    %s: %s" % (name, ", ".join("%s %d" % event for event in sorted(counts.items()))))
+		if self.peakRSS is not None:
+			print("Peak memory (resident): %.1f MB" % (self.peakRSS / (1 << 20)))
+		if self.peakMemory is not None:
+			print("Peak memory (traced): %.1f MB" % (self.peakMemory / (1 << 20)))
+
+
+# A compressed dump, read through its decompressor
+# Damaged data makes decompressors raise all sorts of errors, depending on the format and where it
+# was damaged, which are raised as ConversionError instead, like any other dump that can't be read.
+class CompressedInput(io.RawIOBase):
+	def __init__(self, stream):
+		self.stream = stream # decompressing stream
+	
+	def readable(self):
+		return True
+	
+	def readinto(self, b):
+		try:
+			return self.stream.readinto(b)
+		except DECOMPRESS_ERRORS as e:
+			raise ConversionError("Incorrect input format, damaged compressed data: %s" % e)
+	
+	def close(self):
+		self.stream.close()
+		super().close()
+
+
+# A dump read as it's being written, from a pipe (such as stdin) or a file that's still growing
+# Reads return whatever is there, without waiting for more, so each line is converted as soon as
+# it's in. A pipe ends when it's closed, and a followed file once it hasn't grown for a while.
+# The first bytes are read right away, to tell the format of the dump (see sniffFormat), and
+# handed out again before the rest.
+class LiveInput(io.RawIOBase):
+	def __init__(self, stream, follow=False, timeout=FOLLOW_TIMEOUT):
+		self.stream = stream # unbuffered binary stream
+		self.follow = follow # wait for more at the end, as it may still be written
+		self.timeout = timeout # in seconds
+		self.head = b""
+		while len(self.head) < 8:
+			data = self.readAvailable(8 - len(self.head))
+			if not data:
+				break
+			self.head += data
+		self.pos = 0 # bytes of the head handed out
+	
+	def readable(self):
+		return True
+	
+	# Read up to size bytes, as soon as there are any, or nothing at the end
+	def readAvailable(self, size):
+		idle = time.monotonic()
+		while True:
+			data = self.stream.read(size)
+			if data or not self.follow or time.monotonic() - idle > self.timeout:
+				return data
+			time.sleep(FOLLOW_POLL)
+	
+	def readinto(self, b):
+		if self.pos < len(self.head):
+			data = self.head[self.pos:self.pos + len(b)]
+			self.pos += len(data)
+		else:
+			data = self.readAvailable(len(b))
+		b[:len(data)] = data
+		return len(data)
+	
+	def close(self):
+		self.stream.close()
+		super().close()
+
+
+# Raised when a dump can't be converted
+class ConversionError(Exception):
+	pass
+
+# Raised when a timeline can't be loaded (see Song.loadTimeline)
+class TimelineError(Exception):
+	pass
+
+# Result of an in-memory conversion (see Converter.convertData)
+class ConversionResult(object):
+	def __init__(self, song, midi, data, tempos):
+		self.midi = data # contents of the MIDI file
+		self.mode = song.mode # NTSC or PAL, None if there were no frames
+		self.numPOKEY = song.numPOKEY
+		self.voices = list(song.voices) # voices used (see Converter.voice)
+		self.features = sorted(song.features) # AUDCTL features used
+		self.earliestSound = song.earliestSound # in seconds
+		self.numNotes = midi.numNoteOns # number of notes played
+		self.numShortNotes = midi.numFiltered # number of short notes marked
+		self.tempos = tempos # possible (bpm, confidence) tempos, most likely first, if detecting tempo
+		# Where the song loops, and where it was stopped, in seconds, if found with --autostop
+		dt = song.frameTime
+		self.loopStart = song.loopStart * dt if song.loopStart is not None else None
+		self.loopLength = song.loopLength * dt if song.loopLength is not None else None
+		self.stopTime = song.stopFrame * dt if song.stopFrame is not None else None
+
 
 # Main POKEY2MIDI program class, which handles everything
 class Converter(object):
@@ -672,6 +2122,13 @@ class Converter(object):
 		self.BoostVelocity = 1.0
 		# Time limit (do not convert past this point)
 		self.TimeLimit = None
+		# Subsong of SAP files to play (None plays the default one)
+		self.Subsong = None
+		# Stop once the song loops, or once it falls silent
+		self.AutoStop = False
+		# Loops to keep, and seconds of silence that end a song, with AutoStop
+		self.Loops = AUTOSTOP_LOOPS
+		self.SilenceTime = AUTOSTOP_SILENCE
 		# Split different polynomial counter settings for channels as separate instrument tracks
 		self.SplitPolyAsTracks = True
 		# Use short track names
@@ -683,6 +2140,8 @@ class Converter(object):
 		# Attempt to detect song tempo with a simple algorithm
 		# Display the results aftewards
 		self.DetectTempo = False
+		# Only detect the tempo, without making a MIDI file
+		self.TempoOnly = False
 		# Force a specific timebase
 		self.ForceTimebase = None
 		# Don't use note velocities for note loudness. Use the channel volume instead.
@@ -697,6 +2156,37 @@ class Converter(object):
 		# Mark short notes
 		self.MarkShortNotes = False
 		self.ShortNoteCutoff = 1e3;
+		# Directory to cache compiled songs in, if any
+		self.CacheDir = None
+		# Maximum size of the cache, in MB
+		self.CacheSize = CACHE_SIZE
+		# Keep reading the input file as it's written, until it stops growing (see LiveInput)
+		self.Follow = False
+		# Number of processes to assemble MIDI channels in
+		self.AssembleJobs = 1
+		# Collect conversion statistics here, if set (see ConversionStats)
+		self.Stats = None
+		# Also write non-tonal polys (0-4) notes as given by AUDF (see DEBUG_POLYS)
+		self.DebugPolys = DEBUG_POLYS
+		# Print what's going on
+		self.Verbose = True
+		
+		# Frame to stop reading at, once AutoStop knows where the song ends (see autoStop)
+		self.deadline = None
+		# Tempos found by the last conversion, if detecting tempo (see detectTempo)
+		self.tempos = []
+	
+	# Print a message, if verbose
+	def log(self, *args, **kwargs):
+		if self.Verbose:
+			print(*args, **kwargs)
+	
+	# Time a stage of the conversion, if collecting statistics (see ConversionStats)
+	def stage(self, name, items):
+		return items if self.Stats is None else self.Stats.stage(name, items)
+	
+	def measure(self, name):
+		return contextlib.nullcontext() if self.Stats is None else self.Stats.measure(name)
 	
 	# Get a string tag for a given voice
 	# A voice exists for each instrument for each channel for each POKEY
@@ -708,57 +2198,51 @@ class Converter(object):
 		else:
 			return "%d %s" % (pn, ch+1)
 	
-	# Main conversion function
-	def convert(self, file, output):
-		
-		if not os.path.isfile(file):
-			print("File \"%s\" doesn't exist" % file)
-			return
-		
-		if os.path.splitext(os.path.basename(file))[1].lower() == "sap": # Wrong usage
-			print("Error: POKEY2MIDI does not convert SAP files directly to MIDI.")
-			print("       You must use ASAPSCAN and save the POKEY register dumps to a text file, then run POKEY2MIDI on the text file.")
-			print("       Download ASAP: http://asap.sourceforge.net/")
-			exit()
-		
-		self.file = file
-		
-		song = Song(self) # The song object which will handle things
-		
-		print("="*20 + "[ POKEY2MIDI v%s ]"%VERSION + "="*20)
-		print("Opening \"%s\"" % self.file)
-		
-		
-		# Detect MIME type
-		mime = mimetypes.guess_type(self.file)
-		if mime[0] != "text/plain" or mime[1] is not None and mime[1] != "bzip2":
-			print("ERROR\nIncorrect input format.")
-			exit()
-		if mime[1] == "bzip2":
-			handle = bz2.open(self.file, "rt")
-		elif mime[1] == None:
-			handle = open(self.file, "rt")
+	# Fast parser for the register part of an asapscan dump line, as raw bytes
+	# asapscan always uses the same layout, one or two POKEYs separated by a bar:
+	#     T: AA BB  AA BB  AA BB  AA BB  CC  |  AA BB  AA BB  AA BB  AA BB  CC
+	# Returns a list with 9 bytes per POKEY, or None if the line doesn't follow this layout
+	def parseLine(self, regs):
+		if not regs:
+			return None
+		try:
+			data = [bytes.fromhex(part.decode("ascii")) for part in regs.split(b"|")]
+		except ValueError:
+			return None
+		if len(data) > 2:
+			return None
+		for d in data:
+			if len(d) != 9:
+				return None
+		return data
+	
+	# Read POKEY frames from the lines of an asapscan dump
+	# This is a generator: it yields (frame, data) for each frame where the POKEY registers changed,
+	# as they are read, so the dump never has to be kept in memory. Frames are numbered from 0, one
+	# per line, and are dt (see DT_NTSC and DT_PAL) apart.
+	def readDump(self, fin, mode):
+		dt = DT_NTSC if mode == NTSC else DT_PAL # the correct time between frames
 		
-		with handle as fin:
-			print("Reading POKEY data...")
+		ln = 0 # line number
+		last_regs = None # raw register bytes of the previous line
+		for l in fin:
+			# Register bytes are everything after the timestamp
+			colon = l.find(b":")
+			regs = l[colon+1:].strip() if colon >= 0 else None
 			
-			# Detect NTSC or PAL, skip to the 61st line, where we can tell them apart
-			# NTSC will have timestamp 1.00, PAL will have 1.20
-			for ln in range(61):
-				l = fin.readline()
+			# If the line has the exact same register bytes as the previous one, it's a
+			# duplicate frame, so there's nothing to decode (see below)
+			if regs is not None and regs == last_regs:
+				if self.TimeLimit is not None and ln*dt > self.TimeLimit or \
+					self.deadline is not None and ln >= self.deadline:
+						break
+				ln += 1
+				continue
 			
-			if l.split(":")[0].strip() == "1.00":
-				mode = NTSC
-				dt = DT_NTSC # the correct time between frames for NTSC
-			else:
-				mode = PAL
-				dt = DT_PAL # the correct time between frames for PAL
-			
-			# Reset reading pointer
-			fin.seek(0)
-			
-			ln = 0 # line number
-			for l in fin:
+			# Try the fast parser first, and only use the tolerant one if it fails
+			data = self.parseLine(regs)
+			if data is None:
+				l = l.decode("ascii", "replace")
 				l = re.sub(r"[\n\r\:]", "", l.strip()) # get rid of EOL characters and colon
 				l = re.sub(r"\s+", " ", l) # get rid of extra spaces
 				if l == "NO RESPONSE": # Stop at end of POKEY data, if any (for finite songs)
@@ -770,58 +2254,552 @@ class Converter(object):
 					if len(tokens) != 10 and len(tokens) != 20:
 						raise
 					data = (" ".join(tokens[1:])).split("|")
+					# AUDF1 AUDC1 AUDF2 AUDC2 AUDF3 AUDC3 AUDF4 AUDC4 AUDCTL
+					data = [bytes.fromhex(d) for d in data] # convert to raw data
 				except:
-					print("ERROR\nIncorrect input format.")
-					exit()
-				
-				if ln == 0: # Setup metadata if we just parsed the first line
-					numPOKEY = len(data)
-					# Assume zeroed out registers initially
-					last_data = [bytes.fromhex("00"*9)] * numPOKEY
-					print(
-						("Mode: Mono" if numPOKEY == 1 else "Stereo") + ", " + \
-						("NTSC (%.2f Hz)" % FPS_NTSC if mode == NTSC else "PAL (%.2f Hz)" % FPS_PAL)
-					)
-				
-				# Compute timestamp by ourselves, for more precision
-				t = ln*dt
-				
-				# Stop after a given time limit
-				if self.TimeLimit is not None and t > self.TimeLimit:
+					raise ConversionError("Incorrect input format.")
+				regs = None # the raw bytes can't be trusted for comparisons
+			last_regs = regs
+			
+			if ln == 0: # Setup metadata if we just parsed the first line
+				numPOKEY = len(data)
+				# Assume zeroed out registers initially
+				last_data = [bytes.fromhex("00"*9)] * numPOKEY
+				self.log(
+					("Mode: Mono" if numPOKEY == 1 else "Stereo") + ", " + \
+					("NTSC (%.2f Hz)" % FPS_NTSC if mode == NTSC else "PAL (%.2f Hz)" % FPS_PAL)
+				)
+			
+			# The frame number is the line number, rather than the timestamp, for more precision
+			frame = ln
+			
+			# Stop after a given time limit, or where the song ends
+			if self.TimeLimit is not None and frame*dt > self.TimeLimit or \
+				self.deadline is not None and frame >= self.deadline:
+					break
+			
+			ln += 1 # increase line number
+			
+			# asapscan outputs one line per frame. In many cases, lines are identical
+			# Since duplicate lines are meaningless (only changes in POKEY state are useful
+			# for detecting musical content), we ignore duplicate lines.
+			
+			# If POKEY data hasn't changed, we don't need to do anything
+			if data == last_data: 
+				continue
+			
+			last_data = data # Update previous state
+			
+			# Pass on the song data (the state changes)
+			yield frame, data
+	
+	# Detect the format of a dump from its first bytes (see INPUT_MAGIC)
+	# The dump can be a file path, or its contents as bytes
+	def sniffFormat(self, file):
+		if isinstance(file, (bytes, bytearray, memoryview)):
+			magic = bytes(file[:8])
+		else:
+			with open(file, "rb") as f:
+				magic = f.read(8)
+		for format, start in INPUT_MAGIC:
+			if magic.startswith(start):
+				return format
+		return "text"
+	
+	# Open an asapscan dump, either as plain text or compressed, as given by sniffFormat
+	# The dump can be a file path, or a binary file object
+	# Lines are read as raw bytes, in large chunks, and only decoded when needed
+	def openDump(self, file, format):
+		if format == "text":
+			if isinstance(file, io.RawIOBase): # unbuffered streams are read in large chunks too
+				return io.BufferedReader(file, READ_BUFFER)
+			if not isinstance(file, (str, bytes, os.PathLike)): # already open
+				return file
+			return open(file, "rb", buffering=READ_BUFFER)
+		elif format == "bzip2":
+			fin = bz2.open(file, "rb")
+		elif format == "gzip":
+			fin = gzip.open(file, "rb")
+		elif format == "xz":
+			fin = lzma.open(file, "rb")
+		elif format == "zstd" and zstd is not None:
+			fin = zstd.open(file, "rb")
+		elif format == "zstd":
+			raise ConversionError("Reading zstd-compressed dumps requires Python 3.14 or the zstandard module.")
+		else:
+			raise ConversionError("Incorrect input format.")
+		return io.BufferedReader(CompressedInput(fin), READ_BUFFER)
+	
+	# Detect NTSC or PAL from the timestamps of the first lines, as they come in
+	# Timestamps are in seconds, with 2 decimals, and lines are a frame apart: 1/59.94 seconds with
+	# NTSC, and 1/50 with PAL. As soon as there are enough lines for NTSC and PAL timestamps to be
+	# MODE_GAP seconds apart (16 lines, about a third of a second), the mode whose time is closest
+	# is taken, so dumps read as they're written (see LiveInput) don't wait long. Short dumps are
+	# taken as PAL.
+	# The lines read here are kept, so the input never has to be read twice (compressed inputs
+	# would have to be decompressed again). Returns the mode, and all lines of the input.
+	def detectMode(self, fin):
+		head = []
+		start = None # line and timestamp of the first line with a timestamp
+		for l in fin:
+			head.append(l)
+			try:
+				t = float(l.split(b":")[0])
+			except ValueError: # no timestamp, such as NO RESPONSE
+				continue
+			if start is None:
+				start = (len(head), t)
+			n = len(head) - start[0] # frames since the first timestamp
+			if n * (DT_PAL - DT_NTSC) >= MODE_GAP:
+				t -= start[1]
+				mode = NTSC if abs(t - n * DT_NTSC) < abs(t - n * DT_PAL) else PAL
+				return mode, itertools.chain(head, fin)
+		
+		return PAL, iter(head)
+	
+	# Open a dump to be read as it's written (see LiveInput): stdin if the file is "-", or else a file
+	# that's still being written, which may not even be there yet
+	# Returns None if the file doesn't show up within FOLLOW_TIMEOUT seconds
+	def openLive(self, file):
+		if file == "-":
+			return LiveInput(open(sys.stdin.fileno(), "rb", buffering=0, closefd=False))
+		start = time.monotonic()
+		while not os.path.isfile(file):
+			if time.monotonic() - start > FOLLOW_TIMEOUT:
+				return None
+			time.sleep(FOLLOW_POLL)
+		return LiveInput(open(file, "rb", buffering=0), follow=True)
+	
+	# Open a packed dump (see packDump)
+	# The file is memory-mapped, and frames are sliced straight out of it as they're needed, so
+	# there's nothing to decompress or parse. Returns the mode, and a generator of (frame, data)
+	# frames, just like readDump.
+	def openPKD(self, file):
+		with open(file, "rb") as f:
+			try:
+				view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+			except ValueError: # empty files can't be mapped
+				view = memoryview(b"")
+		# The map stays open for as long as any frame still refers to it
+		return self.readPacked(view)
+	
+	# Check the header of a packed dump, given as a memoryview
+	# Returns the mode, and a generator of its (frame, data) frames (see readPKD)
+	def readPacked(self, view):
+		header = struct.calcsize(PKD_HEADER)
+		if len(view) >= header:
+			magic, version, mode, numPOKEY, numFrames = struct.unpack_from(PKD_HEADER, view)
+		if len(view) < header or magic != PKD_MAGIC or version != PKD_VERSION or \
+			len(view) != header + numFrames * (struct.calcsize(PKD_FRAME) + 9*numPOKEY):
+				raise ConversionError("Incorrect input format.")
+		return mode, self.readPKD(view, mode, numPOKEY, numFrames)
+	
+	# Read POKEY frames from an opened packed dump (see openPKD)
+	def readPKD(self, view, mode, numPOKEY, numFrames):
+		dt = DT_NTSC if mode == NTSC else DT_PAL
+		self.log(
+			("Mode: Mono" if numPOKEY == 1 else "Stereo") + ", " + \
+			("NTSC (%.2f Hz)" % FPS_NTSC if mode == NTSC else "PAL (%.2f Hz)" % FPS_PAL)
+		)
+		
+		pos = struct.calcsize(PKD_HEADER)
+		size = struct.calcsize(PKD_FRAME) + 9*numPOKEY
+		for n in range(numFrames):
+			frame = struct.unpack_from(PKD_FRAME, view, pos)[0]
+			
+			# Stop after a given time limit, or where the song ends
+			if self.TimeLimit is not None and frame*dt > self.TimeLimit or \
+				self.deadline is not None and frame >= self.deadline:
 					break
+			
+			yield frame, [view[p:p+9] for p in range(pos + size - 9*numPOKEY, pos + size, 9)]
+			pos += size
+	
+	# Play a SAP file, given as bytes, with the built-in player (see SAPPlayer)
+	# The subsong is started right away, so bad SAP files fail here. Returns the mode, and a
+	# generator of (frame, data) frames, just like readDump.
+	def openSAP(self, data):
+		player = SAPPlayer(data)
+		song = player.defaultSong if self.Subsong is None else self.Subsong
+		if not 0 <= song < player.numSongs:
+			raise ConversionError("The SAP file has no subsong %d. Its subsongs are 0 to %d." % (song, player.numSongs - 1))
+		player.start(song)
+		return player.mode, self.playSAP(player, song)
+	
+	# Play POKEY frames of a started SAP file (see openSAP)
+	# The registers are taken at the end of each frame, just as asapscan dumps them, and only
+	# frames where they changed are kept. Without a time limit, the song plays for as long as
+	# asapscan would dump it.
+	def playSAP(self, player, song):
+		dt = DT_NTSC if player.mode == NTSC else DT_PAL
+		numPOKEY = len(player.pokeys)
+		self.log("Subsong: %d (the SAP file has %d)" % (song, player.numSongs))
+		self.log(
+			("Mode: Mono" if numPOKEY == 1 else "Stereo") + ", " + \
+			("NTSC (%.2f Hz)" % FPS_NTSC if player.mode == NTSC else "PAL (%.2f Hz)" % FPS_PAL)
+		)
+		
+		numFrames = int(SAP_TIME / dt) if self.TimeLimit is None else None
+		last_data = [bytes(9)] * numPOKEY # Assume zeroed out registers initially
+		for frame in itertools.count():
+			# Stop after a given time limit, or where the song ends
+			if self.TimeLimit is not None and frame*dt > self.TimeLimit or frame == numFrames or \
+				self.deadline is not None and frame >= self.deadline:
+					break
+			
+			player.playFrame()
+			data = [bytes(pokey) for pokey in player.pokeys]
+			if data == last_data:
+				continue
+			
+			last_data = data
+			yield frame, data
+	
+	# Convert an asapscan dump into a packed dump (.pkd), which is much faster to convert later
+	# Packed dumps keep only what readDump gets out of a dump: a header (see PKD_HEADER), followed
+	# by each frame where the POKEY registers changed, as its frame number and 9 bytes of
+	# registers per POKEY (see PKD_FRAME). The time limit, if any, also applies here.
+	def packDump(self, file, output):
+		if not os.path.isfile(file):
+			self.log("File \"%s\" doesn't exist" % file)
+			return
+		
+		format = self.sniffFormat(file)
+		if format == "pkd":
+			raise ConversionError("Incorrect input format.")
+		
+		self.log("Packing \"%s\" into \"%s\"" % (file, output))
+		sap = format == "sap"
+		handle = open(file, "rb") if sap else self.openDump(file, format)
+		with handle as fin, open(output, "wb") as fout:
+			if sap:
+				mode, dump = self.openSAP(fin.read())
+			else:
+				mode, lines = self.detectMode(fin)
+				dump = self.readDump(lines, mode)
+			
+			# The header is written last, once we know what goes in it
+			fout.write(bytes(struct.calcsize(PKD_HEADER)))
+			numPOKEY = numFrames = 0
+			for frame, data in dump:
+				fout.write(struct.pack(PKD_FRAME, frame) + b"".join(data))
+				numPOKEY = len(data)
+				numFrames += 1
+			
+			fout.seek(0)
+			fout.write(struct.pack(PKD_HEADER, PKD_MAGIC, PKD_VERSION, mode, numPOKEY, numFrames))
+		
+		self.log("Done! %d frames packed" % numFrames)
+		return numFrames
+	
+	# Options that change how songs are compiled, rather than how they're assembled into MIDI
+	# Conversions with the same options here can share compiled songs (see SongCache and variants)
+	def compileOptions(self):
+		return (self.TimeLimit, self.Subsong, self.AutoStop, self.Loops, self.SilenceTime, self.DebugPolys)
+	
+	# Main conversion function
+	# Converts a dump file, and saves the MIDI file. Returns the MIDI, or None if the file doesn't
+	# exist. Raises ConversionError if the dump can't be converted.
+	# If variants are given, as (name, converter, output) for each, the song is compiled just once,
+	# and a MIDI file is saved for each variant instead (see assembleVariants).
+	# The file can be "-" to read a dump from stdin, which is converted as it comes in, as are files
+	# with Follow (see openLive).
+	def convert(self, file, output, variants=None):
+		
+		live = None
+		if file == "-" or self.Follow:
+			live = self.openLive(file)
+		if live is None and not os.path.isfile(file):
+			self.log("File \"%s\" doesn't exist" % file)
+			return
+		
+		format = self.sniffFormat(file if live is None else live.head)
+		
+		song = Song(self) # The song object which will handle things
+		
+		self.log("="*20 + "[ POKEY2MIDI v%s ]"%VERSION + "="*20)
+		self.log("Opening \"%s\"" % file)
+		
+		# Initialize MIDI
+		midi = MIDI()
+		
+		# Tempo detection and variants only need the compiled song
+		assembling = not self.TempoOnly and variants is None
+		
+		# If this dump was compiled before, we can skip straight to assembling the MIDI
+		cache = None
+		timeline = None
+		if self.CacheDir is not None and live is None: # Live dumps can't be hashed before they're read
+			cache = SongCache(self.CacheDir, self.CacheSize)
+			key = cache.key(file, self)
+			timeline = cache.load(key)
+		
+		# A damaged song is removed from the cache, and compiled again
+		if timeline is not None:
+			try:
+				frames = song.loadTimeline(timeline)
+			except TimelineError as e:
+				self.log("Couldn't use the compiled song from the cache (%s), compiling it again..." % e)
+				cache.remove(key)
+				song = Song(self)
+				timeline = None
+		
+		if timeline is not None:
+			self.log("Using compiled song from cache...")
+			frames = self.stage("load", frames)
+			mode = song.mode
+			if assembling:
+				if self.AssembleJobs > 1: # Workers get the song as a timeline too
+					frames = self.stage("record", song.recordFrames(frames, mode))
+				with self.measure("assemble"):
+					self.assemble(song, frames, midi)
+		else:
+			# Packed dumps are memory-mapped by openPKD, so there's nothing to open here, unless live
+			packed = format == "pkd"
+			if live is not None and (packed or format == "sap"):
+				handle = live
+			elif packed:
+				handle = contextlib.nullcontext()
+			elif format == "sap":
+				handle = open(file, "rb")
+			else:
+				handle = self.openDump(file if live is None else live, format)
+			
+			with handle as fin:
+				self.log("Playing SAP file..." if format == "sap" else "Reading POKEY data...")
 				
-				# AUDF1 AUDC1 AUDF2 AUDC2 AUDF3 AUDC3 AUDF4 AUDC4 AUDCTL
-				for n in range(numPOKEY): # convert to raw data
-					data[n] = bytes.fromhex(data[n])
+				if packed:
+					if live is not None: # Packed dumps are read whole, and can't be mapped
+						mode, dump = self.readPacked(memoryview(fin.read()))
+					else:
+						mode, dump = self.openPKD(file)
+					dump = self.stage("read", dump)
+				elif format == "sap":
+					with self.measure("play"):
+						mode, dump = self.openSAP(fin.read())
+					dump = self.stage("play", dump)
+				else:
+					mode, lines = self.detectMode(self.stage("read", fin))
+					dump = self.stage("parse", self.readDump(lines, mode))
 				
-				ln += 1 # increase line number
+				self.log("Compiling song...")
+				self.convertFrames(
+					song, dump, mode, midi if assembling else None,
+					record=cache is not None or variants is not None
+				)
+			
+			if cache is not None:
+				with self.measure("cache"):
+					cache.save(key, song.saveTimeline())
+		
+		self.log("Done!")
+		# Display AUDCTL features used
+		self.log( "AUDCTL features used:", ", ".join(list(song.features)) if len(song.features) else "None" )
+		if song.numNotesUpdated:
+			self.log("Channel notes computed: %d, reused: %d" % (
+				song.numNotesUpdated, song.numNotesSkipped
+			))
+		
+		if assembling:
+			self.log("Saving MIDI file at \"%s\"" % output)
+			with self.measure("save"):
+				midi.save(output)
+		elif variants is not None:
+			with self.measure("assemble"):
+				self.assembleVariants(song, variants)
+		
+		if self.DetectTempo:
+			with self.measure("detectTempo"):
+				self.detectTempo(song)
+		
+		if self.Stats is not None:
+			with self.measure("stats"):
+				self.Stats.record(song, midi)
+		
+		return midi
+	
+	# Convert POKEY frames, as given by readDump, into a MIDI
+	# Everything here is a pipeline of generators: each frame read is compiled into notes and
+	# turned into MIDI events right away, before the next frame is read
+	# Without a MIDI, frames are only compiled (and recorded, if needed)
+	def convertFrames(self, song, dump, mode, midi, record=False):
+		if self.AutoStop:
+			dump = self.stage("autostop", self.autoStop(song, dump, mode))
+		frames = self.stage("compile", song.compileFrames(dump, mode))
+		# Keep a copy of the compiled frames for the cache, for parallel assembly or for tempo detection
+		if record or self.AssembleJobs > 1 or self.DetectTempo:
+			frames = self.stage("record", song.recordFrames(frames, mode))
+		if midi is None:
+			collections.deque(frames, maxlen=0)
+			return
+		with self.measure("assemble"):
+			self.assemble(song, frames, midi)
+	
+	# Stop a song once it loops, or once it falls silent (see --autostop)
+	# This is a stage between reading frames and compiling them. To find loops, every window of
+	# AUTOSTOP_WINDOW frames (their registers, and how long since the frame before) is hashed with a
+	# rolling hash as frames come in. A window seen before is where the song may be repeating
+	# itself, and once a whole loop has repeated AUTOSTOP_REPEATS times, and for AUTOSTOP_CONFIRM
+	# seconds, the song is stopped after Loops loops. A song also ends once all channels are
+	# silent for SilenceTime seconds.
+	# Frames that may still be cut are held back until we know, and readers stop as soon as we know
+	# where the song ends (see deadline), so nothing past it is even read. Where the song loops
+	# and stops is kept in the song.
+	def autoStop(self, song, frames, mode):
+		dt = DT_NTSC if mode == NTSC else DT_PAL
+		window = AUTOSTOP_WINDOW
+		minLoop = round(AUTOSTOP_MIN_LOOP / dt)
+		maxLoop = round(AUTOSTOP_MAX_LOOP / dt)
+		confirm = round(AUTOSTOP_CONFIRM / dt)
+		maxSilence = round(self.SilenceTime / dt)
+		power = pow(AUTOSTOP_HASH_BASE, window, AUTOSTOP_HASH_MOD) # weight of the frame leaving the window
+		if self.Loops < 1: # the loop is only known once it has repeated, long after it started
+			raise ConversionError("At least 1 loop must be kept.")
+		self.deadline = None
+		
+		numbers = [] # frame numbers
+		tokens = [] # frames, as frames since the one before and their registers
+		windows = dict() # where each window of frames first ended, by hash
+		order = collections.deque() # windows as they were first seen, to forget them once too old
+		h = 0 # hash of the last window
+		candidate = None # (start, length) of a possible loop, in frames of the stream, while checking it
+		pending = collections.deque() # frames that may still be cut
+		heard = False # whether there was any sound yet
+		silent = None # frame the sound stopped at, if it did
+		end = None # frame to stop at, once we know
+		for frame, data in frames:
+			k = len(tokens)
+			token = (frame - numbers[-1] if numbers else frame).to_bytes(4, "little") + b"".join(data)
+			numbers.append(frame)
+			tokens.append(token)
+			pending.append( (frame, data) )
+			
+			if end is None:
+				# Roll the new frame into the window, and the oldest one out
+				h = (h * AUTOSTOP_HASH_BASE + hash(token)) % AUTOSTOP_HASH_MOD
+				if k >= window:
+					h = (h - hash(tokens[k - window]) * power) % AUTOSTOP_HASH_MOD
 				
-				# asapscan outputs one line per frame. In many cases, lines are identical
-				# Since duplicate lines are meaningless (only changes in POKEY state are useful
-				# for detecting musical content), we ignore duplicate lines.
+				# A window seen before may be where the song repeats itself, from where the repetition
+				# begins, which may be before the window. It's a loop once it has repeated as a whole.
+				if candidate is not None:
+					if token != tokens[k - candidate[1]]:
+						candidate = None
+				elif k >= window - 1:
+					while order and numbers[order[0][0]] < frame - maxLoop: # too old to start a loop
+						j, old = order.popleft()
+						if windows.get(old) == j:
+							del windows[old]
+					j = windows.setdefault(h, k)
+					if j == k:
+						order.append( (k, h) )
+					if j != k and numbers[k] - numbers[j] >= minLoop and \
+						tokens[j - window + 1:j + 1] == tokens[k - window + 1:k + 1]:
+							start, length = j - window + 1, k - j
+							while start > 0 and tokens[start - 1] == tokens[start - 1 + length]:
+								start -= 1
+							candidate = (start, length)
 				
-				# If POKEY data hasn't changed, we don't need to do anything
-				if data == last_data: 
-					continue
+				if candidate is not None and k >= candidate[0] + (AUTOSTOP_REPEATS + 1) * candidate[1] - 1 \
+					and frame - numbers[candidate[0]] >= confirm:
+					start, length = candidate
+					song.loopStart = numbers[start]
+					song.loopLength = numbers[start + length] - numbers[start]
+					end = song.loopStart + self.Loops * song.loopLength
+					if end < pending[0][0]: # the loop started too long ago, and it's too late to stop there
+						end = pending[0][0]
+					self.deadline = end
+					self.log("Loop found at %.2f seconds, %.2f seconds long" % (
+						song.loopStart * dt, song.loopLength * dt
+					))
+					candidate = silent = None
 				
-				last_data = data # Update previous state
+				# All 4-bit volumes of all channels of all POKEYs are zero in silent frames
+				# The first silent frame is kept, since that's where the notes end
+				elif any(d[1] & 15 or d[3] & 15 or d[5] & 15 or d[7] & 15 for d in data):
+					heard = True
+					silent = self.deadline = None
+				elif heard and silent is None:
+					silent = frame
+					self.deadline = silent + maxSilence
 				
-				# Write song data (the state changes)
-				song.addState( t, data )
-		
-		# Initialize POKEYs
-		song.initPOKEY(numPOKEY, mode)
+				if silent is not None and frame >= silent + maxSilence:
+					end = silent + 1
+					self.log("Silence from %.2f seconds on" % (silent * dt))
+			
+			if end is not None:
+				while pending and pending[0][0] < end:
+					yield pending.popleft()
+				if frame >= end:
+					break
+				continue
+			
+			# The last window may turn out to be the repetition of a loop, which may have started a bit
+			# earlier, and a possible loop may cut the song anywhere after its first repetition.
+			# Silent frames may be cut too.
+			limit = frame + 1 - minLoop
+			if candidate is not None:
+				start, length = candidate
+				limit = numbers[start] + self.Loops * (numbers[start + length] - numbers[start])
+			if silent is not None:
+				limit = min(limit, silent + 1)
+			while len(pending) > window and pending[0][0] < limit:
+				yield pending.popleft()
 		
-		# Compile song data into notes
-		song.compile()
+		# The song ended before we knew, and trailing silence is cut as well
+		if end is None and silent is not None:
+			end = silent + 1
+		while pending and (end is None or pending[0][0] < end):
+			yield pending.popleft()
 		
-		# Initialize MIDI
+		if end is not None:
+			song.stopFrame = end
+			self.log("Stopping at %.2f seconds" % (song.stopFrame * dt))
+		self.deadline = None
+	
+	# Convert a dump in memory, without printing anything or touching any files
+	# The dump can be given as bytes (in any of the formats of sniffFormat), as a text stream, or
+	# as (frame, data) frames like the ones readDump gives, in which case the mode (NTSC or PAL)
+	# must be given as well. Options are taken from this converter, which isn't changed, so many
+	# conversions can run at once with the same converter.
+	# Returns a ConversionResult, and raises ConversionError if the dump can't be converted.
+	def convertData(self, source, mode=None):
+		converter = copy.copy(self)
+		converter.Verbose = False
+		converter.Stats = None # conversions sharing this converter would all add to the same statistics
+		song = Song(converter)
 		midi = MIDI()
 		
-		# If we want to trim silences, we set the MIDI time offset to the earliest sound
-		if self.TrimSilence:
-			midi.timeOffset = song.earliestSound
-			
+		if isinstance(source, str):
+			raise TypeError("dumps must be given as bytes or a stream, not as a string")
+		elif isinstance(source, (bytes, bytearray, memoryview)):
+			format = converter.sniffFormat(source)
+			if format == "sap":
+				mode, dump = converter.openSAP(bytes(source))
+			elif format == "pkd":
+				mode, dump = converter.readPacked(memoryview(source))
+			else:
+				fin = converter.openDump(io.BytesIO(source), format)
+				mode, lines = converter.detectMode(fin)
+				dump = converter.readDump(lines, mode)
+		elif isinstance(source, io.TextIOBase):
+			mode, lines = converter.detectMode(l.encode("ascii", "replace") for l in source)
+			dump = converter.readDump(lines, mode)
+		else:
+			if mode is None:
+				raise ValueError("the mode (NTSC or PAL) of frames must be given")
+			dump = source
+			if converter.TimeLimit is not None:
+				dt = DT_NTSC if mode == NTSC else DT_PAL
+				dump = itertools.takewhile(lambda frame: frame[0]*dt <= converter.TimeLimit, dump)
+		
+		converter.convertFrames(song, dump, mode, midi if not converter.TempoOnly else None)
+		data = midi.serialize()
+		tempos = converter.guessTempos(song) if converter.DetectTempo else []
+		return ConversionResult(song, midi, data, tempos)
+	
+	# Assemble MIDI events from compiled song frames
+	def assemble(self, song, frames, midi):
 		# If we want to force a known tempo, we change the MIDI tempo and the scale factor
 		if self.ForceTempo is not None:
 			midi.scaleFactor =  self.ForceTempo / DEFAULT_TEMPO
@@ -831,51 +2809,95 @@ class Converter(object):
 		if self.ForceTimebase is not None:
 			midi.timebase = self.ForceTimebase
 		
-		# Each voice is a track
-		for v in song.voices:
-			mt = midi.newTrack()
-			v = v.split(" ")
-			# If each poly is in a separate track or not, we specify it
-			if self.SplitPolyAsTracks:
-				fmt = "%s: Ch %s Poly %s" if self.ShortTrackNames else "POKEY %s Channel %s Poly %s"
-				midi.setTrackName( mt, fmt % (v[0], int(v[1])+1, v[2]) )
-				midi.setInstrumentName( mt, "Poly %s" % v[2] )
-			else:
-				fmt = "%s: Ch %s" if self.ShortTrackNames else "POKEY %s Channel %s"
-				midi.setTrackName( mt, fmt % (v[0], int(v[1])+1) )
-			
-		# Current active notes for each channel
-		active_note = [ [None]*4 for pn in range(song.numPOKEY) ]
+		# Short notes are marked as soon as they end, so we set this up before any events
+		if self.MarkShortNotes:
+			self.log("Marking notes shorter than 1/%d of a beat..." % self.ShortNoteCutoff)
+			midi.filterNotesByLength(1.0 / self.ShortNoteCutoff)
 		
-		# If we're detecting tempo, initialize beat counter
-		if self.DetectTempo:
-			beats = dict()
+		if self.AssembleJobs > 1:
+			tracks = self.assembleParallel(song, frames, midi)
+		else:
+			tracks = self.assembleTracks(song, frames, midi)
+		
+		# Put tracks in the same order as their voices
+		midi.sortTracks(track for track in tracks if track is not None)
+		
+		if self.MarkShortNotes:
+			self.log("%d note%s filtered" % (midi.numFiltered, "s" if midi.numFiltered != 0 else ""))
+	
+	# Assemble the MIDI tracks of a song, for all channels or only the given MIDI channels
+	# Frames are consumed a chunk at a time, as compiled (see Song.compileFrames), and events are
+	# written to the MIDI tracks as they happen. Channels don't depend on each other, and each track
+	# only gets the events of one channel, so each chunk is assembled one channel after the other,
+	# going through the columns of that channel.
+	# Returns the track number of each voice (see below)
+	def assembleTracks(self, song, frames, midi, channels=None):
+		
+		# Each voice is a track, created as soon as the voice is first used
+		# Voices are numbered by MIDI channel and, if split, poly (see below), in the same order as
+		# their names, so tracks are sorted by this number when saving
+		tracks = []
+		
+		# Note state of each MIDI channel (each channel of each POKEY), and what happens to a
+		# playing note when its channel changes
+		states = None
+		transition = self.noteTransition()
+		
+		# Note velocities (loudness) of each 4-bit volume, with boost and 0-127 range
+		velocities = [max(0,min(127,int(vol / 15 * 127 * self.BoostVelocity))) for vol in range(16)]
 		
 		# We begin assembling the MIDI data
-		print("Assembling MIDI file...")
-		for nt, t in enumerate(song.times):
-			for pn in range(song.numPOKEY):
-				state = song.music[t][pn]
-				for ch in range(4):
+		# No events can happen before the earliest sound, so by the time we need to write anything
+		# the compiler already knows when that was
+		for columns in frames:
+			if states is None: # We know how many POKEYs there are once the first frames are in
+				midi.setFrameTime(song.frameTime)
+				states = [ChannelState() for midi_ch in range(song.numPOKEY * 4)]
+				tracks = [None] * (song.numPOKEY * 4 * 8)
+				# Channels to assemble
+				midiChannels = [
+					midi_ch for midi_ch in range(song.numPOKEY * 4) if channels is None or midi_ch in channels
+				]
+			
+			# If we want to trim silences, we set the MIDI frame offset to the earliest sound
+			# There are no events before it, so there's nothing to do until then
+			start = 0
+			if self.TrimSilence:
+				if song.earliestFrame is None:
+					continue
+				start = bisect.bisect_left(columns.frames, song.earliestFrame)
+				midi.frameOffset = song.earliestFrame
+			# All events of a frame happen at the same tick
+			frameTicks = [midi.frameToTicks(frame) for frame in columns.frames[start:]]
+			
+			for midi_ch in midiChannels:
+				pn, ch = midi_ch >> 2, midi_ch & 3
+				channel = states[midi_ch]
+				
+				for ticks, note, vol, poly in zip(
+					frameTicks, columns.notes[midi_ch][start:], columns.vols[midi_ch][start:],
+					columns.polys[midi_ch][start:]
+				):
 					
-					voice = self.voice(pn, ch, state['poly'][ch])
+					# In MIDI jargon, "note velocity" = loudness
 					
-					midi_track = song.voices.index(voice) + 1 # +1 due to conductor track
-					midi_ch = pn*4 + ch
+					# Nothing is playing and nothing will, so there's nothing else to do
+					if channel.note is None and (note == NO_NOTE or vol == 0):
+						continue
 					
-					if state['note'][ch] is None:
+					if note == NO_NOTE:
 						midi_note = None
 					else:
 						# 21 is A0, which we're using at note 0 internally (as in the piano)
-						midi_note = state['note'][ch] + 21
-					
-					# In MIDI jargon, "note velocity" = loudness
+						midi_note = note + 21
 					
-					# 4-bit volume given in the melody
-					vol = state['vol'][ch]
+					voice = midi_ch << 3 | poly if self.SplitPolyAsTracks else midi_ch
+					midi_track = tracks[voice]
+					if midi_track is None:
+						midi_track = tracks[voice] = self.newVoiceTrack(midi, self.voice(pn, ch, poly))
 					
-					# Volume used in MIDI (note velocity), with boost and 0-127 range
-					midi_vol = max(0,min(127,int(vol / 15 * 127 * self.BoostVelocity)))
+					# Volume used in MIDI (note velocity)
+					midi_vol = velocities[vol]
 					
 					# If we are using channel volumes for the volume data, as opposed to note
 					# velocity, then we always play the loudest note, but control the effect with
@@ -890,183 +2912,213 @@ class Converter(object):
 						midi_vol = 127 if vol > 0 else 0
 					
 					# If there's a note being played in the current channel of the current POKEY
-					if active_note[pn][ch] is not None:
-						kill = False
-						
-						if self.AlwaysRetrigger:
-							# If AlwaysRetrigger is set, the previous note is always killed
-							kill = True
-						else:
-							# Otherwise, we use different heuristics to merge notes
-							
-							# For volume changes
-							if self.UseChannelVolume:
-								# If we're using the channel volume, we update it if changed, 
-								# instead of sending a new note. No need to kill.
-								# But ONLY if it's the same note!
-								if active_note[pn][ch]['note'] == midi_note and \
-									active_note[pn][ch]['vol'] != vol and \
-									vol > 0:
-										midi.ctrlChange(midi_track, t, midi_ch, 0x07, ch_vol)
-							else:
-								# Otherwise, we kill if the note is rising. This usually means
-								# a re-trigger of the note in the actual music.
-								# Decaying sounds are usually used for decaying envelopes, so
-								# the natural decay of the MIDI note should work fine.
-								# Of course, only if we have set MergeDecays to True
-								if self.MergeDecays and active_note[pn][ch]['vol'] <= vol:
-									kill = True
-								# Note, however, that if a song uses a ramping up attack, this
-								# just results in many quick notes rising up in volume, which
-								# is usually fine.
-							
-							# For note changes
-							# If new note is different, always cancel old note and retrigger
-							if active_note[pn][ch]['note'] != midi_note:
-								kill = True
-							
-							# Kill if timbre changed while keeping the note fixed
-							# This is usually used for percussive effects
-							# Disabled for now
-							# TODO: verify when this happens to know exactly how to handle it
-							# if active_note[pn][ch]['voice'] != voice:
-								# print("Voice changed", pn, ch)
-								# exit()
-								# kill = True
-							
-							# Always kill if current volume is zero
-							if vol == 0:
-								kill = True
+					if channel.note is not None:
+						action = transition(channel, midi_note, vol)
 						
 						# Send the NoteOff for the current note if marked to kill it
-						if kill:
-							midi.noteOff(
-								active_note[pn][ch]['track'],
-								t,
-								midi_ch,
-								active_note[pn][ch]['note']
-							)
-							active_note[pn][ch] = None # Mark as free to be used
+						if action == NOTE_KILL:
+							midi.noteOff(channel.track, ticks, midi_ch, channel.note)
+							channel.note = None # Mark as free to be used
 						else:
+							if action == NOTE_VOLUME:
+								midi.ctrlChange(midi_track, ticks, midi_ch, 0x07, ch_vol)
 							# Otherwise, update the note state
-							active_note[pn][ch] = {
-								'note': midi_note,
-								'vol': vol,
-								'track': midi_track,
-								'voice': voice
-							}
+							channel.vol = vol
+							channel.track = midi_track
 					
 					# If no active note, a new current note exists and volume is non-zero, we have
 					# a new note being played
-					if active_note[pn][ch] is None and midi_note is not None and vol > 0:
+					if channel.note is None and midi_note is not None and vol > 0:
 						# If we are using the channel volume, we update it here before the note
 						if self.UseChannelVolume:
-							midi.ctrlChange(midi_track, t, midi_ch, 0x07, ch_vol)
+							midi.ctrlChange(midi_track, ticks, midi_ch, 0x07, ch_vol)
 						if self.UseInstruments:
 							if self.CustomInstruments:
-								inst = self.CustomInstruments[state['poly'][ch]]
+								inst = self.CustomInstruments[poly]
 							else:
-								inst = POLY_INSTRUMENT[state['poly'][ch]]
+								inst = POLY_INSTRUMENT[poly]
 							midi.progChange(
-								midi_track, t, midi_ch,
+								midi_track, ticks, midi_ch,
 								inst
 							)
 						
-						# If we are detecting tempo, we add the note-on times to per-voice beat
-						# tracker, as long as the note is below a threshold (lower notes are
-						# more likely to be related to beats), and if it's a tonal note
-						if self.DetectTempo and \
-							state['poly'][ch] in [5,6,7] and \
-							midi_note < BPM_NOTE_THRESHOLD:
-							if voice not in beats:
-								beats[voice] = list()
-							beats[voice].append(round(t / dt)) # append frame to beat
-						
 						# Add Note On event
-						midi.noteOn(midi_track, t, midi_ch, midi_note, midi_vol) 
-						active_note[pn][ch] = {
-							'note': midi_note,
-							'vol': vol,
-							'track': midi_track,
-							'voice': voice
-						} # Update active note
+						midi.noteOn(midi_track, ticks, midi_ch, midi_note, midi_vol) 
+						channel.note = midi_note # Update active note
+						channel.vol = vol
+						channel.track = midi_track
 		
 		# Once the track is done
 		# Kill all leftover notes after a small offset
-		offset = dt # in seconds
-		for pn in range(song.numPOKEY):
-			for ch in range(4):
-				voice = self.voice(pn, ch, state['poly'][ch])
+		# The voice checked uses the polys of the last POKEY, and the Note Offs go to the last MIDI
+		# channel, whatever the channel. That's how it's always been done.
+		offset = 1 # in frames
+		if states is not None:
+			frame = columns.frames[-1]
+			lastPOKEY = (song.numPOKEY - 1) * 4
+			for midi_ch in midiChannels:
+				pn, ch = midi_ch >> 2, midi_ch & 3
+				voice = self.voice(pn, ch, columns.polys[lastPOKEY + ch][-1])
 				if voice not in song.voices:
 					continue
-				midi_track = song.voices.index(voice) + 1
-				if active_note[pn][ch] is not None:
+				channel = states[midi_ch]
+				if channel.note is not None:
 					midi.noteOff(
-						active_note[pn][ch]['track'],
-						t + offset,
-						midi_ch,
-						active_note[pn][ch]['note']
+						channel.track,
+						midi.frameToTicks(frame + offset),
+						song.numPOKEY*4 - 1,
+						channel.note
 					)
 		
-		if self.MarkShortNotes:
-			midi.filterNotesByLength(1.0 / self.ShortNoteCutoff)
+		return tracks
+	
+	# Assemble the MIDI tracks of a song with a pool of worker processes, each taking some channels
+	# Channels don't depend on each other, and each voice belongs to a single channel, so each
+	# worker writes its own tracks, exactly as assembleTracks would. Workers get the whole song as
+	# a timeline (see Song.saveTimeline), so frames must be recorded before they get here.
+	def assembleParallel(self, song, frames, midi):
+		for columns in frames: # Compile the whole song first
+			pass
+		numChannels = song.numPOKEY * 4
+		if numChannels == 0:
+			return []
 		
-		print("Saving MIDI file at \"%s\"" % output)
-		midi.save(output)
+		# Most of the work is in channels producing sound, so channels are shared out for each
+		# worker to have about as many sounding frames as the others, busiest channels first
+		jobs = min(self.AssembleJobs, numChannels)
+		shares = [set() for n in range(jobs)]
+		load = [0] * jobs
+		sounding = song.soundingFrames()
+		for midi_ch in sorted(range(numChannels), key=lambda midi_ch: -sounding[midi_ch]):
+			n = load.index(min(load))
+			shares[n].add(midi_ch)
+			load[n] += sounding[midi_ch]
 		
-		if self.DetectTempo:
-			converter.detectTempo(beats, mode)
+		timeline = song.saveTimeline()
+		settings = (midi.timebase, midi.tempo, midi.scaleFactor, midi.shortNoteCutoff)
+		tasks = [(self, timeline, settings, share) for share in shares if share]
+		
+		# Tracks are added in the order the workers were given, and sorted by voice later
+		tracks = [None] * (numChannels * 8)
+		with multiprocessing.Pool(len(tasks)) as pool:
+			for voiceTracks, numFiltered, numNoteOns in pool.imap(assembleChannels, tasks):
+				for voice, track in voiceTracks:
+					tracks[voice] = len(midi.tracks)
+					midi.tracks.append(track)
+				midi.numFiltered += numFiltered
+				midi.numNoteOns += numNoteOns
+		return tracks
 	
-	# Tempo/bpm detection function
-	# This is a VERY rudimentary algorithm, but it should work well enough for well-behaved songs
-	def detectTempo(self, beats, mode):
-		if mode == NTSC:
-			dt = DT_NTSC
-			fps = FPS_NTSC
+	# Assemble and save a MIDI file for each variant of a conversion, from the same compiled song
+	# Variants are (name, converter, output), with converters that only change how the song is
+	# assembled (see compileOptions). Variants don't depend on each other, so they're assembled in a
+	# pool of AssembleJobs worker processes, which get the song as a timeline (see Song.saveTimeline).
+	def assembleVariants(self, song, variants):
+		timeline = song.saveTimeline()
+		tasks = [(converter, timeline, output) for name, converter, output in variants]
+		jobs = min(self.AssembleJobs, len(tasks))
+		self.log("Assembling %d variant%s%s..." % (
+			len(tasks), "s" if len(tasks) != 1 else "", " with %d jobs" % jobs if jobs > 1 else ""
+		))
+		with multiprocessing.Pool(jobs) if jobs > 1 else contextlib.nullcontext() as pool:
+			results = pool.imap(assembleVariant, tasks) if pool is not None else map(assembleVariant, tasks)
+			for (name, converter, output), numNotes in zip(variants, results):
+				self.log("    %s: %d notes, saved at \"%s\"" % (name, numNotes, output))
+	
+	# Get the note transition function for the current options (see ChannelState)
+	def noteTransition(self):
+		if self.AlwaysRetrigger:
+			return retriggerNote
+		if self.UseChannelVolume:
+			return channelVolumeNote
+		if self.MergeDecays:
+			return mergeDecaysNote
+		return holdNote
+	
+	# Create the MIDI track for a voice
+	def newVoiceTrack(self, midi, voice):
+		mt = midi.newTrack()
+		v = voice.split(" ")
+		# If each poly is in a separate track or not, we specify it
+		if self.SplitPolyAsTracks:
+			fmt = "%s: Ch %s Poly %s" if self.ShortTrackNames else "POKEY %s Channel %s Poly %s"
+			midi.setTrackName( mt, fmt % (v[0], int(v[1])+1, v[2]) )
+			midi.setInstrumentName( mt, "Poly %s" % v[2] )
 		else:
-			dt = DT_PAL
-			fps = FPS_PAL
-		
-		# For each voice
-		guesses = set()
-		for v in beats:
-			b = []
-			for i in range(1, len(beats[v])):
-				b.append( beats[v][i] - beats[v][i-1] ) # add to a list of time differences
-			
-			if len(b) > BPM_COUNT_THRESHOLD:
-				b = sorted(b)
-				guesses.add(b[ len(b) // 2 ]) # add median difference as a possible fpb
-		
-		# If there ARE guesses, let's work on them
-		if len(guesses) > 0:
-			suggestions = set() # list of reasonable suggestions
-			fracs = [1,1/2,1/4,1/8,2,4,8,3/4,1/3,2/3,3,6,5/4,4/3] # list of reasonable fractions
-			# We'll find all reasonable fractions of the potentially reasonable bpms found earlier
-			for guess in guesses:
-				for f in fracs:
-					fpb = guess*f # suggested guess
-					if fpb >= FPB_LIMITS[0] and fpb <= FPB_LIMITS[1]: # is it "reasonable"? 
-						suggestions.add(round(fpb))
-			
-			# If there are reasonable suggestions
-			if len(suggestions) > 0:
-				# We display them
-				print("Possible tempos (in bpm):")
-				for c, s in enumerate(reversed(sorted(suggestions))):
-					bpm = 60 / (dt * s) # frames per beat to beats per minute - ToDo: shouldn't this be 60/50 for NTSC/PAL?
-					print("    %16.12f" % bpm, end="")
-					if c % 4 == 3 or c == len(suggestions)-1:
-						print("")
-				print("Note: using high precision tempos with --bpm avoids notes drifting out of alignment.")
-				return
+			fmt = "%s: Ch %s" if self.ShortTrackNames else "POKEY %s Channel %s"
+			midi.setTrackName( mt, fmt % (v[0], int(v[1])+1) )
+		return mt
+	
+	# Tempo/bpm detection function
+	# Works on the recorded frames of the song, so it doesn't need the MIDI at all (see guessTempos)
+	def detectTempo(self, song):
+		tempos = self.tempos = self.guessTempos(song)
+		
+		# If there are reasonable suggestions, we display them
+		if len(tempos) > 0:
+			self.log("Possible tempos (in bpm), from most to least likely, and how well they fit:")
+			for c, (bpm, confidence) in enumerate(tempos):
+				self.log("    %16.12f (%.2f)" % (bpm, confidence), end="")
+				if c % 4 == 3 or c == len(tempos)-1:
+					self.log("")
+			self.log("Note: using high precision tempos with --bpm avoids notes drifting out of alignment.")
+			return
+		
+		self.log("Couldn't guess any tempo. Sorry!")
+	
+	# Guess possible tempos from the note onsets of the recorded frames of a song
+	# Notes on the beat repeat one beat later, and two, and so on, so each number of frames per beat
+	# (within FPB_LIMITS) is scored by the autocorrelation of the onsets at 1 to TEMPO_BEATS beats
+	# (see Song.onsetAutocorrelation). Whatever repeats every beat also repeats every two beats,
+	# so scores are weighted by how likely each tempo is, around TEMPO_PRIOR.
+	# Returns up to TEMPO_CANDIDATES (bpm, confidence) pairs, from the most likely tempo to the least.
+	# Confidences are from 0 to 1, where 1 is a tempo at which onsets always repeat.
+	def guessTempos(self, song):
+		dt = song.frameTime
+		ac = song.onsetAutocorrelation(FPB_LIMITS[1] * TEMPO_BEATS)
+		if ac is None:
+			return []
 		
-		print("Couldn't guess any tempo. Sorry!")
+		tempos = []
+		for fpb in range(FPB_LIMITS[0], FPB_LIMITS[1] + 1):
+			# frames per beat to beats per minute - ToDo: shouldn't this be 60/50 for NTSC/PAL?
+			bpm = 60 / (dt * fpb)
+			score = sum(ac[fpb * n] for n in range(1, TEMPO_BEATS + 1)) / TEMPO_BEATS
+			likelihood = math.exp(-0.5 * (math.log2(bpm / TEMPO_PRIOR) / TEMPO_PRIOR_WIDTH)**2)
+			if score > 0:
+				tempos.append( (bpm, min(1.0, score * likelihood)) )
+		tempos.sort(key=lambda tempo: -tempo[1])
+		return tempos[:TEMPO_CANDIDATES]
 
 
-# If running by itself, handle command line options
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="POKEY2MIDI v%s by LucasVB/1ucasvb (http://1ucasvb.com). Converts textual POKEY dumps from asapscan into MIDI files." % VERSION)
+# Assemble some channels of a song in a worker process (see Converter.assembleParallel)
+# Takes (converter, timeline, MIDI settings, MIDI channels), and returns the tracks of each voice,
+# and MIDI counters
+def assembleChannels(task):
+	converter, timeline, settings, channels = task
+	song = Song(converter)
+	midi = MIDI()
+	midi.timebase, midi.tempo, midi.scaleFactor, midi.shortNoteCutoff = settings
+	tracks = converter.assembleTracks(song, song.loadTimeline(timeline), midi, channels)
+	voiceTracks = [(voice, midi.tracks[t]) for voice, t in enumerate(tracks) if t is not None]
+	return voiceTracks, midi.numFiltered, midi.numNoteOns
+
+# Assemble a variant of a song in a worker process (see Converter.assembleVariants)
+# Takes (converter, timeline, output), saves the MIDI file, and returns the number of notes
+def assembleVariant(task):
+	converter, timeline, output = task
+	converter = copy.copy(converter)
+	converter.Verbose = False
+	converter.AssembleJobs = 1 # Workers can't have workers of their own
+	song = Song(converter)
+	midi = MIDI()
+	converter.assemble(song, song.loadTimeline(timeline), midi)
+	midi.save(output)
+	return midi.numNoteOns
+
+# Command line options
+def makeArgumentParser():
+	parser = argparse.ArgumentParser(description="POKEY2MIDI v%s by LucasVB/1ucasvb (http://1ucasvb.com). Converts POKEY dumps from asapscan, or SAP files, into MIDI files." % VERSION)
 	parser.add_argument('--all', action='store_true', help="Use all notes by always retriggering. Useful for when notes are being missed. Overrides note merging.")
 	parser.add_argument('--notrim', action='store_false', help="Do not trim initial silence, which happens by default.")
 	parser.add_argument('--nosplit', action='store_false', help="Do not split different polynomial counter settings for channels as separate instrument tracks, which happens by default.")
@@ -1078,20 +3130,41 @@ if __name__ == "__main__":
 	parser.add_argument('--shortnames', action='store_true', help="Use shorter MIDI track names.")
 	parser.add_argument('--setinst', metavar='n,n,n,n,n,n,n,n', nargs=1, type=str, help="Specify which General MIDI instruments to assign to each of the 8 poly settings. No spaces, n from 0 to 127. The last three are the most important for melody and default to: square wave=80, brass+lead=87, square wave=80.")
 	parser.add_argument('--boost', metavar='factor', nargs=1, type=float, help="Multiply note velocities by a factor. Useful if MIDI is too quiet. Use a large number (> 16) to make all notes have the same max loudness (useful for killing off POKEY effects that don't translate well to MIDI).")
-	parser.add_argument('--maxtime', metavar='time', nargs=1, type=float, help="By default, asapscan dumps 15 minutes (!) of POKEY data. Use this to ignore stuff after some point. Value is given is seconds, fractional values are allowed.")
+	parser.add_argument('--maxtime', metavar='time', nargs=1, type=float, help="By default, asapscan dumps 15 minutes (!) of POKEY data, and SAP files are played for as long. Use this to ignore stuff after some point, or to play SAP files for longer. Value is given is seconds, fractional values are allowed.")
+	parser.add_argument('--subsong', metavar='N', nargs=1, type=int, help="Subsong of SAP files to play, from 0. Default is the SAP file's default subsong.")
+	parser.add_argument('--autostop', action='store_true', help="Stop once the song starts repeating itself, keeping the intro and --loops loops, or once it's silent for --silence seconds. Where the loop starts and how long it is are displayed. Dumps and SAP files usually go on for much longer than the song, so this saves a lot of time.")
+	parser.add_argument('--loops', metavar='N', nargs=1, type=int, help="Number of loops to keep with --autostop. Default is %d." % AUTOSTOP_LOOPS)
+	parser.add_argument('--silence', metavar='seconds', nargs=1, type=float, help="Seconds of silence that end a song with --autostop. Default is %d." % AUTOSTOP_SILENCE)
+	parser.add_argument('--follow', action='store_true', help="Convert input_file while it's still being written, such as by asapscan, reading new lines as they come in. It's taken as finished once it hasn't grown for %d seconds, or at the end of the POKEY data. Dumps from stdin are always read like this, until the pipe is closed. Such dumps aren't cached with --cache." % FOLLOW_TIMEOUT)
 	parser.add_argument('--bpm', nargs=1, type=float, help="Assume a given tempo in beats per minute (bpm), as precisely as you want. Default is %d. If the song's bpm is known precisely, this option makes the MIDI notes align with the beats, which makes using the MIDI in other places much easier. Doesn't work if the song has a dynamic tempo." % DEFAULT_TEMPO)
-	parser.add_argument('--findbpm', action='store_true', help="Attempts to post-process the data to automatically detect tempo/bpm by using a simple algorithm. The best guesses are merely displayed after the conversion. Run again with one of these guesses as a parameter with --bpm to see if events aligned properly. Cannot be used with --all, but might work better with --usevol.")
+	parser.add_argument('--findbpm', action='store_true', help="Attempts to post-process the data to automatically detect tempo/bpm, from how often notes start. The best guesses are merely displayed after the conversion, from the most to the least likely, with how well they fit from 0 to 1. Run again with one of these guesses as a parameter with --bpm to see if events aligned properly.")
+	parser.add_argument('--tempoonly', action='store_true', help="Only detect the tempo, as with --findbpm, without making a MIDI file. This is much faster, so it's handy to find the tempos of many files with --batch, whose summary then shows the most likely tempo of each file.")
 	parser.add_argument('--timebase', nargs=1, type=int, help="Force a given MIDI timebase, the number of ticks in a beat (quarter note). Default is %d." % DEFAULT_TIMEBASE)
+	parser.add_argument('--cache', metavar='dir', nargs='?', const=CACHE_DIR, type=str, help="Cache compiled songs, so converting the same dump again with different options is faster. Songs are cached in the given directory, or %s by default." % CACHE_DIR)
+	parser.add_argument('--cachesize', metavar='MB', nargs=1, type=float, help="Maximum size of the --cache directory, in MB. The least recently used songs are removed when it's full. Default is %d." % CACHE_SIZE)
+	parser.add_argument('--batch', metavar='path', nargs='+', type=str, help="Convert many dumps at once, in parallel. Paths can be dump files or directories, in which case all dumps in them (.txt, .txt.bz2, .txt.gz, .txt.xz, .txt.zst and .pkd files) and SAP files are converted. MIDI files are saved next to each dump, unless --outdir is given. Replaces input_file and output_file.")
+	parser.add_argument('--jobs', metavar='N', nargs=1, type=int, help="Number of conversions to run at the same time with --batch, worker processes for --serve, or variants to assemble at the same time with --variants. Default is the number of CPUs. For a single conversion, number of processes to assemble MIDI channels in, which speeds up long songs. Default is 1.")
+	parser.add_argument('--outdir', metavar='dir', nargs=1, type=str, help="Directory to save MIDI files to with --batch, or packed dumps to with --pack.")
+	parser.add_argument('--overrides', metavar='file', nargs=1, type=str, help="JSON file with options for specific files in --batch. It maps file names (with or without extensions) to lists of extra command line options, such as {\"Sweet_(subsong 0)\": [\"--bpm\", \"124.651864035088\"]}.")
+	parser.add_argument('--variants', metavar='file', nargs=1, type=str, help="JSON file with variants of the conversion, to make many MIDI files from the same dump, reading and compiling it just once. It maps variant names to lists of extra command line options, such as {\"usevol\": [\"--usevol\", \"--useinst\"], \"short\": [\"--shortnotes\", \"16\"]}. A MIDI file is saved for each variant, named after output_file and the variant, such as song_usevol.mid. Variants can't change --maxtime, --subsong, --autostop, --loops or --silence, and can't be used with --tempoonly.")
+	parser.add_argument('--summary', metavar='file', nargs=1, type=str, help="Also save the --batch summary as a JSON file.")
+	parser.add_argument('--pack', metavar='path', nargs='+', type=str, help="Convert dumps into the compact .pkd format, instead of converting them to MIDI. Packed dumps are converted much faster than text dumps, and are used just like them. Paths can be dump files or directories, like with --batch. Packed dumps are saved next to each dump, unless --outdir is given.")
+	parser.add_argument('--serve', metavar='address', nargs=1, type=str, help="Run a conversion server, which converts dumps sent to it over HTTP with a pool of --jobs worker processes. The address is a port or host:port to listen on (localhost by default), or the path of a Unix socket. POST a dump to /convert, with options as the query (such as /convert?usevol&bpm=120), to get its MIDI file back. Only options of the conversion itself can be given, not those that read or write files. GET /health for the state of the server.")
+	parser.add_argument('--timeout', metavar='seconds', nargs=1, type=float, help="Maximum time for a --serve conversion, including waiting for a free worker. Default is %d." % SERVE_TIMEOUT)
+	parser.add_argument('--maxpending', metavar='N', nargs=1, type=int, help="Maximum number of --serve requests waiting for a free worker. Busier servers turn requests down. Default is %d." % SERVE_MAX_PENDING)
+	parser.add_argument('--profile', action='store_true', help="Report where the conversion spends its time: time spent in each stage, frames read and kept, note computations, MIDI events written and peak memory.")
+	parser.add_argument('--profilemem', action='store_true', help="Also trace peak memory use of Python objects with tracemalloc. This slows the conversion down several times, so stage times are much less meaningful. Implies --profile.")
+	parser.add_argument('--stats-json', metavar='file', nargs=1, type=str, help="Save the --profile report as a JSON file. Implies --profile.")
+	parser.add_argument('--cprofile', metavar='file', nargs=1, type=str, help="Also run the conversion under cProfile, and save its statistics to a file, to be read with the pstats module or tools such as snakeviz.")
 	parser.add_argument('--debug', action='store_true', help=argparse.SUPPRESS)
-	parser.add_argument('input', metavar='input_file', type=str, nargs=1, help="Input POKEY dump text file.")
-	parser.add_argument('output', metavar='output_file', type=str, nargs="?", help="MIDI output file. If not specified, will output to the same path, with a '.mid' extension")
-	args = parser.parse_args()
-	
+	parser.add_argument('input', metavar='input_file', type=str, nargs="?", help="Input POKEY dump text file, or SAP file. Use - to read a dump from stdin, such as from asapscan -d, and convert it as it comes in.")
+	parser.add_argument('output', metavar='output_file', type=str, nargs="?", help="MIDI output file. If not specified, will output to the same path, with a '.mid' extension instead of the dump's (such as .txt.bz2)")
+	return parser
+
+# Create a converter with the options given in the command line
+def makeConverter(args):
 	converter = Converter()
 	
-	if args.debug:
-		DEBUG_POLYS = True
-	
 	converter.AlwaysRetrigger = args.all
 	converter.MergeDecays = args.nomerge
 	converter.TrimSilence = args.notrim
@@ -1100,11 +3173,21 @@ if __name__ == "__main__":
 	converter.UseChannelVolume = args.usevol
 	converter.PitchOnly = args.pitchonly
 	converter.UseInstruments = args.useinst
-	converter.DetectTempo = args.findbpm
+	converter.DetectTempo = args.findbpm or args.tempoonly
+	converter.TempoOnly = args.tempoonly
+	converter.DebugPolys = args.debug
 	if args.boost is not None:
 		converter.BoostVelocity = args.boost[0]
 	if args.maxtime is not None:
 		converter.TimeLimit = args.maxtime[0]
+	if args.subsong is not None:
+		converter.Subsong = args.subsong[0]
+	converter.AutoStop = args.autostop
+	converter.Follow = args.follow
+	if args.loops is not None:
+		converter.Loops = args.loops[0]
+	if args.silence is not None:
+		converter.SilenceTime = args.silence[0]
 	if args.bpm is not None:
 		converter.ForceTempo = args.bpm[0]
 	if args.timebase is not None:
@@ -1113,22 +3196,521 @@ if __name__ == "__main__":
 		insts = [min(127,max(0,int(i) if len(i) else 0)) for i in args.setinst[0].split(',')]
 		insts += [0]*(8-len(insts))
 		converter.CustomInstruments = insts
+	if args.cache is not None:
+		converter.CacheDir = args.cache
+	if args.cachesize is not None:
+		converter.CacheSize = args.cachesize[0]
 	if args.shortnotes is not None:
 		converter.MarkShortNotes = True
 		converter.SplitPolyAsTracks = False
 		converter.ShortNoteCutoff = args.shortnotes[0]
 	
-	input = args.input[0]
+	return converter
+
+# Name of a dump file without its extension, such as "song" for song.txt.bz2
+# Only the dump extensions are taken off, so song.v1.txt.bz2 is song.v1
+def dumpName(path):
+	name = os.path.basename(path)
+	for extension in sorted(DUMP_EXTENSIONS, key=len, reverse=True):
+		if name.lower().endswith(extension):
+			return name[:-len(extension)]
+	return os.path.splitext(name)[0]
+
+# Default output path for an input file
+def outputPath(input):
+	return os.path.join(os.path.dirname(os.path.realpath(input)), dumpName(input) + ".mid")
+
+# Create the variants of a conversion given with --variants
+# Returns (name, converter, output) for each (see Converter.convert)
+def makeVariants(parser, args, converter, output):
+	with open(args.variants[0], "rt") as fv:
+		variants = json.load(fv)
+	if converter.TempoOnly: # Variants are all about the MIDI files
+		parser.error("--tempoonly can't be used with --variants")
+	base = os.path.splitext(output)[0]
+	result = []
+	for name, options in variants.items():
+		# Options of each variant are parsed on top of the common ones
+		variant = makeConverter(parser.parse_args(options, argparse.Namespace(**vars(args))))
+		if variant.TempoOnly:
+			parser.error("variant \"%s\" can't use --tempoonly, which makes no MIDI file" % name)
+		if variant.compileOptions() != converter.compileOptions():
+			parser.error("variant \"%s\" changes how the song is compiled (--maxtime, --subsong, --autostop, --loops or --silence)" % name)
+		result.append( (name, variant, "%s_%s.mid" % (base, name)) )
+	return result
+
+# Convert a single file of a batch
+# Takes (input, output, args), and returns a summary of how it went. Any failure is caught here,
+# so it doesn't affect the rest of the batch.
+def batchConvert(task):
+	input, output, args = task
+	result = {'input': input, 'output': output, 'ok': False, 'time': 0.0, 'notes': 0, 'tempos': [], 'error': None}
+	log = io.StringIO() # conversion messages are kept to themselves
+	start = time.perf_counter()
+	try:
+		converter = makeConverter(args)
+		with contextlib.redirect_stdout(log):
+			midi = converter.convert(input, output)
+		if midi is None:
+			raise RuntimeError("File \"%s\" doesn't exist" % input)
+		result['ok'] = True
+		result['notes'] = midi.numNoteOns
+		result['tempos'] = converter.tempos
+	except Exception as e:
+		result['error'] = str(e) or type(e).__name__
+	result['time'] = time.perf_counter() - start
+	return result
+
+# Find all dumps in the given batch paths
+def findDumps(paths):
+	dumps = []
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if name.lower().endswith(DUMP_EXTENSIONS):
+					dumps.append(os.path.join(path, name))
+		else:
+			dumps.append(path)
+	return dumps
+
+# Pack dumps into .pkd files
+def packDumps(args):
+	converter = makeConverter(args)
+	if args.outdir is not None:
+		os.makedirs(args.outdir[0], exist_ok=True)
+	written = dict() # packed dumps written so far, and the dumps they came from
+	for input in findDumps(args.pack):
+		if input.lower().endswith(".pkd"): # already packed
+			continue
+		name = dumpName(input) + ".pkd"
+		if args.outdir is not None:
+			output = os.path.join(args.outdir[0], name)
+		else:
+			output = os.path.join(os.path.dirname(os.path.realpath(input)), name)
+		key = os.path.normcase(os.path.realpath(output))
+		if key in written: # Don't replace what we just packed
+			print("ERROR\n\"%s\" would replace \"%s\", packed from \"%s\"" % (input, output, written[key]))
+			continue
+		written[key] = input
+		try:
+			converter.packDump(input, output)
+		except ConversionError as e: # the other dumps can still be packed
+			print("ERROR\n%s" % e)
+
+# Convert many files in parallel, with a pool of worker processes, and print a summary at the end
+def convertBatch(parser, args):
+	# Options for specific files
+	overrides = dict()
+	if args.overrides is not None:
+		with open(args.overrides[0], "rt") as fo:
+			overrides = json.load(fo)
+	
+	tasks = []
+	for input in findDumps(args.batch):
+		name = os.path.basename(input)
+		if args.outdir is not None:
+			output = os.path.join(args.outdir[0], dumpName(input) + ".mid")
+		else:
+			output = outputPath(input)
+		# Options given for this file are parsed on top of the common ones
+		extra = overrides.get(name, overrides.get(dumpName(input), []))
+		tasks.append( (input, output, parser.parse_args(extra, argparse.Namespace(**vars(args)))) )
+	
+	# Dumps that would be saved as the same MIDI file would overwrite each other
+	outputs = dict()
+	for input, output, options in tasks:
+		key = os.path.normcase(os.path.realpath(output))
+		if key in outputs:
+			parser.error("\"%s\" and \"%s\" would both be saved as \"%s\"" % (outputs[key], input, output))
+		outputs[key] = input
+	
+	if args.outdir is not None:
+		os.makedirs(args.outdir[0], exist_ok=True)
+	
+	jobs = args.jobs[0] if args.jobs is not None else os.cpu_count()
+	print("Converting %d file%s with %d job%s..." % (
+		len(tasks), "s" if len(tasks) != 1 else "", jobs, "s" if jobs != 1 else ""
+	))
+	start = time.perf_counter()
+	results = []
+	with multiprocessing.Pool(jobs) as pool:
+		for result in pool.imap_unordered(batchConvert, tasks):
+			print("    %-4s %s" % ("OK" if result['ok'] else "FAIL", result['input']))
+			results.append(result)
+	elapsed = time.perf_counter() - start
+	
+	# Summary, in the same order as the files were given
+	order = [task[0] for task in tasks]
+	results.sort(key=lambda r: order.index(r['input']))
+	failures = [r for r in results if not r['ok']]
+	print("Summary:")
+	if args.findbpm or args.tempoonly: # the most likely tempo of each file, and how well it fits
+		print("    %8s  %8s  %18s  %s" % ("Time (s)", "Notes", "Tempo (bpm)", "File"))
+		for r in results:
+			tempo = "%11.6f (%.2f)" % r['tempos'][0] if r['tempos'] else "none"
+			print("    %8.2f  %8s  %18s  %s" % (
+				r['time'], r['notes'] if r['ok'] else "FAILED", tempo if r['ok'] else "", r['input']
+			))
+	else:
+		print("    %8s  %8s  %s" % ("Time (s)", "Notes", "File"))
+		for r in results:
+			print("    %8.2f  %8s  %s" % (r['time'], r['notes'] if r['ok'] else "FAILED", r['input']))
+	print("%d converted, %d failed, in %.2f seconds" % (len(results) - len(failures), len(failures), elapsed))
+	for r in failures:
+		print("Error in \"%s\": %s" % (r['input'], r['error']))
+	
+	if args.summary is not None:
+		with open(args.summary[0], "wt") as fs:
+			json.dump({'time': elapsed, 'files': results}, fs, indent=4)
+	
+	if failures:
+		sys.exit(1)
+
+# Conversion server
+# Converting a short dump takes less time than starting Python and importing POKEY2MIDI, so
+# --serve keeps a pool of worker processes ready, and converts dumps sent to it over HTTP, either
+# on a local port or on a Unix socket:
+#     POST /convert?usevol&bpm=120    converts the dump in the request body, with the given command
+#                                     line options, and replies with the MIDI file
+#     GET /health                     replies with the state of the server, as JSON
+# Each worker converts one dump at a time, in memory (see Converter.convertData). Requests wait for
+# a free worker, up to a limit, and conversions that take too long are stopped.
+
+# A worker process of the conversion server
+# Gets (args, dump) requests from a pipe, and sends back (True, ConversionResult) or (False, error)
+def serverWorker(conn):
+	sys.stdout = open(os.devnull, "w") # converters don't print, but makeConverter can
+	while True:
+		try:
+			args, data = conn.recv()
+		except EOFError: # the server is gone
+			return
+		try:
+			conn.send( (True, makeConverter(args).convertData(data)) )
+		except ConversionError as e:
+			conn.send( (False, str(e)) )
+		except Exception as e:
+			conn.send( (False, "%s: %s" % (type(e).__name__, e)) )
+
+# Raised when a conversion server can't take any more requests, or a conversion takes too long
+class ServerBusy(Exception):
+	pass
+
+class ServerTimeout(Exception):
+	pass
+
+# Conversion server state: worker processes, limits and statistics
+class ConversionService(object):
+	def __init__(self, workers, timeout=SERVE_TIMEOUT, maxPending=SERVE_MAX_PENDING):
+		self.parser = makeArgumentParser()
+		self.timeout = timeout # maximum time for a conversion, including waiting for a worker
+		self.maxPending = maxPending # maximum number of requests waiting for a worker
+		self.lock = threading.Lock()
+		self.idle = queue.Queue() # workers waiting for requests
+		self.numWorkers = workers
+		for n in range(workers): # every worker is started up front
+			self.idle.put(self.startWorker())
+		self.start = time.time()
+		self.counters = {
+			'pending': 0, 'busy': 0, 'converted': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0
+		}
+		self.conversionTime = 0.0 # total time spent converting, in seconds
+	
+	# Start a worker process, returning (process, pipe)
+	def startWorker(self):
+		conn, child = multiprocessing.Pipe()
+		process = multiprocessing.Process(target=serverWorker, args=(child,), daemon=True)
+		process.start()
+		child.close()
+		return process, conn
+	
+	def count(self, counter, n=1):
+		with self.lock:
+			self.counters[counter] += n
+	
+	# Parse the options of a request, given as (name, value) pairs (see SERVE_OPTIONS)
+	# They're all checked before parsing, so the parser never has to exit or take an input file
+	# Raises ValueError if they're wrong
+	def parseOptions(self, options):
+		argv = []
+		for name, value in options:
+			if name not in SERVE_OPTIONS:
+				raise ValueError("unrecognized option: %s" % name)
+			kind = SERVE_OPTIONS[name]
+			if kind is None:
+				if value:
+					raise ValueError("option %s doesn't take a value" % name)
+				argv.append("--" + name)
+				continue
+			if not value:
+				raise ValueError("option %s needs a value" % name)
+			try:
+				kind(value)
+			except ValueError:
+				raise ValueError("invalid value for option %s: %s" % (name, value))
+			argv.append("--%s=%s" % (name, value)) # joined, so values can start with a dash
+		return self.parser.parse_args(argv)
+	
+	# Convert a dump with a worker
+	# Returns a ConversionResult, and raises ServerBusy, ServerTimeout or ConversionError
+	def convert(self, args, data):
+		with self.lock:
+			if self.counters['pending'] >= self.maxPending + self.numWorkers:
+				self.counters['rejected'] += 1
+				raise ServerBusy("too many requests")
+			self.counters['pending'] += 1
+		start = time.perf_counter()
+		try:
+			try:
+				worker = self.idle.get(timeout=self.timeout)
+			except queue.Empty:
+				self.count('timeouts')
+				raise ServerTimeout("no worker was free in time")
+			self.count('busy')
+			try:
+				process, conn = worker
+				conn.send( (args, data) )
+				if not conn.poll(max(0, self.timeout - (time.perf_counter() - start))):
+					# A worker can't be interrupted, so it's replaced
+					process.kill()
+					process.join()
+					conn.close()
+					worker = self.startWorker()
+					self.count('timeouts')
+					raise ServerTimeout("conversion took longer than %g seconds" % self.timeout)
+				ok, result = conn.recv()
+			except (EOFError, OSError): # the worker died
+				process.kill()
+				process.join()
+				conn.close()
+				worker = self.startWorker()
+				self.count('failed')
+				raise ConversionError("conversion worker died")
+			finally:
+				self.idle.put(worker)
+				self.count('busy', -1)
+		finally:
+			self.count('pending', -1)
+		
+		if not ok:
+			self.count('failed')
+			raise ConversionError(result)
+		with self.lock:
+			self.counters['converted'] += 1
+			self.conversionTime += time.perf_counter() - start
+		return result
+	
+	# State of the server, as given by /health
+	def health(self):
+		with self.lock:
+			health = dict(self.counters)
+			health['conversionTime'] = self.conversionTime
+		health['status'] = "ok"
+		health['version'] = VERSION
+		health['workers'] = self.numWorkers
+		health['uptime'] = time.time() - self.start
+		return health
+	
+	# Stop all workers
+	def close(self):
+		while not self.idle.empty():
+			process, conn = self.idle.get()
+			conn.close()
+			process.join(1)
+
+# HTTP request handler of the conversion server
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+	server_version = "POKEY2MIDI/%s" % VERSION
+	protocol_version = "HTTP/1.1" # keep connections open between requests
+	
+	def reply(self, status, body, contentType="application/json", headers=()):
+		if contentType == "application/json":
+			body = (json.dumps(body) + "\n").encode()
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		for header in headers:
+			self.send_header(*header)
+		self.end_headers()
+		self.wfile.write(body)
+	
+	# Reply with an error
+	# If the request body wasn't read, the connection can't be used for other requests
+	def error(self, status, message, close=False):
+		self.reply(status, {'error': message}, headers=[("Connection", "close")] if close else ())
+	
+	def do_GET(self):
+		if urllib.parse.urlsplit(self.path).path == "/health":
+			self.reply(200, self.server.service.health())
+		else:
+			self.error(404, "not found")
+	
+	def do_POST(self):
+		url = urllib.parse.urlsplit(self.path)
+		if url.path != "/convert":
+			self.error(404, "not found", close=True)
+			return
+		if "Content-Length" not in self.headers:
+			self.error(411, "the dump must be given with its Content-Length", close=True)
+			return
+		try:
+			length = int(self.headers["Content-Length"])
+		except ValueError:
+			length = -1
+		if length < 0:
+			self.error(400, "Content-Length must be a non-negative integer", close=True)
+			return
+		if length > SERVE_MAX_UPLOAD:
+			self.error(413, "dumps can't be larger than %d MB" % (SERVE_MAX_UPLOAD >> 20), close=True)
+			return
+		data = self.rfile.read(length)
+		
+		# Options are given as the query, without their dashes: ?usevol&bpm=120
+		options = urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+		
+		service = self.server.service
+		try:
+			result = service.convert(service.parseOptions(options), data)
+		except ValueError as e:
+			self.error(400, str(e))
+			return
+		except ConversionError as e:
+			self.error(422, str(e))
+			return
+		except ServerBusy as e:
+			self.error(503, str(e))
+			return
+		except ServerTimeout as e:
+			self.error(504, str(e))
+			return
+		
+		# Conversion details go along with the MIDI file
+		info = {
+			'mode': "NTSC" if result.mode == NTSC else "PAL", 'pokeys': result.numPOKEY,
+			'voices': result.voices, 'features': result.features, 'notes': result.numNotes,
+			'shortNotes': result.numShortNotes, 'tempos': result.tempos, 'loopStart': result.loopStart,
+			'loopLength': result.loopLength, 'stopTime': result.stopTime
+		}
+		self.reply(200, result.midi, "audio/midi", [("X-POKEY2MIDI-Info", json.dumps(info))])
 	
-	if args.output is not None:
-		output = args.output
+	# Unix sockets don't have client addresses
+	def address_string(self):
+		return self.client_address[0] if self.client_address else "local"
+
+# Parse a --serve address: a port, host:port, or anything else as the path of a Unix socket
+def serverAddress(address):
+	host, sep, port = address.rpartition(":")
+	if port.isdigit() and not os.sep in host:
+		return (host or "127.0.0.1", int(port))
+	return address
+
+# Run a conversion server, until interrupted
+def serve(args):
+	address = serverAddress(args.serve[0])
+	if not isinstance(address, tuple) and not hasattr(socketserver, "ThreadingUnixStreamServer"):
+		print("ERROR\nUnix sockets aren't available here. Use a port instead.")
+		return
+	workers = args.jobs[0] if args.jobs is not None else os.cpu_count()
+	service = ConversionService(
+		workers,
+		args.timeout[0] if args.timeout is not None else SERVE_TIMEOUT,
+		args.maxpending[0] if args.maxpending is not None else SERVE_MAX_PENDING
+	)
+	if isinstance(address, tuple):
+		server = http.server.ThreadingHTTPServer(address, ConversionHandler)
+		where = "http://%s:%d" % server.server_address[:2]
 	else:
-		output = os.path.splitext(os.path.realpath(input))[0] + ".mid"
+		if os.path.exists(address): # left over from a previous server
+			os.remove(address)
+		server = socketserver.ThreadingUnixStreamServer(address, ConversionHandler)
+		where = "unix:%s" % address
+	server.daemon_threads = True
+	server.service = service
+	print("POKEY2MIDI v%s serving on %s with %d worker%s" % (
+		VERSION, where, workers, "s" if workers != 1 else ""
+	))
+	sys.stdout.flush()
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit()) # stop cleanly when terminated
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.close()
+		if not isinstance(address, tuple):
+			os.remove(address)
+
+# If running by itself, handle command line options
+if __name__ == "__main__":
+	parser = makeArgumentParser()
+	args = parser.parse_args()
 	
-	if converter.DetectTempo and converter.AlwaysRetrigger:
-		print("Warning: --findbpm detection is incompatible with --all. No tempo will be detected.")
-		converter.DetectTempo = False
+	reporting = args.profile or args.profilemem or args.stats_json is not None
+	profiling = reporting or args.cprofile is not None
+	if profiling and (args.pack is not None or args.batch is not None or args.serve is not None):
+		parser.error("--profile, --profilemem, --stats-json and --cprofile can't be used with --batch, --pack or --serve")
 	
-	converter.convert(input, output)
+	if args.serve is not None:
+		if args.input is not None or args.batch is not None or args.pack is not None:
+			parser.error("input_file, --batch and --pack can't be used with --serve")
+		serve(args)
+	elif args.pack is not None:
+		if args.input is not None or args.batch is not None:
+			parser.error("input_file and --batch can't be used with --pack")
+		packDumps(args)
+	elif args.batch is not None:
+		if args.input is not None:
+			parser.error("input_file can't be used with --batch")
+		if args.variants is not None:
+			parser.error("--variants can't be used with --batch")
+		convertBatch(parser, args)
+	else:
+		if args.input is None:
+			parser.error("the following arguments are required: input_file")
+		
+		converter = makeConverter(args)
+		if args.jobs is not None:
+			converter.AssembleJobs = args.jobs[0]
+		
+		input = args.input
+		
+		if args.output is not None:
+			output = args.output
+		elif input == "-":
+			parser.error("output_file is required when reading from stdin")
+		else:
+			output = outputPath(input)
+		
+		variants = None
+		if args.variants is not None:
+			variants = makeVariants(parser, args, converter, output)
+			if args.jobs is None: # Variants are assembled at the same time by default
+				converter.AssembleJobs = os.cpu_count()
+		
+		try:
+			if not profiling:
+				converter.convert(input, output, variants)
+			else:
+				profiler = cProfile.Profile() if args.cprofile is not None else None
+				stats = None
+				if reporting:
+					stats = converter.Stats = ConversionStats(memory=args.profilemem)
+				with stats.collect() if stats is not None else contextlib.nullcontext():
+					if profiler is not None:
+						profiler.runcall(converter.convert, input, output, variants)
+					else:
+						converter.convert(input, output, variants)
+				if stats is not None:
+					stats.report()
+				if args.stats_json is not None:
+					with open(args.stats_json[0], "wt") as fs:
+						json.dump(stats.summary(), fs, indent=4)
+				if profiler is not None:
+					profiler.dump_stats(args.cprofile[0])
+					print("cProfile statistics saved at \"%s\"" % args.cprofile[0])
+		except ConversionError as e:
+			print("ERROR\n%s" % e)
+			sys.exit(1)
 
 # EOF